@@ -0,0 +1,190 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Benchmarks the queries issued by `run_query` and `process-data`, and the
+inserts of `process-data`, with and without the indexes declared on
+`ProcessedView` and `RawView`.
+
+Example: `python -m benchmarks.bench_indexes --num_rows 1000000 --num_rows 10000000`
+"""
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+import click
+import sqlalchemy as sqla
+
+from flaskr import create_app
+from flaskr.config import SiteConfig
+from flaskr.models.processed_view import ProcessedView
+from flaskr.models.raw_view import RawView
+from flaskr.processing.query_runner import (
+    FilterBy,
+    GroupBy,
+    Query,
+    QueryEngine,
+    run_query,
+)
+from flaskr.storage.database import db
+from flaskr.storage.processed_view_storage import write_processed_views
+
+START_TIME = datetime(2023, 1, 1)
+# Rows are spread evenly over this many days.
+NUM_DAYS = 365
+COUNTRIES = [f"Country-{i}" for i in range(50)]
+# Number of rows inserted per statement while populating the database.
+INSERT_CHUNK_SIZE = 50000
+# Number of raw views left unprocessed, as `process-data` would find them.
+NUM_UNPROCESSED = 500
+# Number of processed views inserted per commit, as by `process-data`.
+WRITE_BATCH_SIZE = 1000
+
+
+def make_processed_view(timestamp: datetime) -> ProcessedView:
+    """Returns a processed view with every column that queries group by set."""
+    country = random.choice(COUNTRIES)
+    return ProcessedView(
+        url=f"/post/{random.randrange(100)}",
+        ip_address="123.456.7890",
+        user_agent="benchmark",
+        timestamp=timestamp,
+        process_timestamp=START_TIME,
+        is_bot=random.random() < 0.3,
+        country=country,
+        region=f"{country}-Region-{random.randrange(10)}",
+        city=f"{country}-City-{random.randrange(100)}",
+        domain=f"isp-{random.randrange(1000)}.net",
+        operating_system_family=random.choice(["Windows", "Mac OS X", "Linux"]),
+        device_brand=random.choice(["Apple", "Samsung", "Google", None]),
+        device_type=random.choice(["Desktop", "Mobile", "Tablet"]),
+        browser_family=random.choice(["Chrome", "Firefox", "Safari", "Edge"]),
+    )
+
+
+def populate(num_rows: int):
+    """Inserts `num_rows` processed views and `num_rows` raw views."""
+    step = timedelta(days=NUM_DAYS) / num_rows
+    for chunk_start in range(0, num_rows, INSERT_CHUNK_SIZE):
+        chunk = range(chunk_start, min(chunk_start + INSERT_CHUNK_SIZE, num_rows))
+        write_processed_views(
+            db.session, [make_processed_view(START_TIME + i * step) for i in chunk]
+        )
+        db.session.execute(
+            sqla.insert(RawView),
+            [
+                {
+                    "url": f"/post/{i % 100}",
+                    "ip_address": "123.456.7890",
+                    "user_agent": "benchmark",
+                    "timestamp": START_TIME + i * step,
+                    "process_timestamp": (
+                        None
+                        if i >= num_rows - NUM_UNPROCESSED
+                        else START_TIME + i * step
+                    ),
+                }
+                for i in chunk
+            ],
+        )
+        db.session.commit()
+
+
+def time_ms(func: Callable, repeat: int) -> float:
+    """Returns the median latency of `func` in milliseconds."""
+    timings: List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def write_batch(views: List[ProcessedView]):
+    write_processed_views(db.session, views)
+    db.session.commit()
+
+
+def run_benchmarks(repeat: int) -> dict:
+    # Views newer than those populated, built up front so that only the
+    # insert is timed.
+    new_views = [
+        make_processed_view(START_TIME + timedelta(days=NUM_DAYS, seconds=i))
+        for i in range(WRITE_BATCH_SIZE)
+    ]
+    day_query = Query(
+        START_TIME + timedelta(days=100),
+        START_TIME + timedelta(days=101, minutes=30),
+        1800,
+        GroupBy.Country,
+        FilterBy.Humans,
+    )
+    return {
+        "query one day by country": time_ms(
+            lambda: run_query(db.session, day_query, QueryEngine.Sql), repeat
+        ),
+        "find unprocessed raw views": time_ms(
+            lambda: RawView.query.filter_by(process_timestamp=None).all(), repeat
+        ),
+        f"insert {WRITE_BATCH_SIZE} processed views": time_ms(
+            lambda: write_batch(new_views), repeat
+        ),
+    }
+
+
+def set_indexes(enabled: bool):
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if enabled:
+                index.create(bind=db.engine, checkfirst=True)
+            else:
+                index.drop(bind=db.engine, checkfirst=True)
+    db.session.execute(sqla.text("ANALYZE"))
+
+
+@click.command()
+@click.option(
+    "--num_rows",
+    type=int,
+    multiple=True,
+    default=[1000000, 10000000],
+    help="Number of rows to benchmark with. May be given several times.",
+)
+@click.option("--repeat", type=int, default=5, help="Runs per measurement.")
+def main(num_rows: List[int], repeat: int):
+    for n in num_rows:
+        with tempfile.TemporaryDirectory() as tempdir:
+            app = create_app(test_config=SiteConfig("benchmark", tempdir))
+            with app.app_context():
+                db.create_all()
+                set_indexes(False)
+                click.echo(f"Inserting {n} rows...")
+                populate(n)
+                without = run_benchmarks(repeat)
+                set_indexes(True)
+                with_ = run_benchmarks(repeat)
+                for name in without:
+                    click.echo(
+                        f"{n:>10} rows | {name:<30} "
+                        f"| no indexes {without[name]:>9.2f} ms "
+                        f"| indexes {with_[name]:>9.2f} ms"
+                    )
+                db.session.close()
+                db.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measures the lookup throughput of `RangeDatabaseProvider`.
+
+Example: `python -m benchmarks.bench_ip_providers --num_ranges 500000`
+"""
+import csv
+import random
+import socket
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from flaskr.processing.ip_providers import RangeDatabaseProvider
+
+
+def int_to_ip(value: int) -> str:
+    return socket.inet_ntoa(value.to_bytes(4, "big"))
+
+
+@click.command()
+@click.option("--num_ranges", type=int, default=500000)
+@click.option("--num_lookups", type=int, default=1000000)
+def main(num_ranges: int, num_lookups: int):
+    # Split the IPv4 space into `num_ranges` contiguous ranges.
+    bounds = sorted(random.sample(range(1, 2**32), num_ranges - 1))
+    starts = [0] + bounds
+    ends = [b - 1 for b in bounds] + [2**32 - 1]
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir) / "ranges.csv"
+        with open(path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                writer.writerow(
+                    [int_to_ip(start), int_to_ip(end), f"Country-{i % 250}"]
+                )
+        start_time = time.perf_counter()
+        provider = RangeDatabaseProvider(str(path))
+        click.echo(
+            f"Loaded {num_ranges} ranges in {time.perf_counter() - start_time:.2f} s."
+        )
+
+    ip_addresses = [int_to_ip(random.getrandbits(32)) for _ in range(num_lookups)]
+    start_time = time.perf_counter()
+    for i in range(0, num_lookups, provider.batch_size):
+        provider.lookup(ip_addresses[i : i + provider.batch_size])
+    elapsed = time.perf_counter() - start_time
+    click.echo(
+        f"Looked up {num_lookups} IP addresses in {elapsed:.2f} s "
+        f"({num_lookups / elapsed:,.0f} IPs/sec)."
+    )
+
+
+if __name__ == "__main__":
+    main()
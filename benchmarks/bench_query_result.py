@@ -0,0 +1,86 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measures the time to create a `QueryResult`, fill it with the kind of
+(key, bucket, count) rows returned by the SQL engine, and serialize it to
+JSON in each format.
+
+Example: `python -m benchmarks.bench_query_result --num_buckets 1000 --num_keys 200`
+"""
+import json
+import random
+import statistics
+import time
+from datetime import datetime
+
+import click
+
+from flaskr.processing.query_result import QueryResult
+
+START_TIME = datetime(2023, 1, 1)
+
+
+def run(rows: list, num_buckets: int) -> dict:
+    """Returns the time in ms taken by each step."""
+    timings = {}
+    start = time.perf_counter()
+    result = QueryResult(
+        START_TIME, START_TIME.replace(year=2024), 365 * 86400 // num_buckets
+    )
+    timings["init"] = time.perf_counter() - start
+    start = time.perf_counter()
+    if hasattr(result, "add_counts"):
+        result.add_counts(rows)
+    else:
+        for key, bucket_index, count in rows:
+            result.add(key, bucket_index, count)
+    timings["add"] = time.perf_counter() - start
+    start = time.perf_counter()
+    json.dumps(result.make_json())
+    timings["json"] = time.perf_counter() - start
+    if hasattr(result, "make_columnar_json"):
+        start = time.perf_counter()
+        json.dumps(result.make_columnar_json())
+        timings["columnar"] = time.perf_counter() - start
+    return {name: elapsed * 1000 for name, elapsed in timings.items()}
+
+
+@click.command()
+@click.option("--num_runs", type=int, default=10)
+@click.option("--num_buckets", type=int, default=1000)
+@click.option("--num_keys", type=int, default=200)
+@click.option(
+    "--density",
+    type=float,
+    default=0.5,
+    help="Fraction of (bucket, key) pairs that have a count.",
+)
+def main(num_runs: int, num_buckets: int, num_keys: int, density: float):
+    random.seed(0)
+    rows = [
+        (f"key-{k}", b, random.randint(1, 100))
+        for b in range(num_buckets)
+        for k in range(num_keys)
+        if random.random() < density
+    ]
+    timings = [run(rows, num_buckets) for _ in range(num_runs)]
+    click.echo(f"{len(rows)} rows into {num_buckets} buckets x {num_keys} keys")
+    for name in timings[0]:
+        click.echo(
+            f"{name:<10} median {statistics.median(t[name] for t in timings):8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measures how quickly `flask restore-log` loads a backup log into an empty
+database, and how quickly it skips a log whose views are all stored.
+
+Example: `python -m benchmarks.bench_restore_log --num_rows 1000000`
+"""
+import csv
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+
+from flaskr import create_app
+from flaskr.config import SiteConfig
+from flaskr.storage.database import db
+
+START_TIME = datetime(2023, 1, 1)
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:80.0) Gecko/20100101 Firefox/80.0"
+)
+
+
+def write_log(path: str, num_rows: int):
+    with open(path, "w", newline="") as log_file:
+        writer = csv.writer(log_file)
+        for i in range(num_rows):
+            writer.writerow(
+                [
+                    (START_TIME + timedelta(milliseconds=100 * i)).isoformat(),
+                    f"/post/{i % 50}",
+                    f"10.{i % 256}.{i // 256 % 256}.{i % 100}",
+                    USER_AGENT,
+                ]
+            )
+
+
+@click.command()
+@click.option("--num_rows", type=int, default=1000000)
+def main(num_rows: int):
+    with tempfile.TemporaryDirectory() as tempdir:
+        app = create_app(test_config=SiteConfig("benchmark", tempdir))
+        with app.app_context():
+            db.create_all()
+            write_log(app.config["LOG_PATH"], num_rows)
+            runner = app.test_cli_runner()
+            for name in ["empty database", "already restored"]:
+                start = time.perf_counter()
+                res = runner.invoke(args=["restore-log"])
+                elapsed = time.perf_counter() - start
+                assert res.exit_code == 0, res.output
+                click.echo(
+                    f"{name:<16} {elapsed:6.2f}s | "
+                    f"{num_rows / elapsed * 60 / 1e6:5.2f}M rows/min | "
+                    f"{res.output.strip()}"
+                )
+            db.session.close()
+            db.engine.dispose()
+            app.extensions["backup_log"].close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measures mixed read/write throughput against a single SQLite database, with
+writer processes ingesting batches of raw views (like `POST /api/v1/traffic`)
+while reader processes run dashboard queries (like `/api/v1/data/query`).
+Each journal mode is run against a fresh database.
+
+Example: `python -m benchmarks.bench_sqlite_concurrency --duration 10`
+"""
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Tuple
+
+import click
+import sqlalchemy as sqla
+
+from benchmarks.bench_write_raw_views import make_batch
+from flaskr import create_app
+from flaskr.config import SiteConfig
+from flaskr.models.processed_view import ProcessedView
+from flaskr.processing.query_runner import GroupBy, Query, QueryEngine, run_query
+from flaskr.storage.database import db
+from flaskr.storage.raw_view_storage import write_raw_views
+
+START_TIME = datetime(2023, 1, 1)
+NUM_DAYS = 30
+
+
+def make_config(instance_path: str, journal_mode: str, synchronous: str):
+    return SiteConfig(
+        "benchmark",
+        instance_path,
+        sqlite_journal_mode=journal_mode,
+        sqlite_synchronous=synchronous,
+    )
+
+
+def seed(config: SiteConfig, num_views: int):
+    """Creates the schema and adds `num_views` processed views."""
+    app = create_app(test_config=config)
+    with app.app_context():
+        db.create_all()
+        step = timedelta(days=NUM_DAYS) / num_views
+        db.session.execute(
+            sqla.insert(ProcessedView),
+            [
+                {
+                    "url": f"/post/{i % 50}",
+                    "ip_address": f"10.0.{i % 256}.{i % 100}",
+                    "user_agent": "benchmark",
+                    "timestamp": START_TIME + step * i,
+                    "process_timestamp": datetime.now(),
+                    "is_bot": i % 5 == 0,
+                    "country": f"Country {i % 20}",
+                }
+                for i in range(num_views)
+            ],
+        )
+        db.session.commit()
+        db.engine.dispose()
+
+
+def run_worker(
+    config: SiteConfig, is_writer: bool, start_barrier, duration: float
+) -> Tuple[int, int]:
+    """
+    Repeatedly writes a batch or runs a query for `duration` seconds, starting
+    once all workers reach `start_barrier`. Returns the number of completed
+    operations and the number that failed.
+    """
+    app = create_app(test_config=config)
+    num_done, num_failed = 0, 0
+    with app.app_context():
+        query = Query(
+            START_TIME, START_TIME + timedelta(days=7), 86400, GroupBy.Url, None
+        )
+        start_barrier.wait()
+        end_time = time.perf_counter() + duration
+        while time.perf_counter() < end_time:
+            try:
+                if is_writer:
+                    write_raw_views(make_batch(num_done))
+                else:
+                    run_query(db.session, query, QueryEngine.Sql)
+                    db.session.rollback()
+                num_done += 1
+            except sqla.exc.OperationalError:
+                db.session.rollback()
+                num_failed += 1
+        db.engine.dispose()
+    return num_done, num_failed
+
+
+@click.command()
+@click.option("--duration", type=float, default=10, help="Seconds per run.")
+@click.option("--writers", type=int, default=2)
+@click.option("--readers", type=int, default=4)
+@click.option("--num_views", type=int, default=100000)
+def main(duration: float, writers: int, readers: int, num_views: int):
+    mp_context = multiprocessing.get_context("spawn")
+    num_workers = writers + readers
+    for journal_mode, synchronous in [("DELETE", "FULL"), ("WAL", "NORMAL")]:
+        with tempfile.TemporaryDirectory() as tempdir, mp_context.Manager() as manager:
+            config = make_config(tempdir, journal_mode, synchronous)
+            seed(config, num_views)
+            start_barrier = manager.Barrier(num_workers)
+            with ProcessPoolExecutor(num_workers, mp_context=mp_context) as pool:
+                futures = [
+                    pool.submit(
+                        run_worker, config, i < writers, start_barrier, duration
+                    )
+                    for i in range(num_workers)
+                ]
+                results = [future.result() for future in futures]
+        writes = sum(done for done, _ in results[:writers])
+        reads = sum(done for done, _ in results[writers:])
+        failed = sum(failed for _, failed in results)
+        click.echo(
+            f"{journal_mode:<6} synchronous={synchronous:<6} | "
+            f"{writes / duration:7.1f} writes/sec | "
+            f"{reads / duration:7.1f} queries/sec | {failed} failed"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measures the time to validate a `POST /api/v1/traffic` body of 200 views
+with `ReportTrafficContract.load` (marshmallow) and with `fast_load`.
+
+Example: `python -m benchmarks.bench_traffic_contract --num_runs 500`
+"""
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import click
+
+from flaskr.contracts.report_traffic import ReportTrafficContract
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:80.0) Gecko/20100101 Firefox/80.0"
+)
+
+
+def make_body(num_views: int) -> dict:
+    return {
+        "traffic": [
+            {
+                "url": f"https://www.stefanonsoftware.com/post/{i % 20}",
+                "ip_address": f"10.0.{i % 256}.{i % 100}",
+                "user_agent": USER_AGENT,
+                "timestamp": (
+                    datetime(2023, 1, 1) + timedelta(seconds=i, microseconds=i)
+                ).isoformat(),
+            }
+            for i in range(num_views)
+        ]
+    }
+
+
+@click.command()
+@click.option("--num_runs", type=int, default=500)
+@click.option("--num_views", type=int, default=200)
+def main(num_runs: int, num_views: int):
+    body = make_body(num_views)
+    assert ReportTrafficContract.load(body) == ReportTrafficContract.fast_load(body)
+    for name, load in [
+        ("marshmallow", ReportTrafficContract.load),
+        ("fast_load", ReportTrafficContract.fast_load),
+    ]:
+        timings = []
+        for _ in range(num_runs):
+            start = time.perf_counter()
+            load(body)
+            timings.append((time.perf_counter() - start) * 1000)
+        click.echo(
+            f"{name:<12} median {statistics.median(timings):7.3f} ms | "
+            f"{num_views / statistics.median(timings) * 1000:9.0f} views/sec"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Measures the per-request latency of `write_raw_views` for batches of 200
+views, compared to adding one ORM object per view (the previous approach).
+
+Example: `python -m benchmarks.bench_write_raw_views --num_requests 500`
+"""
+import csv
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, List
+
+import click
+from flask import current_app
+
+from flaskr import create_app
+from flaskr.config import SiteConfig
+from flaskr.contracts.report_traffic import SinglePageView
+from flaskr.models.raw_view import RawView
+from flaskr.storage.database import db
+from flaskr.storage.raw_view_storage import write_raw_views
+
+BATCH_SIZE = 200
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:80.0) Gecko/20100101 Firefox/80.0"
+)
+
+
+def write_raw_views_orm(views: List[SinglePageView]):
+    """The ORM-based implementation that `write_raw_views` replaced."""
+    with open(current_app.config["LOG_PATH"], "a", newline="") as log_file:
+        writer = csv.writer(log_file, delimiter=",")
+        for view in views:
+            writer.writerow(
+                [
+                    view.timestamp.isoformat(),
+                    view.url.strip(),
+                    view.ip_address.strip(),
+                    view.user_agent.strip(),
+                ]
+            )
+    for view in views:
+        db.session.add(
+            RawView(
+                url=view.url.strip(),
+                ip_address=view.ip_address.strip(),
+                user_agent=view.user_agent.strip(),
+                timestamp=view.timestamp,
+            )
+        )
+    db.session.commit()
+
+
+def make_batch(i: int) -> List[SinglePageView]:
+    return [
+        SinglePageView(
+            url=f"/post/{j}",
+            ip_address=f"10.0.{i % 256}.{j}",
+            user_agent=USER_AGENT,
+            timestamp=datetime.now(),
+        )
+        for j in range(BATCH_SIZE)
+    ]
+
+
+def measure(write: Callable, num_requests: int) -> List[float]:
+    """Returns the latency of each call to `write`, in milliseconds."""
+    latencies = []
+    with tempfile.TemporaryDirectory() as tempdir:
+        app = create_app(test_config=SiteConfig("benchmark", tempdir))
+        with app.app_context():
+            db.create_all()
+            batches = [make_batch(i) for i in range(num_requests)]
+            for batch in batches:
+                start = time.perf_counter()
+                write(batch)
+                latencies.append((time.perf_counter() - start) * 1000)
+            db.session.close()
+            db.engine.dispose()
+    return latencies
+
+
+@click.command()
+@click.option("--num_requests", type=int, default=500)
+def main(num_requests: int):
+    for name, write in [
+        ("ORM objects", write_raw_views_orm),
+        ("write_raw_views", write_raw_views),
+    ]:
+        latencies = sorted(measure(write, num_requests))
+        click.echo(
+            f"{name:<16} median {statistics.median(latencies):7.2f} ms | "
+            f"p95 {latencies[int(len(latencies) * 0.95)]:7.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
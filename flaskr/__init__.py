@@ -16,7 +16,8 @@ import os
 from flask import Flask
 
 from .config import SiteConfig, validate_config
-from .storage.database import db
+from .storage.backup_log import BackupLogWriter
+from .storage.database import db, enable_sqlite_pragmas
 
 
 def create_app(test_config: SiteConfig = None):
@@ -37,6 +38,13 @@ def create_app(test_config: SiteConfig = None):
         app.instance_path, "db.sqlite"
     )
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLITE_PRAGMAS"] = site_config.make_sqlite_pragmas()
+    app.config["MAX_VIEWS_PER_REQUEST"] = site_config.max_views_per_request
+    app.config["IP_API_URL"] = site_config.ip_api_url
+    app.config["IP_CACHE_TTL_DAYS"] = site_config.ip_cache_ttl_days
+    app.config["IP_CACHE_NEGATIVE_TTL_DAYS"] = site_config.ip_cache_negative_ttl_days
+    app.config["IP_DATABASE_PATH"] = site_config.ip_database_path
+    app.config["IP_API_FALLBACK"] = site_config.ip_api_fallback
 
     app.logger.info(f'LOG_PATH: {app.config["LOG_PATH"]}')
     app.logger.info(f'DATABASE_URI: {app.config["SQLALCHEMY_DATABASE_URI"]}')
@@ -46,6 +54,34 @@ def create_app(test_config: SiteConfig = None):
 
     auth.login_manager.init_app(app)
     db.init_app(app)
+    with app.app_context():
+        enable_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
+    app.extensions["backup_log"] = BackupLogWriter(
+        app.config["LOG_PATH"],
+        site_config.backup_log_max_bytes,
+        site_config.backup_log_rotate_interval_sec,
+        site_config.backup_log_compress,
+        site_config.backup_log_flush_interval_sec,
+        site_config.backup_log_max_segments,
+        app.logger,
+    )
+    if site_config.query_cache_max_entries:
+        from .processing.query_cache import QueryCache
+
+        app.extensions["query_cache"] = QueryCache(
+            site_config.query_cache_max_entries,
+            site_config.query_cache_max_bytes,
+            site_config.query_cache_max_age_sec,
+        )
+    if site_config.ingestion_buffer_enabled:
+        from .storage.ingestion_buffer import IngestionBuffer
+
+        app.extensions["ingestion_buffer"] = IngestionBuffer(
+            app,
+            site_config.ingestion_buffer_max_views,
+            site_config.ingestion_flush_views,
+            site_config.ingestion_flush_interval_sec,
+        )
 
     # Register blueprints.
     from .api import data_api, traffic_api
@@ -59,7 +95,10 @@ def create_app(test_config: SiteConfig = None):
 
     # Register click commands.
     app.cli.add_command(cli.init_db_command)
+    app.cli.add_command(cli.upgrade_db_command)
     app.cli.add_command(cli.process_data)
+    app.cli.add_command(cli.rebuild_rollups_command)
+    app.cli.add_command(cli.restore_log)
     app.cli.add_command(cli.garbage_collect)
 
     return app
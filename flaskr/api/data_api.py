@@ -11,27 +11,159 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import gzip
+from typing import Optional
+
 import marshmallow
-from flask import Blueprint, Response, request
+from flask import Blueprint, Response, current_app, request
 from flask_login import login_required
 
-from flaskr.contracts.query_contract import QueryContract
-from flaskr.processing.query_runner import run_query
+from flaskr.contracts.query_contract import BatchQueryContract, QueryContract
+from flaskr.processing.query_cache import CachedResponse, make_etag
+from flaskr.processing.query_result import QueryResult, ResultFormat
+from flaskr.processing.query_runner import run_queries, run_query
 from flaskr.storage.database import db
 
+try:
+    import brotli
+except ImportError:
+    # Responses are gzipped instead.
+    brotli = None
+
 blueprint = Blueprint("data", __name__, url_prefix="/api/v1/data")
 
+# Compression levels that favour speed, as responses are compressed on
+# every cache miss.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
 
 @blueprint.route("/query")
 @login_required
 def query():
     """
     Endpoint used to execute a query against the ProcessedViews.
-    Arguments are expected as query parameters.
+    Arguments are expected as query parameters. `format=Columnar` selects
+    the compact format of `QueryResult.make_columnar_json()`.
+
+    Results are cached (see `QueryCache`) and carry an ETag, so clients
+    can revalidate with `If-None-Match` and get a 304 if nothing changed.
+    They are compressed if the client accepts it.
     """
     try:
-        query_ = QueryContract.load(request.args).to_query()
-        result = run_query(db.session, query_)
-        return result.make_json()
+        contract = QueryContract.load(request.args)
+        query_ = contract.to_query()
+        encoding = choose_encoding()
+        # The cache holds a body per format and encoding.
+        variant = f"{contract.format.name}/{encoding or 'identity'}"
+        query_cache = current_app.extensions.get("query_cache")
+        cached = None
+        if query_cache is not None:
+            change_id = query_cache.sync(db.session)
+            cached = query_cache.get(query_, variant)
+        if cached is None:
+            previous = None
+            if query_cache is not None:
+                # Reuse the buckets of an earlier result, e.g. of the same
+                # dashboard panel a minute ago.
+                previous = query_cache.get_partial(query_)
+            result = run_query(db.session, query_, previous=previous)
+            body = compress(_make_body(result, contract.format), encoding)
+            if query_cache is not None:
+                cached = query_cache.put(
+                    query_,
+                    body,
+                    change_id,
+                    variant,
+                    result=result,
+                    created=previous.created if previous else None,
+                )
+            else:
+                cached = CachedResponse(body, make_etag(body))
+        response = _make_response(cached.body, encoding)
+        response.set_etag(cached.etag)
+        # Let browsers keep the result, but revalidate it on every use.
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    except (marshmallow.exceptions.ValidationError, ValueError) as e:
+        # `run_query()` raises ValueErrors for queries it can't answer, e.g.
+        # with too many buckets.
+        return Response(status=400, response="Invalid parameters: {}".format(e))
+
+
+@blueprint.route("/batch_query", methods=["POST"])
+@login_required
+def batch_query():
+    """
+    Endpoint used to execute several queries that share a time range and
+    filter, e.g. the charts of a dashboard, in a single pass over the data.
+    Arguments are expected as a JSON body (see `BatchQueryContract`).
+
+    Responds with `{"results": [...]}`, holding the result of each query
+    in order, as `query()` would return it.
+    """
+    try:
+        contract = BatchQueryContract.load(request.get_json())
     except marshmallow.exceptions.ValidationError as e:
         return Response(status=400, response="Invalid parameters: {}".format(e))
+    queries = contract.to_queries()
+    variant = f"{contract.format.name}/identity"
+
+    query_cache = current_app.extensions.get("query_cache")
+    bodies = [None] * len(queries)
+    if query_cache is not None:
+        change_id = query_cache.sync(db.session)
+        for i, query_ in enumerate(queries):
+            cached = query_cache.get(query_, variant)
+            if cached is not None:
+                bodies[i] = cached.body
+    missing = [i for i, body in enumerate(bodies) if body is None]
+    try:
+        results = run_queries(db.session, [queries[i] for i in missing])
+    except ValueError as e:
+        return Response(status=400, response="Invalid parameters: {}".format(e))
+    for i, result in zip(missing, results):
+        bodies[i] = _make_body(result, contract.format)
+        if query_cache is not None:
+            query_cache.put(queries[i], bodies[i], change_id, variant, result=result)
+    # The bodies are JSON already, so they are joined rather than re-encoded.
+    encoding = choose_encoding()
+    body = b'{"results": [' + b", ".join(bodies) + b"]}"
+    return _make_response(compress(body, encoding), encoding)
+
+
+def choose_encoding() -> Optional[str]:
+    """
+    Returns the content encoding to compress the response with, based on
+    the request's Accept-Encoding header. None means no compression.
+    """
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    """Compresses `body` with the content encoding `encoding`."""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        # A fixed mtime makes equal bodies compress to equal bytes and ETags.
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
+
+
+def _make_body(result: QueryResult, result_format: ResultFormat) -> bytes:
+    """Serializes `result` to the JSON response body of a query."""
+    return current_app.json.dumps(result.serialize(result_format)).encode()
+
+
+def _make_response(body: bytes, encoding: Optional[str]) -> Response:
+    """Returns a JSON response with the `body` compressed with `encoding`."""
+    response = Response(body, mimetype="application/json")
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    return response
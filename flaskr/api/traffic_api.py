@@ -11,37 +11,263 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
+import pickle
+import tempfile
+import zlib
+from typing import IO, Iterator, Tuple
+
 import marshmallow
-from flask import Blueprint, Response, request
+from flask import Blueprint, Response, current_app, request
 from flask_login import login_required
 
 from flaskr.contracts.report_traffic import ReportTrafficContract
-from flaskr.storage.raw_view_storage import write_raw_views
+from flaskr.storage.database import db
+from flaskr.storage.ingestion_buffer import BufferFullError
+from flaskr.storage.raw_view_storage import insert_raw_views, write_raw_views
 
 blueprint = Blueprint("traffic", __name__, url_prefix="/api/v1/traffic")
 
 
-# The maximum number of views allowed to be reported per request.
-MAX_ALLOWED_VIEWS_PER_REQUEST = 200
+# The maximum size of a gzipped JSON request body once decompressed is
+# this many bytes per view allowed in a request, but at least
+# `MIN_DECOMPRESSED_BYTES`.
+MAX_DECOMPRESSED_BYTES_PER_VIEW = 4 * 1024
+MIN_DECOMPRESSED_BYTES = 4 * 1024 * 1024
+# Content type of request bodies in the format of `ColumnarTrafficSchema`.
+COLUMNAR_CONTENT_TYPE = "application/vnd.site-analytics.columnar+json"
+# Content type of request bodies with one `SinglePageViewSchema` per line.
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+# The maximum size of a single line of an NDJSON request body.
+MAX_NDJSON_LINE_BYTES = 64 * 1024
+# Number of views of an NDJSON request body that are written at a time.
+NDJSON_WRITE_CHUNK_SIZE = 1000
+# Bytes of validated views that are held in memory before spilling to disk.
+MAX_SPOOL_MEMORY_BYTES = 4 * 1024 * 1024
+# Number of bytes read from the request stream at a time.
+READ_SIZE = 64 * 1024
+
+
+class RequestBodyError(Exception):
+    """Raised when a request body can't be read."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def get_max_decompressed_bytes() -> int:
+    """Returns the maximum size of a compressed JSON body once decompressed."""
+    return max(
+        MIN_DECOMPRESSED_BYTES,
+        current_app.config["MAX_VIEWS_PER_REQUEST"] * MAX_DECOMPRESSED_BYTES_PER_VIEW,
+    )
+
+
+def read_json_body():
+    """
+    Returns the JSON request body, decompressing it first if it was sent
+    with `Content-Encoding: gzip`. Raises `RequestBodyError` otherwise.
+    """
+    if (request.content_encoding or "identity").lower() == "identity":
+        body = request.get_data()
+    else:
+        max_bytes = get_max_decompressed_bytes()
+        chunks = []
+        size = 0
+        for chunk in iter_body_chunks():
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                raise RequestBodyError(
+                    413, f"The body exceeds {max_bytes} bytes decompressed."
+                )
+        body = b"".join(chunks)
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        raise RequestBodyError(400, f"Invalid JSON body: {e}")
+
+
+def iter_body_chunks() -> Iterator[bytes]:
+    """
+    Yields the request body in chunks of at most `READ_SIZE` bytes,
+    decompressing it if it was sent with `Content-Encoding: gzip`.
+    """
+    encoding = (request.content_encoding or "identity").lower()
+    if encoding not in ("identity", "gzip"):
+        raise RequestBodyError(415, f"Unsupported Content-Encoding {encoding}.")
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    while True:
+        chunk = request.stream.read(READ_SIZE)
+        if not chunk:
+            break
+        if encoding == "identity":
+            yield chunk
+            continue
+        try:
+            # Limit the output size, so that a small chunk can't decompress
+            # into something huge.
+            yield decompressor.decompress(chunk, READ_SIZE)
+            while decompressor.unconsumed_tail:
+                yield decompressor.decompress(decompressor.unconsumed_tail, READ_SIZE)
+        except zlib.error as e:
+            raise RequestBodyError(400, f"Invalid gzip body: {e}")
+
+
+def iter_body_lines() -> Iterator[bytes]:
+    """Yields the lines of the request body."""
+    remainder = b""
+    for chunk in iter_body_chunks():
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        if len(remainder) > MAX_NDJSON_LINE_BYTES:
+            raise RequestBodyError(
+                413, f"A line exceeds {MAX_NDJSON_LINE_BYTES} bytes."
+            )
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+def spool_ndjson_views(max_views: int) -> Tuple[IO[bytes], int]:
+    """
+    Validates the views in an NDJSON request body and spools them, in
+    pickled chunks of `NDJSON_WRITE_CHUNK_SIZE`, to a temporary file that
+    only spills to disk once it is large. Returns the file and the number
+    of views. Raises a `ValidationError` for the first invalid view.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOL_MEMORY_BYTES)
+    try:
+        num_views = _spool_views(spool, max_views)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, num_views
+
+
+def _spool_views(spool: IO[bytes], max_views: int) -> int:
+    chunk = []
+    num_views = 0
+    for line in iter_body_lines():
+        if not line.strip():
+            continue
+        if num_views == max_views:
+            raise RequestBodyError(400, make_too_many_views_message(max_views))
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise RequestBodyError(400, f"Invalid JSON for view {num_views}: {e}")
+        try:
+            view = ReportTrafficContract.load_view(data)
+        except marshmallow.exceptions.ValidationError as e:
+            # Report errors by view index, like `ReportTrafficSchema`.
+            raise marshmallow.exceptions.ValidationError(
+                {"traffic": {num_views: e.messages}}
+            )
+        chunk.append(view)
+        num_views += 1
+        if len(chunk) == NDJSON_WRITE_CHUNK_SIZE:
+            pickle.dump(chunk, spool)
+            chunk = []
+    if chunk:
+        pickle.dump(chunk, spool)
+    return num_views
+
+
+def write_spooled_views(spool: IO[bytes]):
+    """
+    Writes the views spooled by `spool_ndjson_views()`, chunk by chunk, in a
+    single transaction, so that a failed request stores none of its views
+    and can be retried without duplicating them.
+    """
+    try:
+        while True:
+            try:
+                chunk = pickle.load(spool)
+            except EOFError:
+                break
+            insert_raw_views(chunk)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def make_too_many_views_message(max_views: int, num_views: int = None) -> str:
+    return (
+        f"Too many traffic records in this request; the maximum allowed is "
+        f"{max_views} but this one has {num_views or 'more'}"
+    )
 
 
 @blueprint.route("", methods=["POST"])
 @login_required
 def report_traffic():
+    """
+    Endpoint used to report page views. The body is either JSON in the
+    format of `ReportTrafficSchema`, or, with the content type
+    `COLUMNAR_CONTENT_TYPE`, in the format of `ColumnarTrafficSchema`, or,
+    with the content type `NDJSON_CONTENT_TYPE`, one view per line. Any of
+    these may be gzipped.
+    """
+    if request.mimetype == NDJSON_CONTENT_TYPE:
+        return report_ndjson_traffic()
+    if not request.is_json:
+        return Response(status=415, response="The body must be JSON.")
+    try:
+        data = read_json_body()
+    except RequestBodyError as e:
+        return Response(status=e.status, response=str(e))
     try:
-        contract = ReportTrafficContract.load(request.json)
+        if request.mimetype == COLUMNAR_CONTENT_TYPE:
+            contract = ReportTrafficContract.load_columnar(data)
+        else:
+            contract = ReportTrafficContract.fast_load(data)
         if not contract.views:
             return Response(
                 status=400, response="The request did not contain any traffic records."
             )
-        if len(contract.views) > MAX_ALLOWED_VIEWS_PER_REQUEST:
+        max_views = current_app.config["MAX_VIEWS_PER_REQUEST"]
+        if len(contract.views) > max_views:
             return Response(
                 status=400,
-                response=f"Too many traffic records in this request; the maximum "
-                f"allowed is {MAX_ALLOWED_VIEWS_PER_REQUEST} but this one"
-                f" has {len(contract.views)}",
+                response=make_too_many_views_message(max_views, len(contract.views)),
             )
-        write_raw_views(contract.views)
-        return Response(status=200)
+        ingestion_buffer = current_app.extensions.get("ingestion_buffer")
+        if ingestion_buffer is None:
+            write_raw_views(contract.views)
+            return Response(status=200)
+        try:
+            ingestion_buffer.submit(contract.views)
+        except BufferFullError as e:
+            return Response(status=503, response=str(e), headers={"Retry-After": "1"})
+        # The views have been accepted but not yet written.
+        return Response(status=202)
     except marshmallow.exceptions.ValidationError as e:
         return Response(status=400, response=f"Invalid parameters: {e}")
+
+
+def report_ndjson_traffic():
+    """
+    Reports the views in an NDJSON request body. The body is streamed and
+    fully validated before any view is written, then written in chunks within
+    one transaction, so that large batches don't need to be held in memory.
+    Always writes synchronously, even if the ingestion buffer is enabled.
+    """
+    try:
+        spool, num_views = spool_ndjson_views(
+            current_app.config["MAX_VIEWS_PER_REQUEST"]
+        )
+    except RequestBodyError as e:
+        return Response(status=e.status, response=str(e))
+    except marshmallow.exceptions.ValidationError as e:
+        return Response(status=400, response=f"Invalid parameters: {e}")
+    with spool:
+        if not num_views:
+            return Response(
+                status=400, response="The request did not contain any traffic records."
+            )
+        write_spooled_views(spool)
+    return Response(status=200)
@@ -12,15 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Flask CLI commands."""
+import itertools
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from datetime import datetime, timedelta
+from typing import List, Optional, Set
 
 import click
+import sqlalchemy as sqla
 from flask import current_app
 from flask.cli import with_appcontext
 
+from flaskr.models.processed_view import ProcessedView
 from flaskr.models.raw_view import RawView
+from flaskr.models.view_rollup import ViewRollup
+from flaskr.models.visitor_sketch import VisitorSketch
+from flaskr.processing.rollups import (
+    RollupAccumulator,
+    rebuild_rollups,
+    rebuild_visitor_sketches,
+)
+from flaskr.processing.shard_processing import (
+    iter_unprocessed_id_ranges,
+    process_shard,
+    read_shard_ip_addresses,
+)
 from flaskr.processing.view_processor import ViewProcessor
+from flaskr.storage.backup_log import read_log
 from flaskr.storage.database import db
+from flaskr.storage.processed_view_storage import (
+    mark_raw_views_processed,
+    write_processed_views,
+)
+from flaskr.storage.raw_view_storage import (
+    insert_new_raw_views,
+    read_unprocessed_raw_views,
+)
+from flaskr.storage.view_change_storage import delete_view_changes, record_view_change
+
+# The number of unprocessed views handed to a worker process at a time.
+SHARD_SIZE = 2000
+# The number of shards per worker process that are read or waiting to be
+# written at a time.
+SHARDS_IN_FLIGHT_PER_WORKER = 2
 
 
 @click.command("reset-db")
@@ -36,25 +71,266 @@ def init_db_command():
     current_app.logger.info("Reset the database.")
 
 
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    """
+    Creates any tables and indexes that are missing from the existing
+    database. Unlike `reset-db`, this keeps all data.
+
+    If the rollups or visitor sketch tables are new, they are filled from
+    the processed views, as aligned queries are answered from them.
+    """
+    current_app.logger.info("Upgrading the database.")
+    existing_tables = set(sqla.inspect(db.engine).get_table_names())
+    # `create_all()` skips tables that already exist, including their indexes.
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            current_app.logger.info(f"Ensuring index {index.name} exists.")
+            index.create(bind=db.engine, checkfirst=True)
+    if ViewRollup.__tablename__ not in existing_tables:
+        current_app.logger.info("Building rollups of existing views.")
+        rebuild_rollups(db.session)
+        record_view_change(db.session, None, None)
+        db.session.commit()
+    elif VisitorSketch.__tablename__ not in existing_tables:
+        current_app.logger.info("Building visitor sketches of existing views.")
+        rebuild_visitor_sketches(db.session)
+        record_view_change(db.session, None, None)
+        db.session.commit()
+    current_app.logger.info("Upgraded the database.")
+
+
 @click.command("process-data")
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of worker processes used to read and parse unprocessed views.",
+)
+@click.option(
+    "--chunk_size",
+    type=int,
+    default=500,
+    help="Number of views read, processed and committed at a time.",
+)
 @with_appcontext
-def process_data():
+def process_data(workers: int, chunk_size: int):
     current_app.logger.info("Running data processing.")
     view_processor = ViewProcessor()
+    rollups = RollupAccumulator()
+    if workers > 1:
+        num_processed = _process_data_in_parallel(view_processor, rollups, workers)
+    else:
+        num_processed = _process_data_in_chunks(view_processor, rollups, chunk_size)
+    view_processor.close()
+    view_processor.log_stats()
+    click.echo(f"Processed {num_processed} records.")
+
+
+def _process_data_in_chunks(
+    view_processor: ViewProcessor, rollups: RollupAccumulator, chunk_size: int
+) -> int:
+    """
+    Processes all unprocessed views, reading them in chunks of `chunk_size`
+    ordered by id. Each chunk is read with a fresh keyset query and
+    committed on its own, so memory use doesn't grow with the backlog.
+    Returns the number of processed views.
+    """
+    num_processed = 0
+    chunk = read_unprocessed_raw_views(0, chunk_size)
+    view_processor.prefetch(chunk)
+    while chunk:
+        # Start looking up the next chunk's IP addresses while this one is
+        # processed and written.
+        next_chunk = read_unprocessed_raw_views(chunk[-1].id, chunk_size)
+        view_processor.prefetch(next_chunk)
+        start_time = time.perf_counter()
+        processed = [view_processor.process_view(raw_view) for raw_view in chunk]
+        _write_chunk(view_processor, rollups, chunk, processed)
+        num_processed += len(processed)
+        elapsed = time.perf_counter() - start_time
+        current_app.logger.info(
+            f"Committed a chunk of {len(processed)} views in {elapsed:.2f}s "
+            f"({len(processed) / max(elapsed, 1e-6):.0f} views/sec); "
+            f"{num_processed} processed so far."
+        )
+        chunk = next_chunk
+    return num_processed
+
+
+def _process_data_in_parallel(
+    view_processor: ViewProcessor, rollups: RollupAccumulator, workers: int
+) -> int:
+    """
+    Processes all unprocessed views, sharded by id range across `workers`
+    processes. This process looks up IP addresses and does all the writing.
+    Returns the number of processed views.
+
+    At most `SHARDS_IN_FLIGHT_PER_WORKER` shards per worker are read or
+    waiting to be written at a time, so memory use doesn't grow with the
+    backlog when writing is slower than the workers.
+    """
+    id_ranges = iter_unprocessed_id_ranges(db.session, SHARD_SIZE)
+    database_uri = current_app.config["SQLALCHEMY_DATABASE_URI"]
+    sqlite_pragmas = current_app.config["SQLITE_PRAGMAS"]
     num_processed = 0
-    for raw_view in RawView.query.filter_by(process_timestamp=None):
-        current_app.logger.debug(f"Processing id={raw_view.id}.")
-        processed = view_processor.process_view(raw_view)
-        raw_view.process_timestamp = processed.process_timestamp
-        db.session.add(processed)
-        num_processed += 1
-        if (num_processed % 500) == 0:
+    # Spawn rather than fork, as this process already runs lookup threads.
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        futures: Set[Future] = set()
+        while True:
+            for first_id, last_id in itertools.islice(
+                id_ranges, workers * SHARDS_IN_FLIGHT_PER_WORKER - len(futures)
+            ):
+                # Look up the shard's IP addresses while a worker reads it.
+                view_processor.prefetch_ip_addresses(
+                    read_shard_ip_addresses(db.session, first_id, last_id)
+                )
+                futures.add(
+                    pool.submit(
+                        process_shard, database_uri, sqlite_pragmas, first_id, last_id
+                    )
+                )
+            if not futures:
+                break
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard = future.result()
+                processed = [
+                    view_processor.process_view(
+                        raw_view, shard.user_agents[raw_view.user_agent]
+                    )
+                    for raw_view in shard.raw_views
+                ]
+                view_processor.add_parsed_user_agents(
+                    shard.new_user_agents, shard.user_agent_stats
+                )
+                _write_chunk(view_processor, rollups, shard.raw_views, processed)
+                num_processed += len(processed)
+                current_app.logger.info(
+                    f"Committed a shard of {len(processed)} views; "
+                    f"{num_processed} processed so far."
+                )
+    return num_processed
+
+
+def _write_chunk(
+    view_processor: ViewProcessor,
+    rollups: RollupAccumulator,
+    raw_views: List[RawView],
+    processed: List[ProcessedView],
+):
+    """
+    Writes the views processed from `raw_views`, along with the updated
+    rollups and caches, in a single transaction.
+    """
+    write_processed_views(db.session, processed)
+    mark_raw_views_processed(
+        db.session, [raw_view.id for raw_view in raw_views], datetime.now()
+    )
+    for view in processed:
+        rollups.add(view)
+    rollups.flush(db.session)
+    if processed:
+        # Let servers know which cached query results are out of date.
+        timestamps = [view.timestamp for view in processed]
+        record_view_change(db.session, min(timestamps), max(timestamps))
+    view_processor.flush()
+    db.session.commit()
+
+
+@click.command("rebuild-rollups")
+@with_appcontext
+def rebuild_rollups_command():
+    """
+    Recomputes the hourly rollups and visitor sketches from all processed
+    views.
+
+    `process-data` keeps both up to date, and `upgrade-db` fills them when
+    it creates their tables, so this is only needed to repair them.
+    """
+    current_app.logger.info("Rebuilding rollups.")
+    rebuild_rollups(db.session)
+    record_view_change(db.session, None, None)
+    db.session.commit()
+    current_app.logger.info("Rebuilt rollups.")
+
+
+@click.command("restore-log")
+@click.option(
+    "--start",
+    type=click.DateTime(),
+    default=None,
+    help="Only restore views at or after this time.",
+)
+@click.option(
+    "--end",
+    type=click.DateTime(),
+    default=None,
+    help="Only restore views before this time.",
+)
+@click.option(
+    "--chunk_size",
+    type=int,
+    default=50000,
+    help="Number of log rows inserted and committed at a time.",
+)
+@with_appcontext
+def restore_log(
+    start: Optional[datetime],
+    end: Optional[datetime],
+    chunk_size: int,
+):
+    """
+    Loads views from the backup log, including its rotated segments, into
+    raw_view. Views that are already stored in raw_view or processed_view
+    are skipped, so this can be re-run safely, including after garbage
+    collection. Restored views are left unprocessed, so that
+    `process-data` counts them.
+    """
+    log_path = current_app.config["LOG_PATH"]
+    current_app.logger.info(f"Restoring raw views from {log_path}.")
+    # Make sure that everything reported so far is in the log.
+    current_app.extensions["backup_log"].flush()
+    start_time = time.perf_counter()
+    num_read, num_restored, num_invalid = 0, 0, 0
+    chunk = []
+    for row in read_log(log_path):
+        num_read += 1
+        try:
+            timestamp_str, url, ip_address, user_agent = row
+            # Stored timestamps are naive, whatever the reported offset.
+            timestamp = datetime.fromisoformat(timestamp_str).replace(tzinfo=None)
+        except ValueError:
+            num_invalid += 1
+            continue
+        if (start and timestamp < start) or (end and timestamp >= end):
+            continue
+        chunk.append(
+            {
+                "timestamp": timestamp,
+                "url": url,
+                "ip_address": ip_address,
+                "user_agent": user_agent,
+            }
+        )
+        if len(chunk) == chunk_size:
+            num_restored += insert_new_raw_views(db.session, chunk)
+            db.session.commit()
+            chunk = []
+            elapsed = time.perf_counter() - start_time
             current_app.logger.info(
-                f"Committing after processing {num_processed} views."
+                f"Read {num_read} rows and restored {num_restored} views "
+                f"({num_read / max(elapsed, 1e-6):.0f} rows/sec)."
             )
-            db.session.commit()
+    num_restored += insert_new_raw_views(db.session, chunk)
     db.session.commit()
-    click.echo(f"Processed {num_processed} records.")
+    if num_invalid:
+        current_app.logger.warning(f"Skipped {num_invalid} malformed rows.")
+    click.echo(f"Restored {num_restored} of {num_read} records.")
 
 
 @click.command("garbage-collect")
@@ -80,3 +356,8 @@ def garbage_collect(max_age_days: int):
         .delete()
     )
     current_app.logger.info(f"Deleted {num_deleted} rows.")
+    # Cached query results expire long before this, so servers can't miss
+    # these changes.
+    num_deleted = delete_view_changes(db.session, cutoff_date)
+    db.session.commit()
+    current_app.logger.info(f"Deleted {num_deleted} view changes.")
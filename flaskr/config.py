@@ -12,15 +12,78 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from dataclasses import dataclass
-from os import environ
+from os import environ, path
+from typing import Dict, Optional
 
 from dotenv import load_dotenv
 
+from flaskr.processing.ip_lookup import IP_API_URL
+
+SQLITE_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SQLITE_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
 
 @dataclass
 class SiteConfig:
     secret_key: str
     instance_path: str
+    # Base URL of the ip-api used to look up information about IP addresses.
+    ip_api_url: str = IP_API_URL
+    # Number of days for which looked-up IP information is reused.
+    ip_cache_ttl_days: int = 30
+    # Number of days before a failed IP lookup is retried.
+    ip_cache_negative_ttl_days: int = 1
+    # Path to a local IP range database (CSV or .mmdb). If set, IP addresses
+    # are looked up there instead of in the ip-api.
+    ip_database_path: Optional[str] = None
+    # Whether to ask the ip-api about IP addresses that aren't in the local
+    # IP range database.
+    ip_api_fallback: bool = True
+    # SQLite journal mode. WAL lets readers run concurrently with a writer.
+    sqlite_journal_mode: str = "WAL"
+    # SQLite synchronous setting. NORMAL is safe from corruption under WAL,
+    # but the last transactions may be lost on power failure.
+    sqlite_synchronous: str = "NORMAL"
+    # Milliseconds a connection waits for a lock before raising an error.
+    sqlite_busy_timeout_ms: int = 5000
+    # Bytes of the database file that are memory-mapped.
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    # KiB of page cache per connection.
+    sqlite_cache_size_kib: int = 64 * 1024
+    # The maximum number of views allowed to be reported per request. Large
+    # batches should be sent as NDJSON, which is streamed rather than read
+    # into memory at once. The limit on the decompressed size of gzipped
+    # JSON bodies grows with this.
+    max_views_per_request: int = 200
+    # Whether reported traffic is acknowledged right away and written to
+    # storage in the background, rather than within the request.
+    ingestion_buffer_enabled: bool = False
+    # The most views held in the ingestion buffer before requests are
+    # rejected with a 503.
+    ingestion_buffer_max_views: int = 10000
+    # Number of buffered views that triggers a write.
+    ingestion_flush_views: int = 1000
+    # Seconds after which buffered views are written regardless of count.
+    ingestion_flush_interval_sec: float = 1.0
+    # The most query results kept in memory by each server process.
+    # 0 disables the query cache.
+    query_cache_max_entries: int = 256
+    # The most bytes of query results kept in memory by each server process.
+    query_cache_max_bytes: int = 32 * 1024 * 1024
+    # Seconds after which a cached query result is recomputed, even if no
+    # change to the data was recorded.
+    query_cache_max_age_sec: int = 3600
+    # Size in bytes at which the backup log is rotated. 0 disables this.
+    backup_log_max_bytes: int = 64 * 1024 * 1024
+    # The backup log is rotated when it was last written in an earlier
+    # period of this many seconds. 0 disables this.
+    backup_log_rotate_interval_sec: int = 86400
+    # Whether rotated segments of the backup log are gzipped.
+    backup_log_compress: bool = True
+    # Seconds between writes of buffered rows to the backup log.
+    backup_log_flush_interval_sec: float = 1.0
+    # The number of rotated segments kept. 0 keeps all of them.
+    backup_log_max_segments: int = 0
 
     @staticmethod
     def load_from_env() -> "SiteConfig":
@@ -30,8 +93,43 @@ class SiteConfig:
         return SiteConfig(
             environ.get("SITE_ANALYTICS_SECRET_KEY"),
             environ.get("SITE_ANALYTICS_INSTANCE_PATH"),
+            environ.get("SITE_ANALYTICS_IP_API_URL", IP_API_URL),
+            int(environ.get("SITE_ANALYTICS_IP_CACHE_TTL_DAYS", 30)),
+            int(environ.get("SITE_ANALYTICS_IP_CACHE_NEGATIVE_TTL_DAYS", 1)),
+            environ.get("SITE_ANALYTICS_IP_DATABASE_PATH"),
+            environ.get("SITE_ANALYTICS_IP_API_FALLBACK", "true").lower() == "true",
+            environ.get("SITE_ANALYTICS_SQLITE_JOURNAL_MODE", "WAL"),
+            environ.get("SITE_ANALYTICS_SQLITE_SYNCHRONOUS", "NORMAL"),
+            int(environ.get("SITE_ANALYTICS_SQLITE_BUSY_TIMEOUT_MS", 5000)),
+            int(environ.get("SITE_ANALYTICS_SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+            int(environ.get("SITE_ANALYTICS_SQLITE_CACHE_SIZE_KIB", 64 * 1024)),
+            int(environ.get("SITE_ANALYTICS_MAX_VIEWS_PER_REQUEST", 200)),
+            environ.get("SITE_ANALYTICS_INGESTION_BUFFER_ENABLED", "false").lower()
+            == "true",
+            int(environ.get("SITE_ANALYTICS_INGESTION_BUFFER_MAX_VIEWS", 10000)),
+            int(environ.get("SITE_ANALYTICS_INGESTION_FLUSH_VIEWS", 1000)),
+            float(environ.get("SITE_ANALYTICS_INGESTION_FLUSH_INTERVAL_SEC", 1.0)),
+            int(environ.get("SITE_ANALYTICS_QUERY_CACHE_MAX_ENTRIES", 256)),
+            int(environ.get("SITE_ANALYTICS_QUERY_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+            int(environ.get("SITE_ANALYTICS_QUERY_CACHE_MAX_AGE_SEC", 3600)),
+            int(environ.get("SITE_ANALYTICS_BACKUP_LOG_MAX_BYTES", 64 * 1024 * 1024)),
+            int(environ.get("SITE_ANALYTICS_BACKUP_LOG_ROTATE_INTERVAL_SEC", 86400)),
+            environ.get("SITE_ANALYTICS_BACKUP_LOG_COMPRESS", "true").lower() == "true",
+            float(environ.get("SITE_ANALYTICS_BACKUP_LOG_FLUSH_INTERVAL_SEC", 1.0)),
+            int(environ.get("SITE_ANALYTICS_BACKUP_LOG_MAX_SEGMENTS", 0)),
         )
 
+    def make_sqlite_pragmas(self) -> Dict[str, str]:
+        """Returns the pragmas to set on each SQLite connection."""
+        return {
+            "journal_mode": self.sqlite_journal_mode.upper(),
+            "synchronous": self.sqlite_synchronous.upper(),
+            "busy_timeout": str(self.sqlite_busy_timeout_ms),
+            "mmap_size": str(self.sqlite_mmap_size),
+            # Negative values are interpreted as KiB rather than pages.
+            "cache_size": str(-self.sqlite_cache_size_kib),
+        }
+
 
 def validate_config(cfg: SiteConfig):
     """Validates that the provided configuration is proper."""
@@ -39,3 +137,32 @@ def validate_config(cfg: SiteConfig):
         raise ValueError(f"No secret key has been configured.")
     if not cfg.instance_path:
         raise ValueError(f"No instance path has been configured.")
+    if cfg.ip_database_path and not path.isfile(cfg.ip_database_path):
+        raise ValueError(f"IP database {cfg.ip_database_path} does not exist.")
+    if cfg.sqlite_journal_mode.upper() not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f"Unknown SQLite journal mode {cfg.sqlite_journal_mode}.")
+    if cfg.sqlite_synchronous.upper() not in SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError(f"Unknown SQLite synchronous mode {cfg.sqlite_synchronous}.")
+    for name in (
+        "sqlite_busy_timeout_ms",
+        "sqlite_mmap_size",
+        "sqlite_cache_size_kib",
+        "query_cache_max_entries",
+        "query_cache_max_bytes",
+        "query_cache_max_age_sec",
+        "backup_log_max_bytes",
+        "backup_log_rotate_interval_sec",
+        "backup_log_max_segments",
+    ):
+        if getattr(cfg, name) < 0:
+            raise ValueError(f"{name} must not be negative.")
+    if cfg.max_views_per_request < 1:
+        raise ValueError(f"max_views_per_request must be positive.")
+    if cfg.ingestion_buffer_enabled and (
+        cfg.ingestion_buffer_max_views < 1
+        or cfg.ingestion_flush_views < 1
+        or cfg.ingestion_flush_interval_sec <= 0
+    ):
+        raise ValueError(f"The ingestion buffer settings must be positive.")
+    if cfg.backup_log_flush_interval_sec <= 0:
+        raise ValueError(f"backup_log_flush_interval_sec must be positive.")
@@ -12,13 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import List, Optional
 
-from marshmallow import INCLUDE, Schema, ValidationError, fields, post_load
+from marshmallow import INCLUDE, Schema, ValidationError, fields, post_load, validate
 from marshmallow_enum import EnumField
 
-from flaskr.processing.query_runner import FilterBy, GroupBy, Query
+from flaskr.processing.query_result import ResultFormat
+from flaskr.processing.query_runner import FilterBy, GroupBy, Metric, Query
+
+# The maximum number of queries allowed in a batch.
+MAX_QUERIES_PER_BATCH = 20
 
 
 @dataclass
@@ -30,6 +34,9 @@ class QueryContract:
     time_bucket: int
     group_by: Optional[GroupBy]
     filter_by: Optional[FilterBy]
+    format: ResultFormat = ResultFormat.Json
+    top_n: Optional[int] = None
+    metric: Metric = Metric.Views
 
     @staticmethod
     def get_schema() -> Schema:
@@ -46,6 +53,8 @@ class QueryContract:
             self.time_bucket,
             self.group_by,
             self.filter_by,
+            self.top_n,
+            self.metric,
         )
 
 
@@ -54,6 +63,18 @@ def validate_time_bucket(n):
         raise ValidationError("time_bucket must be greater than 0.")
 
 
+def to_naive_utc(timestamp: datetime) -> datetime:
+    """Converts `timestamp` to naive UTC, as views are stored."""
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def validate_metric(data: dict):
+    if data.get("top_n") is not None and data.get("metric") == Metric.UniqueVisitors:
+        raise ValidationError("top_n is not supported for unique visitors.")
+
+
 class QuerySchema(Schema):
     """Marshmallow schema used to parse a `QueryContract`."""
 
@@ -67,6 +88,13 @@ class QuerySchema(Schema):
     filter_by = EnumField(
         FilterBy, allow_none=True, load_default=None, dump_default=None
     )
+    format = EnumField(
+        ResultFormat, load_default=ResultFormat.Json, dump_default=ResultFormat.Json
+    )
+    top_n = fields.Integer(
+        allow_none=True, load_default=None, validate=validate.Range(min=1)
+    )
+    metric = EnumField(Metric, load_default=Metric.Views, dump_default=Metric.Views)
 
     class Meta:
         unknown = INCLUDE
@@ -75,4 +103,92 @@ class QuerySchema(Schema):
     def make_contract(self, data, **kwargs) -> QueryContract:
         data["time_bucket"] = int(data["time_bucket"])
         validate_time_bucket(data["time_bucket"])
+        data["start_time"] = to_naive_utc(data["start_time"])
+        data["end_time"] = to_naive_utc(data["end_time"])
+        validate_metric(data)
         return QueryContract(**data)
+
+
+@dataclass
+class BatchQueryItem:
+    """The parts of a query that may differ within a batch."""
+
+    time_bucket: int
+    group_by: Optional[GroupBy]
+    top_n: Optional[int] = None
+    metric: Metric = Metric.Views
+
+
+@dataclass
+class BatchQueryContract:
+    """Contract used to get several queries over the same views from a request."""
+
+    start_time: datetime
+    end_time: datetime
+    filter_by: Optional[FilterBy]
+    queries: List[BatchQueryItem]
+    format: ResultFormat = ResultFormat.Json
+
+    @staticmethod
+    def get_schema() -> Schema:
+        return BatchQuerySchema()
+
+    @staticmethod
+    def load(data: dict) -> "BatchQueryContract":
+        return BatchQueryContract.get_schema().load(data)
+
+    def to_queries(self) -> List[Query]:
+        return [
+            Query(
+                self.start_time,
+                self.end_time,
+                item.time_bucket,
+                item.group_by,
+                self.filter_by,
+                item.top_n,
+                item.metric,
+            )
+            for item in self.queries
+        ]
+
+
+class BatchQueryItemSchema(Schema):
+    """Marshmallow schema used to parse a `BatchQueryItem`."""
+
+    time_bucket = fields.Integer(
+        required=True, allow_none=False, strict=True, validate=validate.Range(min=1)
+    )
+    group_by = EnumField(GroupBy, allow_none=True, load_default=None, dump_default=None)
+    top_n = fields.Integer(
+        allow_none=True, load_default=None, strict=True, validate=validate.Range(min=1)
+    )
+    metric = EnumField(Metric, load_default=Metric.Views, dump_default=Metric.Views)
+
+    @post_load
+    def make_item(self, data, **kwargs) -> BatchQueryItem:
+        validate_metric(data)
+        return BatchQueryItem(**data)
+
+
+class BatchQuerySchema(Schema):
+    """Marshmallow schema used to parse a `BatchQueryContract`."""
+
+    start_time = fields.DateTime(required=True, allow_none=False)
+    end_time = fields.DateTime(required=True, allow_none=False)
+    filter_by = EnumField(
+        FilterBy, allow_none=True, load_default=None, dump_default=None
+    )
+    queries = fields.List(
+        fields.Nested(BatchQueryItemSchema),
+        required=True,
+        validate=validate.Length(min=1, max=MAX_QUERIES_PER_BATCH),
+    )
+    format = EnumField(
+        ResultFormat, load_default=ResultFormat.Json, dump_default=ResultFormat.Json
+    )
+
+    @post_load
+    def make_contract(self, data, **kwargs) -> BatchQueryContract:
+        data["start_time"] = to_naive_utc(data["start_time"])
+        data["end_time"] = to_naive_utc(data["end_time"])
+        return BatchQueryContract(**data)
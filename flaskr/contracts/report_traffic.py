@@ -11,11 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import re
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
-from marshmallow import Schema, fields, post_load
+from marshmallow import Schema, ValidationError, fields, post_load
 
 
 @dataclass
@@ -42,6 +43,35 @@ class ReportTrafficContract:
     def load(data: dict) -> "ReportTrafficContract":
         return ReportTrafficContract.get_schema().load(data)
 
+    @staticmethod
+    def fast_load(data: dict) -> "ReportTrafficContract":
+        """
+        Equivalent to `load()`, but much faster for valid data. Views are
+        checked and converted in a single pass without going through
+        marshmallow. If anything about `data` is unusual, it is loaded with
+        `load()` instead, so errors are reported exactly as by `load()`.
+        """
+        views = _fast_load_views(data)
+        if views is None:
+            return ReportTrafficContract.load(data)
+        return ReportTrafficContract(views)
+
+    @staticmethod
+    def load_view(data: dict) -> SinglePageView:
+        """
+        Loads a single view in the format of `SinglePageViewSchema`, taking
+        the same fast path as `fast_load()`.
+        """
+        view = _fast_load_view(data)
+        if view is None:
+            view = SinglePageView(**SinglePageViewSchema().load(data))
+        return view
+
+    @staticmethod
+    def load_columnar(data: dict) -> "ReportTrafficContract":
+        """Loads a contract from the columnar format of `ColumnarTrafficSchema`."""
+        return ColumnarTrafficSchema().load(data)
+
 
 class SinglePageViewSchema(Schema):
     """The schema for SinglePageView."""
@@ -59,4 +89,120 @@ class ReportTrafficSchema(Schema):
 
     @post_load
     def make_contract(self, data, **kwargs) -> ReportTrafficContract:
-        return ReportTrafficContract([SinglePageView(**d) for d in data["traffic"]])
+        return ReportTrafficContract(
+            [SinglePageView(**d) for d in data.get("traffic", [])]
+        )
+
+
+# The fields of a view in `ReportTrafficSchema`.
+_VIEW_FIELDS = {"url", "ip_address", "user_agent", "timestamp"}
+# ISO 8601 timestamps that `datetime.fromisoformat()` and marshmallow's
+# `fields.DateTime(format="iso")` both parse, and parse to the same value.
+_ISO_TIMESTAMP_PATTERN = re.compile(
+    r"[0-9]{4}-[0-9]{2}-[0-9]{2}[T ][0-9]{2}:[0-9]{2}:[0-9]{2}"
+    r"(?:\.[0-9]{3}|\.[0-9]{6})?(?:[+-][0-9]{2}:[0-9]{2})?"
+)
+
+
+def _fast_load_views(data) -> Optional[List[SinglePageView]]:
+    """
+    Returns the views in `data`, which has the format of
+    `ReportTrafficSchema`. Returns None if `data` is not in the common,
+    valid form that this handles.
+    """
+    if type(data) is not dict or data.keys() != {"traffic"}:
+        return None
+    traffic = data["traffic"]
+    if type(traffic) is not list:
+        return None
+    views = []
+    for view in traffic:
+        view = _fast_load_view(view)
+        if view is None:
+            return None
+        views.append(view)
+    return views
+
+
+def _fast_load_view(data) -> Optional[SinglePageView]:
+    """
+    Returns the view in `data`, which has the format of
+    `SinglePageViewSchema`, or None if it is not in the common, valid form
+    that this handles.
+    """
+    if type(data) is not dict or data.keys() != _VIEW_FIELDS:
+        return None
+    url = data["url"]
+    ip_address = data["ip_address"]
+    user_agent = data["user_agent"]
+    timestamp = data["timestamp"]
+    if (
+        type(url) is not str
+        or type(ip_address) is not str
+        or type(user_agent) is not str
+        or type(timestamp) is not str
+        or not _ISO_TIMESTAMP_PATTERN.fullmatch(timestamp)
+    ):
+        return None
+    try:
+        return SinglePageView(
+            url, ip_address, user_agent, datetime.fromisoformat(timestamp)
+        )
+    except ValueError:
+        return None
+
+
+class ColumnarTrafficSchema(Schema):
+    """
+    A compact alternative to `ReportTrafficSchema`. Each field of the page
+    views is sent as a column. URLs and user agents, which repeat across
+    views, are dictionary-encoded: each distinct value is sent once in
+    `urls`/`user_agents`, and the `url`/`user_agent` columns hold indices
+    into them. For example:
+
+        {
+            "urls": ["/", "/about"],
+            "user_agents": ["Mozilla/5.0 ..."],
+            "url": [0, 1, 0],
+            "user_agent": [0, 0, 0],
+            "ip_address": ["1.2.3.4", "1.2.3.4", "5.6.7.8"],
+            "timestamp": ["2023-01-01T00:00:00", ...]
+        }
+    """
+
+    urls = fields.List(fields.Str(), required=True)
+    user_agents = fields.List(fields.Str(), required=True)
+    url = fields.List(fields.Int(strict=True), required=True)
+    user_agent = fields.List(fields.Int(strict=True), required=True)
+    ip_address = fields.List(fields.Str(), required=True)
+    timestamp = fields.List(fields.DateTime(format="iso"), required=True)
+
+    @post_load
+    def make_contract(self, data, **kwargs) -> ReportTrafficContract:
+        num_views = len(data["timestamp"])
+        for column in ("url", "user_agent", "ip_address"):
+            if len(data[column]) != num_views:
+                raise ValidationError(
+                    f"Has {len(data[column])} values but timestamp has {num_views}.",
+                    column,
+                )
+        for column, values in (
+            ("url", data["urls"]),
+            ("user_agent", data["user_agents"]),
+        ):
+            if any(not 0 <= i < len(values) for i in data[column]):
+                raise ValidationError(f"Contains an out-of-range index.", column)
+        urls, user_agents = data["urls"], data["user_agents"]
+        return ReportTrafficContract(
+            [
+                SinglePageView(
+                    urls[url], ip_address, user_agents[user_agent], timestamp
+                )
+                for url, ip_address, user_agent, timestamp in zip(
+                    data["url"],
+                    data["ip_address"],
+                    data["user_agent"],
+                    data["timestamp"],
+                )
+            ]
+        )
@@ -0,0 +1,42 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from flaskr import db
+
+
+class IpInfo(db.Model):
+    """
+    Caches information looked up for a single IP address, so that it can be
+    reused across runs of `process-data`.
+    """
+
+    __tablename__ = "ip_info"
+    # The IP address that was looked up.
+    ip_address = db.Column(db.String, primary_key=True)
+    # Time at which the IP address was looked up.
+    lookup_timestamp = db.Column(db.DateTime, nullable=False)
+    # Whether the lookup succeeded. Failed lookups are cached as well, so
+    # that they aren't retried on every run.
+    is_found = db.Column(db.Boolean, nullable=False)
+
+    # Information derived from the IP address. See `IpAddressInfo`.
+    country = db.Column(db.String, nullable=True)
+    region = db.Column(db.String, nullable=True)
+    city = db.Column(db.String, nullable=True)
+    zip = db.Column(db.String, nullable=True)
+    lat = db.Column(db.String, nullable=True)
+    lon = db.Column(db.String, nullable=True)
+    isp = db.Column(db.String, nullable=True)
+    org = db.Column(db.String, nullable=True)
+    hostname = db.Column(db.String, nullable=True)
+    domain = db.Column(db.String, nullable=True)
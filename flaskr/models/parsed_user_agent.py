@@ -0,0 +1,38 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from flaskr import db
+
+
+class ParsedUserAgent(db.Model):
+    """
+    Caches the result of parsing a single user agent string, so that it can
+    be reused across runs of `process-data`.
+    """
+
+    __tablename__ = "parsed_user_agent"
+    # The user agent string that was parsed.
+    user_agent = db.Column(db.String, primary_key=True)
+    # Version of the parsing libraries that produced this result. Results
+    # from other versions are ignored, as the parsing rules may have changed.
+    parser_version = db.Column(db.String, nullable=False)
+
+    # Information derived from the user agent. See `UserAgentInfo`.
+    is_bot = db.Column(db.Boolean, nullable=False)
+    operating_system_family = db.Column(db.String, nullable=True)
+    operating_system_version = db.Column(db.String, nullable=True)
+    browser_family = db.Column(db.String, nullable=True)
+    browser_version = db.Column(db.String, nullable=True)
+    device_family = db.Column(db.String, nullable=True)
+    device_brand = db.Column(db.String, nullable=True)
+    device_type = db.Column(db.String, nullable=True)
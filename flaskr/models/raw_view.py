@@ -11,6 +11,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import sqlalchemy as sqla
+
 from flaskr import db
 
 
@@ -18,6 +20,19 @@ class RawView(db.Model):
     """Stores raw information for a single site view."""
 
     __tablename__ = "raw_view"
+    __table_args__ = (
+        # Used by `restore-log` to find views that are already stored.
+        db.Index("ix_raw_view_timestamp", "timestamp"),
+        # Used by `garbage-collect` to find views that were processed long ago.
+        db.Index("ix_raw_view_process_timestamp", "process_timestamp"),
+        # Used by `process-data` to find views that haven't been processed yet.
+        # Only contains unprocessed views, so it stays small.
+        db.Index(
+            "ix_raw_view_unprocessed",
+            "id",
+            sqlite_where=sqla.text("process_timestamp IS NULL"),
+        ),
+    )
     # Unique ID assigned to this record.
     id = db.Column(db.Integer, primary_key=True)
     # URL that received this view.
@@ -0,0 +1,36 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from flaskr import db
+
+
+class ViewChange(db.Model):
+    """
+    Records that processed views (and their rollups) were added or changed
+    within a range of time. Written by `process-data` in the same
+    transaction as the views, so that web processes can tell which cached
+    query results are out of date.
+    """
+
+    __tablename__ = "view_change"
+    # Increases with every change, so readers can ask for changes since
+    # the last one they saw.
+    id = db.Column(db.Integer, primary_key=True)
+    # Earliest timestamp of the changed views, or null if the change
+    # covers all time.
+    min_timestamp = db.Column(db.DateTime, nullable=True)
+    # Latest timestamp of the changed views, or null if the change covers
+    # all time.
+    max_timestamp = db.Column(db.DateTime, nullable=True)
+    # Time at which the change was made.
+    change_timestamp = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,39 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from flaskr import db
+
+# The width, in seconds, of the time buckets that views are rolled up into.
+ROLLUP_GRAIN_SECONDS = 3600
+
+
+class ViewRollup(db.Model):
+    """
+    Stores the number of processed views in a single hour, broken down by
+    one of the `GroupBy` dimensions and by whether the viewer was a bot.
+
+    Maintained by the `process-data` command so that queries with hourly
+    (or coarser) buckets don't need to scan the `processed_view` table.
+    """
+
+    __tablename__ = "view_rollup"
+    # Start of the hour that this rollup covers.
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    # Value of the `GroupBy` dimension that this rollup is keyed by.
+    group_by = db.Column(db.String, primary_key=True)
+    # Value of the group column, or "UNKNOWN" if it could not be determined.
+    group_key = db.Column(db.String, primary_key=True)
+    # Whether the views were classified as being from a bot.
+    is_bot = db.Column(db.Boolean, primary_key=True)
+    # Number of views in this rollup.
+    count = db.Column(db.Integer, nullable=False)
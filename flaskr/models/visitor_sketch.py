@@ -0,0 +1,37 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from flaskr import db
+
+
+class VisitorSketch(db.Model):
+    """
+    Stores a HyperLogLog sketch of the visitors (IP addresses) seen in a
+    single hour, with the same breakdown as `ViewRollup`.
+
+    Maintained by the `process-data` command. Sketches can be merged, so
+    unique visitors over any range of whole hours are estimated without
+    scanning the `processed_view` table.
+    """
+
+    __tablename__ = "visitor_sketch"
+    # Start of the hour that this sketch covers.
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    # Value of the `GroupBy` dimension that this sketch is keyed by.
+    group_by = db.Column(db.String, primary_key=True)
+    # Value of the group column, or "UNKNOWN" if it could not be determined.
+    group_key = db.Column(db.String, primary_key=True)
+    # Whether the views were classified as being from a bot.
+    is_bot = db.Column(db.Boolean, primary_key=True)
+    # The serialized `HyperLogLog` sketch.
+    sketch = db.Column(db.LargeBinary, nullable=False)
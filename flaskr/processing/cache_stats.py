@@ -0,0 +1,47 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from dataclasses import dataclass
+
+
+@dataclass
+class CacheStats:
+    """Counts lookups served by a two-level (memory, then database) cache."""
+
+    # Lookups served from the in-memory cache.
+    memory_hits: int = 0
+    # Lookups served from the database.
+    database_hits: int = 0
+    # Lookups that had to be computed or fetched from scratch.
+    misses: int = 0
+
+    def add(self, other: "CacheStats"):
+        """Adds the counts of `other` to this one."""
+        self.memory_hits += other.memory_hits
+        self.database_hits += other.database_hits
+        self.misses += other.misses
+
+    @property
+    def total(self) -> int:
+        return self.memory_hits + self.database_hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        """Returns the fraction of lookups served by either cache level."""
+        return (self.memory_hits + self.database_hits) / self.total if self.total else 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.memory_hits} memory hits, {self.database_hits} database hits, "
+            f"{self.misses} misses ({self.hit_rate:.1%} hit rate)"
+        )
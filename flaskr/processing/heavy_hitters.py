@@ -0,0 +1,60 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import heapq
+from typing import Dict, Hashable, List
+
+
+def select_top_keys(totals: Dict[Hashable, int], n: int) -> List[Hashable]:
+    """
+    Returns the `n` keys with the highest totals, highest first. Ties are
+    broken by key, so that the selection doesn't depend on the order of
+    `totals`.
+    """
+    return heapq.nsmallest(n, totals, key=lambda key: (-totals[key], key))
+
+
+class SpaceSaving:
+    """
+    The Space-Saving heavy hitters sketch (Metwally et al., 2005).
+
+    Counts a stream of keys while tracking at most `capacity` of them.
+    When a new key arrives and the sketch is full, it replaces the key with
+    the lowest count and inherits that count, so counts are overestimated
+    by at most `total / capacity`. Every key that occurs more often than
+    that is guaranteed to be tracked.
+
+    Replacing a key scans all tracked keys, so `capacity` should be small,
+    e.g. a small multiple of the number of keys of interest.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("capacity must be positive.")
+        self._capacity = capacity
+        self._counts: Dict[Hashable, int] = {}
+
+    def add(self, key: Hashable, count: int = 1):
+        """Counts `count` occurrences of `key`."""
+        counts = self._counts
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self._capacity:
+            counts[key] = count
+        else:
+            victim = min(counts, key=counts.__getitem__)
+            counts[key] = counts.pop(victim) + count
+
+    def candidates(self) -> List[Hashable]:
+        """Returns the tracked keys, by estimated count, highest first."""
+        return select_top_keys(self._counts, len(self._counts))
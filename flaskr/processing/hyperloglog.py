@@ -0,0 +1,154 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import math
+import struct
+from typing import Dict, Optional
+
+# Each sketch has 2**PRECISION registers, for a standard error of about
+# 1.04 / sqrt(2**PRECISION), i.e. 1.6%.
+PRECISION = 12
+NUM_REGISTERS = 1 << PRECISION
+# The number of set registers up to which a sketch is kept sparse, as a map
+# from register index to value. Most sketches of a single hour and group
+# key only ever see a few visitors.
+SPARSE_LIMIT = NUM_REGISTERS // 16
+
+_HASH_BITS = 64
+_ALPHA = 0.7213 / (1 + 1.079 / NUM_REGISTERS)
+# The high bit of each register, as an integer over all registers.
+_HIGH_BITS = int.from_bytes(b"\x80" * NUM_REGISTERS, "little")
+# Markers for the serialized representations.
+_SPARSE = 0
+_DENSE = 1
+
+
+def hash_value(value: str) -> int:
+    """Returns the 64-bit hash of `value` used to add it to a sketch."""
+    return int.from_bytes(
+        hashlib.blake2b(value.encode(), digest_size=8).digest(), "little"
+    )
+
+
+class HyperLogLog:
+    """
+    A HyperLogLog sketch (Flajolet et al., 2007) estimating the number of
+    distinct values added to it, using at most `NUM_REGISTERS` bytes.
+    Sketches can be merged, giving the sketch of the union of their values.
+
+    Small sketches are sparse, which keeps them cheap to store, merge and
+    count.
+    """
+
+    def __init__(self):
+        self._sparse: Optional[Dict[int, int]] = {}
+        self._registers: Optional[bytearray] = None
+
+    def add(self, value: str):
+        """Adds `value` to the sketch."""
+        self.add_hash(hash_value(value))
+
+    def add_hash(self, value_hash: int):
+        """Adds a value, given by its `hash_value()`, to the sketch."""
+        index = value_hash >> (_HASH_BITS - PRECISION)
+        rest = value_hash & ((1 << (_HASH_BITS - PRECISION)) - 1)
+        # The position of the first 1 bit in the remaining bits.
+        self._update(index, _HASH_BITS - PRECISION - rest.bit_length() + 1)
+
+    def merge(self, other: "HyperLogLog"):
+        """Adds all values of `other` to this sketch."""
+        if other._sparse is not None:
+            for index, value in other._sparse.items():
+                self._update(index, value)
+            return
+        if self._registers is None:
+            self._densify()
+        # Take the bytewise maximum of the registers on them as one integer.
+        # Register values are below 128, so adding 128 to each byte of `a`
+        # and subtracting the byte of `b` never borrows across bytes. The
+        # high bit of each byte is then set where `a` >= `b`.
+        a = int.from_bytes(self._registers, "little")
+        b = int.from_bytes(other._registers, "little")
+        a_greater_equal = (((a | _HIGH_BITS) - b) & _HIGH_BITS) >> 7
+        mask = a_greater_equal * 0xFF
+        self._registers = bytearray(
+            ((a & mask) | (b & ~mask)).to_bytes(NUM_REGISTERS, "little")
+        )
+
+    def count(self) -> float:
+        """Returns the estimated number of distinct values in the sketch."""
+        if self._sparse is not None:
+            num_zeros = NUM_REGISTERS - len(self._sparse)
+            inverse_sum = num_zeros + sum(
+                2.0**-value for value in self._sparse.values()
+            )
+        else:
+            num_zeros = self._registers.count(0)
+            inverse_sum = num_zeros
+            num_left = NUM_REGISTERS - num_zeros
+            value = 0
+            # Counting each value is much faster than iterating registers.
+            while num_left:
+                value += 1
+                num_registers = self._registers.count(value)
+                inverse_sum += num_registers * 2.0**-value
+                num_left -= num_registers
+        estimate = _ALPHA * NUM_REGISTERS * NUM_REGISTERS / inverse_sum
+        if estimate <= 2.5 * NUM_REGISTERS and num_zeros:
+            # Linear counting is more accurate for small cardinalities.
+            return NUM_REGISTERS * math.log(NUM_REGISTERS / num_zeros)
+        return estimate
+
+    def to_bytes(self) -> bytes:
+        """Serializes the sketch; see `from_bytes()`."""
+        if self._sparse is not None:
+            indexes = sorted(self._sparse)
+            return (
+                bytes([_SPARSE])
+                + struct.pack(f"<{len(indexes)}H", *indexes)
+                + bytes(self._sparse[index] for index in indexes)
+            )
+        return bytes([_DENSE]) + bytes(self._registers)
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "HyperLogLog":
+        """Deserializes a sketch serialized with `to_bytes()`."""
+        sketch = HyperLogLog()
+        if data[0] == _SPARSE:
+            num_set = (len(data) - 1) // 3
+            indexes = struct.unpack_from(f"<{num_set}H", data, 1)
+            sketch._sparse = dict(zip(indexes, data[1 + 2 * num_set :]))
+        elif data[0] == _DENSE and len(data) == NUM_REGISTERS + 1:
+            sketch._sparse = None
+            sketch._registers = bytearray(data[1:])
+        else:
+            raise ValueError("Invalid HyperLogLog sketch.")
+        return sketch
+
+    def _update(self, index: int, value: int):
+        """Raises the register at `index` to `value`."""
+        if self._sparse is None:
+            if value > self._registers[index]:
+                self._registers[index] = value
+        elif value > self._sparse.get(index, 0):
+            self._sparse[index] = value
+            if len(self._sparse) > SPARSE_LIMIT:
+                self._densify()
+
+    def _densify(self):
+        """Switches to the dense representation."""
+        self._registers = bytearray(NUM_REGISTERS)
+        for index, value in self._sparse.items():
+            self._registers[index] = value
+        self._sparse = None
@@ -0,0 +1,158 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import dataclasses as dc
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set
+
+import pylru
+
+from flaskr.processing.cache_stats import CacheStats
+from flaskr.processing.ip_lookup import IpAddressInfo
+from flaskr.processing.ip_providers import IpInfoProvider, PartialLookupError
+from flaskr.storage.ip_info_storage import IpInfoStorage
+
+
+@dc.dataclass
+class _LookupResult:
+    """The result of looking up several IP addresses at once."""
+
+    # Information for each IP address, or None if the lookup failed.
+    results: Dict[str, Optional[IpAddressInfo]]
+    # Whether the results were freshly looked up and should be stored.
+    is_new: bool
+    # Addresses whose lookup failed, e.g. because of a network error. Their
+    # results aren't stored, so that they're retried on the next run.
+    failed: Set[str] = dc.field(default_factory=set)
+
+
+class IpEnricher:
+    """
+    Resolves IP addresses to `IpAddressInfo` in the background.
+
+    Callers first `prefetch()` every IP address they are about to need.
+    The addresses are deduplicated and checked against an in-memory LRU
+    cache, then against the persistent `storage`, if any. The rest are
+    resolved in batches by the `provider` on a thread pool, so lookups
+    overlap with whatever the caller does next. `get()` then returns the
+    result for a single address, waiting for its lookup to finish if
+    necessary. New results are written to `storage` on `flush()`.
+
+    `prefetch()`, `get()` and `flush()` must be called from the same thread.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        provider: IpInfoProvider,
+        storage: Optional[IpInfoStorage] = None,
+        max_workers: int = 4,
+    ):
+        self._logger = logger
+        self._provider = provider
+        self._storage = storage
+        self._cache = pylru.lrucache(512)
+        # Futures for lookups that have been started but not yet consumed.
+        self._pending: Dict[str, Future] = {}
+        # Results that have been looked up but not yet written to storage.
+        self._unsaved: Dict[str, Optional[IpAddressInfo]] = {}
+        self.stats = CacheStats()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ip-enricher"
+        )
+
+    def prefetch(self, ip_addresses: Iterable[str]):
+        """Starts looking up any of `ip_addresses` that aren't known yet."""
+        # Deduplicate while keeping the order in which addresses are needed.
+        to_lookup: List[str] = []
+        for ip_address in dict.fromkeys(ip_addresses):
+            if ip_address in self._pending:
+                continue
+            if ip_address in self._cache:
+                self.stats.memory_hits += 1
+            else:
+                to_lookup.append(ip_address)
+
+        if self._storage and to_lookup:
+            stored = self._storage.load(to_lookup)
+            if stored:
+                self.stats.database_hits += len(stored)
+                # Park the stored results as a completed lookup rather than
+                # in the LRU cache, which may be smaller than the batch.
+                future = Future()
+                future.set_result(_LookupResult(stored, is_new=False))
+                for ip_address in stored:
+                    self._pending[ip_address] = future
+                to_lookup = [ip for ip in to_lookup if ip not in stored]
+
+        self.stats.misses += len(to_lookup)
+        batch_size = self._provider.batch_size
+        for i in range(0, len(to_lookup), batch_size):
+            batch = to_lookup[i : i + batch_size]
+            future = self._executor.submit(self._lookup_batch, batch)
+            for ip_address in batch:
+                self._pending[ip_address] = future
+
+    def get(self, ip_address: str) -> Optional[IpAddressInfo]:
+        """
+        Returns information for `ip_address`, or None if it could not be
+        looked up. Blocks until the lookup has finished.
+        """
+        if ip_address in self._cache:
+            return self._cache[ip_address]
+        if ip_address not in self._pending:
+            self.prefetch([ip_address])
+        lookup: _LookupResult = self._pending.pop(ip_address).result()
+        ip_info = lookup.results[ip_address]
+        self._cache[ip_address] = ip_info
+        if lookup.is_new and ip_address not in lookup.failed:
+            self._unsaved[ip_address] = ip_info
+        return ip_info
+
+    def flush(self):
+        """Writes new lookup results to storage. Does not commit."""
+        if self._storage:
+            self._storage.save(self._unsaved)
+        self._unsaved.clear()
+
+    def close(self):
+        """Waits for outstanding lookups and releases the thread pool."""
+        self._executor.shutdown(wait=True)
+        self._provider.close()
+
+    def _lookup_batch(self, ip_addresses: List[str]) -> _LookupResult:
+        """Looks up `ip_addresses` using the provider."""
+        try:
+            results = self._provider.lookup(ip_addresses)
+        except PartialLookupError as e:
+            self._logger.error(f"Error while looking up IP addresses: {e}.")
+            failed = {ip for ip in ip_addresses if ip not in e.results}
+            return _LookupResult(
+                {**e.results, **{ip_address: None for ip_address in failed}},
+                is_new=self._provider.should_cache,
+                failed=failed,
+            )
+        except ValueError as e:
+            self._logger.error(
+                f"Error while looking up {len(ip_addresses)} IP addresses: {e}."
+            )
+            # Don't store the failure, so that it's retried on the next run.
+            return _LookupResult(
+                {ip_address: None for ip_address in ip_addresses}, is_new=False
+            )
+        for ip_address, ip_info in results.items():
+            if ip_info is None:
+                self._logger.error(f"Could not look up IP address {ip_address}.")
+        return _LookupResult(results, is_new=self._provider.should_cache)
@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import dataclasses as dc
-from typing import Optional
+from typing import Dict, List, Optional
 
 import requests
 
@@ -45,20 +45,18 @@ def get_domain(hostname: str) -> Optional[str]:
     )
 
 
-def lookup_ip_address(ip_address: str) -> IpAddressInfo:
-    """
-    Queries the ip-api API and returns information received for the given IP address.
+# The default base URL of the ip-api.
+IP_API_URL = "http://ip-api.com"
+# The fields requested from the ip-api, encoded as a bitmask.
+# See https://ip-api.com/docs/api:json.
+IP_API_FIELDS = 63225
+# The maximum number of IP addresses that can be sent in a single request to
+# the ip-api batch endpoint.
+MAX_BATCH_SIZE = 100
 
-    It is the responsibility of the caller to ensure that rate limits are adhered to.
-    Throws ValueError if the request fails.
-    """
-    # See https://ip-api.com/docs/api:json.
-    response = requests.get(f"http://ip-api.com/json/{ip_address}?fields=63225")
-    response_json = response.json()
-    if response.status_code != 200 or response_json["status"] != "success":
-        raise ValueError(
-            f'Request failed with status {response.status_code}: {response_json["message"]}'
-        )
+
+def _parse_ip_info(response_json: dict) -> IpAddressInfo:
+    """Creates an `IpAddressInfo` from a successful ip-api response."""
     return IpAddressInfo(
         country=response_json.get("country", None),
         region=response_json.get("regionName", None),
@@ -71,3 +69,49 @@ def lookup_ip_address(ip_address: str) -> IpAddressInfo:
         hostname=response_json.get("reverse", None),
         domain=get_domain(response_json.get("reverse", "")),
     )
+
+
+def lookup_ip_address(ip_address: str, base_url: str = IP_API_URL) -> IpAddressInfo:
+    """
+    Queries the ip-api API and returns information received for the given IP address.
+
+    It is the responsibility of the caller to ensure that rate limits are adhered to.
+    Throws ValueError if the request fails.
+    """
+    response = requests.get(f"{base_url}/json/{ip_address}?fields={IP_API_FIELDS}")
+    response_json = response.json()
+    if response.status_code != 200 or response_json["status"] != "success":
+        raise ValueError(
+            f'Request failed with status {response.status_code}: {response_json["message"]}'
+        )
+    return _parse_ip_info(response_json)
+
+
+def lookup_ip_addresses(
+    ip_addresses: List[str],
+    session: requests.Session,
+    base_url: str = IP_API_URL,
+) -> Dict[str, Optional[IpAddressInfo]]:
+    """
+    Queries the ip-api batch endpoint for up to `MAX_BATCH_SIZE` IP addresses
+    at once. Returns the information received for each IP address, or None
+    for the IP addresses that could not be looked up.
+
+    It is the responsibility of the caller to ensure that rate limits are adhered to.
+    Throws ValueError if the request as a whole fails.
+    """
+    if len(ip_addresses) > MAX_BATCH_SIZE:
+        raise ValueError(
+            f"Too many IP addresses: got {len(ip_addresses)} but max is {MAX_BATCH_SIZE}."
+        )
+    # See https://ip-api.com/docs/api:batch.
+    response = session.post(
+        f"{base_url}/batch?fields={IP_API_FIELDS}", json=ip_addresses
+    )
+    if response.status_code != 200:
+        raise ValueError(f"Request failed with status {response.status_code}")
+    results: Dict[str, Optional[IpAddressInfo]] = {ip: None for ip in ip_addresses}
+    for response_json in response.json():
+        if response_json.get("status") == "success":
+            results[response_json["query"]] = _parse_ip_info(response_json)
+    return results
@@ -0,0 +1,302 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Pluggable sources of `IpAddressInfo`.
+
+`IpApiProvider` queries the rate-limited ip-api over the network.
+`RangeDatabaseProvider` and `MmdbProvider` read a local database instead,
+so they need no network and are limited only by CPU. `FallbackProvider`
+chains two providers, e.g. to ask the ip-api about addresses that aren't
+in the local database.
+"""
+import abc
+import bisect
+import csv
+import socket
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import ratelimiter
+import requests
+from requests.adapters import HTTPAdapter
+
+from flaskr.processing.ip_lookup import (
+    IP_API_URL,
+    MAX_BATCH_SIZE,
+    IpAddressInfo,
+    lookup_ip_addresses,
+)
+
+# Columns of a CSV range database, after the start and end addresses.
+RANGE_DATABASE_FIELDS = [
+    "country",
+    "region",
+    "city",
+    "zip",
+    "lat",
+    "lon",
+    "isp",
+    "org",
+]
+
+
+class PartialLookupError(ValueError):
+    """Raised when a lookup fails for some, but not all, IP addresses."""
+
+    def __init__(self, message: str, results: Dict[str, Optional[IpAddressInfo]]):
+        super().__init__(message)
+        # The results for the IP addresses that were looked up.
+        self.results = results
+
+
+class IpInfoProvider(abc.ABC):
+    """Looks up information about IP addresses."""
+
+    # The maximum number of IP addresses that can be passed to `lookup()`.
+    batch_size: int = MAX_BATCH_SIZE
+    # Whether results are expensive enough to obtain that they should be
+    # persisted in the `ip_info` table.
+    should_cache: bool = True
+
+    @abc.abstractmethod
+    def lookup(self, ip_addresses: List[str]) -> Dict[str, Optional[IpAddressInfo]]:
+        """
+        Returns information for each of `ip_addresses`, or None for the ones
+        that could not be found. Must be thread-safe.
+
+        Throws ValueError if the lookup fails as a whole, or
+        `PartialLookupError` if it fails for some of the addresses.
+        """
+
+    def close(self):
+        """Releases any resources held by the provider."""
+
+
+class IpApiProvider(IpInfoProvider):
+    """Looks up IP addresses using the ip-api batch endpoint."""
+
+    batch_size = MAX_BATCH_SIZE
+    should_cache = True
+
+    def __init__(self, base_url: str = IP_API_URL, max_connections: int = 4):
+        self._base_url = base_url
+        # ip-api's batch endpoint is limited to 15 requests per minute.
+        # The rate limiter is thread-safe and shared by all callers.
+        self._lookup_throttler = ratelimiter.RateLimiter(15, 60)
+        # Share one pooled session so that callers reuse TCP connections.
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_maxsize=max_connections))
+        self._session.mount("https://", HTTPAdapter(pool_maxsize=max_connections))
+
+    def lookup(self, ip_addresses: List[str]) -> Dict[str, Optional[IpAddressInfo]]:
+        with self._lookup_throttler:
+            try:
+                return lookup_ip_addresses(ip_addresses, self._session, self._base_url)
+            except requests.RequestException as e:
+                raise ValueError(str(e)) from e
+
+    def close(self):
+        self._session.close()
+
+
+def ip_to_int(ip_address: str) -> Tuple[int, int]:
+    """
+    Converts `ip_address` to a (version, integer) pair.
+    Throws ValueError if it is not a valid IPv4 or IPv6 address.
+    """
+    # `socket.inet_pton` is roughly ten times faster than `ipaddress`.
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), "big")
+    except OSError:
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), "big")
+    except OSError:
+        raise ValueError(f"Invalid IP address: {ip_address}")
+
+
+class _RangeTable:
+    """Sorted, non-overlapping IP ranges of a single IP version."""
+
+    def __init__(self, ranges: List[Tuple[int, int, IpAddressInfo]], typecode: str):
+        ranges.sort(key=lambda r: r[0])
+        # Store the bounds in flat arrays rather than lists of Python ints,
+        # which keeps millions of ranges compact. IPv6 addresses don't fit in
+        # a machine integer, so `typecode` is None for them.
+        make = (lambda v: array(typecode, v)) if typecode else list
+        self.starts = make(r[0] for r in ranges)
+        self.ends = make(r[1] for r in ranges)
+        self.infos = [r[2] for r in ranges]
+
+    def find(self, ip: int) -> Optional[IpAddressInfo]:
+        """Returns the info of the range containing `ip`, if any."""
+        i = bisect.bisect_right(self.starts, ip) - 1
+        return self.infos[i] if i >= 0 and ip <= self.ends[i] else None
+
+
+class RangeDatabaseProvider(IpInfoProvider):
+    """
+    Looks up IP addresses in a local CSV range database.
+
+    Each row has the form `START_IP,END_IP,COUNTRY,REGION,CITY,ZIP,LAT,LON,ISP,ORG`.
+    Addresses may be IPv4 or IPv6, written in the usual notation or as
+    integers. Empty fields are treated as unknown. Ranges must not overlap.
+    Lookups are a binary search over the sorted range starts.
+    """
+
+    batch_size = 10000
+    should_cache = False
+
+    def __init__(self, path: str):
+        ranges: Dict[int, List[Tuple[int, int, IpAddressInfo]]] = {4: [], 6: []}
+        with open(path, newline="") as csv_file:
+            for row in csv.reader(csv_file):
+                if not row or row[0].startswith("#"):
+                    continue
+                start_version, start = self._parse_bound(row[0])
+                end_version, end = self._parse_bound(row[1])
+                if start_version != end_version or start > end:
+                    raise ValueError(f"Invalid range: {row[0]} - {row[1]}")
+                values = [value or None for value in row[2:]]
+                info = IpAddressInfo(**dict(zip(RANGE_DATABASE_FIELDS, values)))
+                ranges[start_version].append((start, end, info))
+        self._tables = {4: _RangeTable(ranges[4], "L"), 6: _RangeTable(ranges[6], None)}
+
+    @staticmethod
+    def _parse_bound(value: str) -> Tuple[int, int]:
+        value = value.strip()
+        if value.isdigit():
+            number = int(value)
+            return (4 if number < 2**32 else 6), number
+        return ip_to_int(value)
+
+    def lookup(self, ip_addresses: List[str]) -> Dict[str, Optional[IpAddressInfo]]:
+        results: Dict[str, Optional[IpAddressInfo]] = {}
+        for ip_address in ip_addresses:
+            try:
+                version, ip = ip_to_int(ip_address)
+            except ValueError:
+                results[ip_address] = None
+                continue
+            results[ip_address] = self._tables[version].find(ip)
+        return results
+
+
+class MmdbProvider(IpInfoProvider):
+    """
+    Looks up IP addresses in a MaxMind DB file (e.g. GeoLite2-City), which
+    is memory-mapped rather than loaded.
+
+    Requires the optional `maxminddb` package.
+    """
+
+    batch_size = 10000
+    should_cache = False
+
+    def __init__(self, path: str):
+        try:
+            import maxminddb
+        except ImportError:
+            raise ImportError(
+                "Reading .mmdb files requires the `maxminddb` package: "
+                "pip install maxminddb"
+            )
+        self._reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+    def lookup(self, ip_addresses: List[str]) -> Dict[str, Optional[IpAddressInfo]]:
+        results: Dict[str, Optional[IpAddressInfo]] = {}
+        for ip_address in ip_addresses:
+            try:
+                record = self._reader.get(ip_address)
+            except ValueError:
+                record = None
+            results[ip_address] = self._parse_record(record) if record else None
+        return results
+
+    @staticmethod
+    def _parse_record(record: dict) -> IpAddressInfo:
+        def name(key: str) -> Optional[str]:
+            return record.get(key, {}).get("names", {}).get("en")
+
+        subdivisions = record.get("subdivisions") or [{}]
+        location = record.get("location", {})
+        return IpAddressInfo(
+            country=name("country"),
+            region=subdivisions[0].get("names", {}).get("en"),
+            city=name("city"),
+            zip=record.get("postal", {}).get("code"),
+            lat=location.get("latitude"),
+            lon=location.get("longitude"),
+            isp=record.get("isp"),
+            org=record.get("organization")
+            or record.get("autonomous_system_organization"),
+        )
+
+    def close(self):
+        self._reader.close()
+
+
+class FallbackProvider(IpInfoProvider):
+    """
+    Asks `fallback` about the IP addresses that `primary` can't find. If
+    the fallback fails, what `primary` found is still returned, through a
+    `PartialLookupError`.
+    """
+
+    def __init__(self, primary: IpInfoProvider, fallback: IpInfoProvider):
+        self._primary = primary
+        self._fallback = fallback
+        self.batch_size = primary.batch_size
+        self.should_cache = fallback.should_cache
+
+    def lookup(self, ip_addresses: List[str]) -> Dict[str, Optional[IpAddressInfo]]:
+        results = self._primary.lookup(ip_addresses)
+        missing = [ip for ip, info in results.items() if info is None]
+        errors = []
+        for i in range(0, len(missing), self._fallback.batch_size):
+            batch = missing[i : i + self._fallback.batch_size]
+            try:
+                results.update(self._fallback.lookup(batch))
+            except ValueError as e:
+                for ip_address in batch:
+                    del results[ip_address]
+                errors.append(str(e))
+        if errors:
+            raise PartialLookupError(
+                f"Could not look up {len(ip_addresses) - len(results)} IP addresses "
+                f"that aren't in the local database: {'; '.join(errors)}",
+                results,
+            )
+        return results
+
+    def close(self):
+        self._primary.close()
+        self._fallback.close()
+
+
+def make_ip_info_provider(
+    ip_api_url: str, database_path: Optional[str], use_fallback: bool
+) -> IpInfoProvider:
+    """
+    Creates the provider configured by the `SiteConfig`: the local database
+    at `database_path` if one is set, falling back to the ip-api if
+    `use_fallback` is set. Otherwise just the ip-api.
+    """
+    if not database_path:
+        return IpApiProvider(ip_api_url)
+    if database_path.endswith(".mmdb"):
+        local: IpInfoProvider = MmdbProvider(database_path)
+    else:
+        local = RangeDatabaseProvider(database_path)
+    return FallbackProvider(local, IpApiProvider(ip_api_url)) if use_fallback else local
@@ -0,0 +1,248 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import dataclasses as dc
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+import sqlalchemy.orm
+
+from flaskr.processing.cache_stats import CacheStats
+from flaskr.processing.query_result import PartialResult, QueryResult
+from flaskr.processing.query_runner import FilterBy, GroupBy, Query
+from flaskr.storage.view_change_storage import read_view_changes
+
+# Passed as `after_id` to only read the latest view change.
+_LATEST_CHANGE_ONLY = 2**62
+
+
+@dc.dataclass(frozen=True)
+class CachedResponse:
+    """A serialized query result."""
+
+    body: bytes
+    # Identifies the content of `body`, for use as an HTTP ETag.
+    etag: str
+
+
+@dc.dataclass
+class _CacheEntry:
+    response: CachedResponse
+    # The result that `response` was made from, if it can be reused.
+    result: Optional[QueryResult]
+    start_time: datetime
+    end_time: datetime
+    # Buckets that end at or before this time are up to date. The response
+    # is only served while this is `end_time`.
+    valid_until: datetime
+    # `time.monotonic()` when the oldest data in the entry was computed.
+    created: float
+    # The size of `response` and `result`, counted towards `max_bytes`.
+    num_bytes: int
+
+
+def make_etag(body: bytes) -> str:
+    """Returns an ETag for a response with the given `body`."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def normalize_query(query: Query) -> Query:
+    """Returns `query` with equivalent ways of leaving options unset unified."""
+    return dc.replace(
+        query,
+        group_by=None if query.group_by == GroupBy.Unset else query.group_by,
+        filter_by=None if query.filter_by == FilterBy.Unset else query.filter_by,
+    )
+
+
+class QueryCache:
+    """
+    An LRU cache of serialized query results, bounded by the number of
+    entries and by their total size in bytes. The size includes the counts
+    of results kept for `get_partial()`, which are usually much larger
+    than the compressed response.
+
+    Entries are keyed by the normalized `Query` and a `variant` (e.g. the
+    response format). The cache learns about new data from the
+    `view_change` table, which `process-data` writes to: callers `sync()`
+    before each lookup, which drops the entries whose time range overlaps
+    a change. As a safeguard, entries also expire after `max_age_sec`.
+
+    Changes usually only touch the newest buckets of a result. The buckets
+    before the change are kept, and `get_partial()` offers them to queries
+    over a later or shifted time range on the same bucket grid.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 32 * 1024 * 1024,
+        max_age_sec: float = 3600,
+    ):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._max_age_sec = max_age_sec
+        self._entries: "OrderedDict[Tuple[Query, str], _CacheEntry]" = OrderedDict()
+        self._num_bytes = 0
+        # The id of the latest view change that has been applied.
+        self._change_id = 0
+        self._lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def sync(self, session: "sqlalchemy.orm.scoping.scoped_session") -> int:
+        """
+        Drops the entries that are out of date because of view changes
+        since the last sync. Returns the id of the latest change, which must
+        be passed to `put()` for results computed after this call.
+        """
+        with self._lock:
+            after_id = self._change_id if self._entries else _LATEST_CHANGE_ONLY
+        changes = read_view_changes(session, after_id)
+        with self._lock:
+            latest_id = changes[-1].id if changes else 0
+            if latest_id < self._change_id:
+                # The table has been recreated, so nothing can be trusted.
+                self._clear()
+            for change in changes:
+                if change.id > self._change_id:
+                    self._invalidate(change.min_timestamp, change.max_timestamp)
+            self._change_id = latest_id
+            return latest_id
+
+    def get(self, query: Query, variant: str = "") -> Optional[CachedResponse]:
+        """Returns the cached response for `query`, if any."""
+        key = (normalize_query(query), variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._is_expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is None or entry.valid_until < entry.end_time:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.memory_hits += 1
+            return entry.response
+
+    def get_partial(self, query: Query) -> Optional[PartialResult]:
+        """
+        Returns the cached result that has the most buckets of `query` up to
+        date, if any. Only results over naive time ranges, starting at or
+        before `query` and with buckets that line up with its buckets, are
+        considered.
+        """
+        if query.start_time.tzinfo is not None:
+            return None
+        query = normalize_query(query)
+        step = timedelta(seconds=query.time_bucket)
+        best = None
+        with self._lock:
+            for (cached_query, _), entry in self._entries.items():
+                if (
+                    entry.result is None
+                    or dc.replace(cached_query, start_time=None, end_time=None)
+                    != dc.replace(query, start_time=None, end_time=None)
+                    or cached_query.start_time.tzinfo is not None
+                    or entry.start_time > query.start_time
+                    or (query.start_time - entry.start_time) % step
+                    or entry.valid_until < query.start_time + step
+                    or self._is_expired(entry)
+                ):
+                    continue
+                if best is None or entry.valid_until > best.valid_until:
+                    best = entry
+            if best is None:
+                return None
+            return PartialResult(best.result, best.valid_until, best.created)
+
+    def put(
+        self,
+        query: Query,
+        body: bytes,
+        change_id: int,
+        variant: str = "",
+        result: Optional[QueryResult] = None,
+        created: Optional[float] = None,
+    ) -> CachedResponse:
+        """
+        Caches `body` as the response for `query`, unless data has changed
+        since the `sync()` that returned `change_id`. Returns the response.
+
+        If given, `result` is kept for `get_partial()`. `created` is when
+        the oldest data in it was computed, in case it reused an earlier
+        result; it defaults to now.
+        """
+        response = CachedResponse(body, make_etag(body))
+        key = (normalize_query(query), variant)
+        num_bytes = len(body) + (result.nbytes if result is not None else 0)
+        with self._lock:
+            if change_id != self._change_id or num_bytes > self._max_bytes:
+                return response
+            if key in self._entries:
+                self._remove(key)
+            # Stored timestamps are naive, and compared as such in SQL.
+            end_time = query.end_time.replace(tzinfo=None)
+            self._entries[key] = _CacheEntry(
+                response,
+                result,
+                query.start_time.replace(tzinfo=None),
+                end_time,
+                end_time,
+                time.monotonic() if created is None else created,
+                num_bytes,
+            )
+            self._num_bytes += num_bytes
+            while (
+                len(self._entries) > self._max_entries
+                or self._num_bytes > self._max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+        return response
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _invalidate(
+        self, min_timestamp: Optional[datetime], max_timestamp: Optional[datetime]
+    ):
+        """
+        Marks the buckets of entries from `min_timestamp` on as out of date,
+        if the entry's time range overlaps [min, max]. Drops the entries
+        with no buckets left up to date.
+        """
+        if min_timestamp is None or max_timestamp is None:
+            self._clear()
+            return
+        for key, entry in list(self._entries.items()):
+            if min_timestamp >= entry.end_time or max_timestamp < entry.start_time:
+                continue
+            if entry.result is None or min_timestamp <= entry.start_time:
+                self._remove(key)
+            else:
+                entry.valid_until = min(entry.valid_until, min_timestamp)
+
+    def _is_expired(self, entry: _CacheEntry) -> bool:
+        return time.monotonic() - entry.created > self._max_age_sec
+
+    def _remove(self, key: Tuple[Query, str]):
+        self._num_bytes -= self._entries.pop(key).num_bytes
+
+    def _clear(self):
+        self._entries.clear()
+        self._num_bytes = 0
@@ -12,10 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import math
-from collections import defaultdict
-from dataclasses import dataclass, field
+from array import array
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Dict, Set
+from enum import Enum
+from itertools import compress
+from operator import add
+from typing import Dict, Iterable, Tuple
+
+from flaskr.processing.heavy_hitters import select_top_keys
+
+# The key that the counts of keys outside the top N are combined under.
+OTHER_KEY = "OTHER"
 
 
 def calculate_num_buckets(
@@ -29,58 +37,182 @@ def calculate_num_buckets(
     return int(math.ceil((end_time - start_time).total_seconds() / time_bucket))
 
 
-@dataclass
-class Bucket:
-    """Stores query results from a single "bucket" of time."""
+class ResultFormat(Enum):
+    """The possible JSON formats of a serialized QueryResult."""
 
-    # Timestamp at which the bucket starts.
-    timestamp: datetime
-    # Data stored for this bucket, keyed by the "group_by" of the query.
-    data: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
+    # A list of buckets, each with its timestamp and its counts by key.
+    Json = "JSON"
+    # The keys once, followed by a dense array of counts for each key.
+    # Much smaller than `Json` when there are many buckets or keys.
+    Columnar = "COLUMNAR"
 
-    def json(self) -> dict:
-        """Serialize this bucket to a JSON object."""
-        return {
-            "timestamp": self.timestamp.isoformat(),
-            "data": self.data,
-        }
+
+@dataclass(frozen=True)
+class PartialResult:
+    """A previously computed result, of which only some buckets are up to date."""
+
+    result: "QueryResult"
+    # Buckets that end at or before this time are up to date.
+    valid_until: datetime
+    # `time.monotonic()` when the oldest data in `result` was computed.
+    created: float
 
 
 class QueryResult:
-    """Utility for bucketing the results of a query."""
+    """
+    Utility for bucketing the results of a query.
+
+    The counts of each key are kept in a dense column of 64-bit integers
+    with one entry per bucket, so adding a count is a single array update
+    and the result takes 8 bytes per bucket and key.
+    """
 
     def __init__(self, start_time: datetime, end_time: datetime, time_bucket: int):
         self._start_time = start_time
         self._end_time = end_time
         self._time_bucket = time_bucket
-        self._buckets = []
-        self._groups: Set[str] = set()
+        self._step = timedelta(seconds=time_bucket)
+        self._num_buckets = calculate_num_buckets(start_time, end_time, time_bucket)
+        # The counts of each key by bucket index, in the order that the keys
+        # were first added.
+        self._columns: Dict[str, array] = {}
 
-        # Initialize the buckets.
-        curr_time = self._start_time
-        for _ in range(calculate_num_buckets(start_time, end_time, time_bucket)):
-            self._buckets.append(Bucket(curr_time))
-            curr_time += timedelta(seconds=time_bucket)
+    @property
+    def start_time(self) -> datetime:
+        return self._start_time
 
-    def increment(self, key: str, timestamp: datetime):
-        """Increment the value of `key` at the specified `timestamp`."""
+    @property
+    def end_time(self) -> datetime:
+        return self._end_time
+
+    @property
+    def time_bucket(self) -> int:
+        return self._time_bucket
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes taken up by the counts."""
+        return sum(len(column) * column.itemsize for column in self._columns.values())
+
+    def copy_buckets(self, other: "QueryResult", valid_until: datetime) -> datetime:
+        """
+        Copies the counts of the leading buckets of this result from `other`,
+        as far as `other` has the same buckets and they end at or before
+        `valid_until`. This lets a moving time window reuse the buckets that
+        it shares with an earlier result.
+
+        Returns the time from which this result still has to be filled in.
+        """
+        if other._time_bucket != self._time_bucket:
+            return self._start_time
+        offset, remainder = divmod(self._start_time - other._start_time, self._step)
+        if offset < 0 or remainder:
+            # The buckets of `other` don't line up with these.
+            return self._start_time
+        # A bucket cut short by the end of either range is incomplete.
+        end_time = min(valid_until, other._end_time, self._end_time)
+        num_copied = max(
+            0,
+            min(
+                (end_time - self._start_time) // self._step,
+                self._num_buckets,
+                other._num_buckets - offset,
+            ),
+        )
+        for key, other_column in other._columns.items():
+            counts = other_column[offset : offset + num_copied]
+            if any(counts):
+                self._get_column(key)[:num_copied] = counts
+        return self._start_time + num_copied * self._step
+
+    def get_bucket_index(self, timestamp: datetime) -> int:
+        """Returns the index of the bucket that `timestamp` falls into."""
         if timestamp < self._start_time or timestamp > self._end_time:
             raise ValueError(f"Time out of bounds: {timestamp}.")
-        # Calculate which bucket `timestamp` falls into.
-        bucket_index = int(
-            (timestamp - self._start_time).total_seconds() / self._time_bucket
-        )
-        self._buckets[bucket_index].data[key] += 1
-        self._groups.add(key)
+        return (timestamp - self._start_time) // self._step
+
+    def increment(self, key: str, timestamp: datetime):
+        """Increment the value of `key` at the specified `timestamp`."""
+        self.add(key, self.get_bucket_index(timestamp), 1)
+
+    def add(self, key: str, bucket_index: int, count: int):
+        """Add `count` to the value of `key` in the bucket at `bucket_index`."""
+        if bucket_index < 0 or bucket_index >= self._num_buckets:
+            raise ValueError(f"Bucket index out of bounds: {bucket_index}.")
+        self._get_column(key)[bucket_index] += count
+
+    def add_counts(self, rows: Iterable[Tuple[str, int, int]]):
+        """
+        Adds the count of each `(key, bucket_index, count)` in `rows`.
+        Equivalent to calling `add()` for each row, but faster.
+        """
+        columns = self._columns
+        num_buckets = self._num_buckets
+        for key, bucket_index, count in rows:
+            column = columns.get(key)
+            if column is None:
+                column = self._get_column(key)
+            if bucket_index < 0 or bucket_index >= num_buckets:
+                raise ValueError(f"Bucket index out of bounds: {bucket_index}.")
+            column[bucket_index] += count
+
+    def keep_top_keys(self, n: int):
+        """
+        Combines the counts of all keys except for the `n` with the highest
+        total counts into `OTHER_KEY`.
+        """
+        totals = {
+            key: sum(column)
+            for key, column in self._columns.items()
+            if key != OTHER_KEY
+        }
+        if len(totals) <= n:
+            return
+        top_keys = set(select_top_keys(totals, n))
+        other_column = self._get_column(OTHER_KEY)
+        for key in totals.keys() - top_keys:
+            other_column[:] = array("q", map(add, other_column, self._columns.pop(key)))
 
     def make_json(self) -> Dict:
         """
         Returns the data into the expected JSON result format.
-        This causes a data copy so it is a bit expensive.
+        This causes a data copy so it is a bit expensive; see
+        `make_columnar_json()` for a cheaper format.
+        """
+        data = [{} for _ in range(self._num_buckets)]
+        for key, column in self._columns.items():
+            # Only the buckets in which the key was counted list it.
+            for bucket_data, count in zip(compress(data, column), filter(None, column)):
+                bucket_data[key] = count
+        buckets = [
+            {"timestamp": (self._start_time + i * self._step).isoformat(), "data": d}
+            for i, d in enumerate(data)
+        ]
+        return {"all_keys": list(self._columns), "buckets": buckets}
+
+    def make_columnar_json(self) -> Dict:
+        """
+        Returns the data in the columnar JSON format: `counts[i][j]` is the
+        count of `all_keys[i]` in the bucket starting `j * time_bucket`
+        seconds after `start_time`.
         """
-        # TODO: this copies the data when serializing to JSON.
-        #   Would be good to just "natively" have it in the JSON dict.
         return {
-            "all_keys": list(self._groups),
-            "buckets": [bucket.json() for bucket in self._buckets],
+            "start_time": self._start_time.isoformat(),
+            "time_bucket": self._time_bucket,
+            "num_buckets": self._num_buckets,
+            "all_keys": list(self._columns),
+            "counts": [column.tolist() for column in self._columns.values()],
         }
+
+    def serialize(self, result_format: ResultFormat) -> Dict:
+        """Returns the data in the JSON format given by `result_format`."""
+        if result_format == ResultFormat.Columnar:
+            return self.make_columnar_json()
+        return self.make_json()
+
+    def _get_column(self, key: str) -> array:
+        """Returns the column of `key`, adding it if it doesn't exist yet."""
+        column = self._columns.get(key)
+        if column is None:
+            column = self._columns[key] = array("q", bytes(8 * self._num_buckets))
+        return column
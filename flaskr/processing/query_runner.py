@@ -11,19 +11,37 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from dataclasses import dataclass
-from datetime import datetime
+import math
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
 from enum import Enum
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import sqlalchemy as sqla
 import sqlalchemy.engine
 
-from flaskr.processing.query_result import QueryResult, calculate_num_buckets
+from flaskr.models.view_rollup import ROLLUP_GRAIN_SECONDS
+from flaskr.processing.heavy_hitters import SpaceSaving, select_top_keys
+from flaskr.processing.hyperloglog import HyperLogLog
+from flaskr.processing.query_result import (
+    OTHER_KEY,
+    PartialResult,
+    QueryResult,
+    calculate_num_buckets,
+)
 
 # The maximum number of buckets allowed for query processing.
-# This is configured to avoid overworking the system.
-MAX_NUM_BUCKETS = 1000
+# This is configured to avoid overworking the system. A result takes
+# 8 bytes per bucket for each key.
+MAX_NUM_BUCKETS = 10000
+
+# The number of keys tracked per requested top key when the top keys are
+# found with a `SpaceSaving` sketch.
+TOP_N_SKETCH_FACTOR = 10
+
+# The epoch used to convert datetimes to integer timestamps.
+EPOCH = datetime(1970, 1, 1)
 
 
 class GroupBy(Enum):
@@ -50,49 +68,156 @@ class FilterBy(Enum):
     Bots = "BOTS"
 
 
-@dataclass
+class Metric(Enum):
+    """The possible quantities that a query counts."""
+
+    # The number of views.
+    Views = "VIEWS"
+    # The number of distinct visitors, identified by `VISITOR_COLUMN`.
+    # Estimated with HyperLogLog sketches when answered from the rollups.
+    UniqueVisitors = "UNIQUE_VISITORS"
+
+
+# The column that identifies visitors for `Metric.UniqueVisitors`.
+VISITOR_COLUMN = "ip_address"
+
+
+class QueryEngine(Enum):
+    """The possible strategies for executing a query."""
+
+    # Fetch every matching row and bucket it in Python. Slow, but simple
+    # enough to serve as the reference implementation in tests.
+    Python = "PYTHON"
+    # Compute the bucket index and group key in SQL, so that only one row
+    # per (bucket, key) pair is returned.
+    Sql = "SQL"
+    # Sum the hourly counts in the `view_rollup` table. Only possible when
+    # the buckets line up with the rollup grain (see `can_use_rollups()`).
+    Rollup = "ROLLUP"
+
+
+@dataclass(frozen=True)
 class Query:
-    """Defines a query to run over the ProcessedViews."""
+    """Defines a query to run over the ProcessedViews. Hashable."""
 
     start_time: datetime
     end_time: datetime
     time_bucket: int
     group_by: Optional[GroupBy]
     filter_by: Optional[FilterBy]
+    # If set, only this many keys with the highest total counts are kept,
+    # and the rest are combined into `OTHER_KEY`.
+    top_n: Optional[int] = None
+    metric: Metric = Metric.Views
 
 
-def _make_select(query: Query) -> str:
-    """Builds the subject of the SELECT clause of the query."""
-    first_term: str
-    if query.group_by is None or query.group_by == GroupBy.Unset:
+def get_group_column(group_by: Optional[GroupBy]) -> str:
+    """Returns the SQL expression for the column that `group_by` aggregates on."""
+    if group_by is None or group_by == GroupBy.Unset:
         # If unset, simply select the string "Count".
-        first_term = "'Count'"
-    elif query.group_by == GroupBy.Country:
-        first_term = "country"
-    elif query.group_by == GroupBy.City:
-        first_term = "city"
-    elif query.group_by == GroupBy.Region:
-        first_term = "region"
-    elif query.group_by == GroupBy.Url:
-        first_term = "url"
-    elif query.group_by == GroupBy.Domain:
-        first_term = "domain"
-    elif query.group_by == GroupBy.OperatingSystem:
-        first_term = "operating_system_family"
-    elif query.group_by == GroupBy.Device:
-        first_term = "device_brand"
-    elif query.group_by == GroupBy.DeviceType:
-        first_term = "device_type"
-    elif query.group_by == GroupBy.Browser:
-        first_term = "browser_family"
+        return "'Count'"
+    elif group_by == GroupBy.Country:
+        return "country"
+    elif group_by == GroupBy.City:
+        return "city"
+    elif group_by == GroupBy.Region:
+        return "region"
+    elif group_by == GroupBy.Url:
+        return "url"
+    elif group_by == GroupBy.Domain:
+        return "domain"
+    elif group_by == GroupBy.OperatingSystem:
+        return "operating_system_family"
+    elif group_by == GroupBy.Device:
+        return "device_brand"
+    elif group_by == GroupBy.DeviceType:
+        return "device_type"
+    elif group_by == GroupBy.Browser:
+        return "browser_family"
     else:
         raise ValueError("Not implemented")
-    return f"IFNULL({first_term}, 'UNKNOWN'), timestamp"
 
 
-def _make_where(query: Query) -> str:
-    """Builds the content of the WHERE clause of the query."""
-    sql = "timestamp >= :start_time AND timestamp <= :end_time"
+def _make_group_key(query: Query) -> str:
+    """Builds the SQL expression for the key that a row is counted under."""
+    return f"IFNULL({get_group_column(query.group_by)}, 'UNKNOWN')"
+
+
+def _make_group_keys(queries: List[Query]) -> Tuple[List[str], List[int]]:
+    """
+    Builds the distinct SQL expressions for the keys that rows are counted
+    under by `queries`. Also returns the index of each query's key.
+    """
+    group_keys = list(dict.fromkeys(_make_group_key(query) for query in queries))
+    columns = [group_keys.index(_make_group_key(query)) for query in queries]
+    return group_keys, columns
+
+
+def to_micros(timestamp: datetime) -> int:
+    """Returns the number of microseconds between the epoch and `timestamp`."""
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def _make_timestamp_micros(column: str) -> str:
+    """
+    Builds the SQL expression converting the datetime `column` to integer
+    microseconds since the epoch.
+
+    SQLAlchemy stores datetimes in SQLite as text of the form
+    "YYYY-MM-DD HH:MM:SS.ffffff". `strftime('%s')` gives whole seconds and
+    the microseconds are taken straight from the string, so the arithmetic
+    is exact and buckets agree with the ones computed in Python.
+    """
+    return (
+        f"(CAST(strftime('%s', {column}) AS INTEGER) * 1000000"
+        f" + CAST(substr({column}, 21, 6) AS INTEGER))"
+    )
+
+
+def _make_bucket_index(column: str = "timestamp") -> str:
+    """
+    Builds the SQL expression computing the index of the bucket a row
+    falls into. Expects the `start_micros` and `bucket_micros` parameters.
+    """
+    # The WHERE clause guarantees a non-negative dividend, so integer
+    # division is equivalent to taking the floor.
+    return f"({_make_timestamp_micros(column)} - :start_micros) / :bucket_micros"
+
+
+def get_group_by_value(group_by: Optional[GroupBy]) -> str:
+    """Returns the value that `group_by` is stored as in the `view_rollup` table."""
+    return (group_by or GroupBy.Unset).value
+
+
+def _is_aligned(timestamp: datetime) -> bool:
+    """Returns whether `timestamp` falls on a rollup bucket boundary."""
+    return (
+        timestamp.tzinfo is None
+        and to_micros(timestamp) % (ROLLUP_GRAIN_SECONDS * 1000000) == 0
+    )
+
+
+def can_use_rollups(query: Query) -> bool:
+    """
+    Returns whether `query` can be answered from the `view_rollup` table.
+
+    This requires each query bucket to be made up of whole rollup buckets,
+    i.e. the bucket size must be a multiple of the rollup grain and the
+    time range must start and end on rollup bucket boundaries.
+    """
+    return (
+        query.time_bucket % ROLLUP_GRAIN_SECONDS == 0
+        and _is_aligned(query.start_time)
+        and _is_aligned(query.end_time)
+    )
+
+
+def _make_where(query: Query, column: str = "timestamp") -> str:
+    """
+    Builds the content of the WHERE clause of the query. `column` is the
+    datetime column that the time range applies to.
+    """
+    sql = f"{column} >= :start_time AND {column} < :end_time"
     if query.filter_by == FilterBy.Bots:
         sql += " AND is_bot = TRUE"
     elif query.filter_by == FilterBy.Humans:
@@ -101,7 +226,10 @@ def _make_where(query: Query) -> str:
 
 
 def run_query(
-    session: "sqlalchemy.orm.scoping.scoped_session", query: Query
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    query: Query,
+    engine: Optional[QueryEngine] = None,
+    previous: Optional[PartialResult] = None,
 ) -> QueryResult:
     """
     Dynamically generate and execute queries over the `processed_view`
@@ -137,8 +265,89 @@ def run_query(
       filter=Filter.Humans,
     )
 
+    If no `engine` is given, the query is answered from the hourly
+    rollups when possible (see `can_use_rollups()`), and otherwise by
+    bucketing and grouping in SQL (see `QueryEngine.Sql`).
+    `QueryEngine.Python` does the same work in Python and is kept as a
+    reference for tests.
+
+    If a `previous` result is given, the leading buckets that it has
+    up to date are copied from it and only the rest of the time range is
+    queried (see `QueryResult.copy_buckets()`). For example, a dashboard
+    polling the last 24 hourly buckets only needs the newest bucket
+    computed, as long as its start times fall on the hour.
+
+    With `top_n`, only the keys with the highest counts over the whole
+    time range are kept, and the others are counted as `OTHER_KEY`. The
+    SQL and rollup engines select them exactly from the grouped rows; the
+    Python engine finds candidates with a bounded-memory `SpaceSaving`
+    sketch in a first pass over the views.
+
+    With `Metric.UniqueVisitors`, each bucket holds the number of distinct
+    visitors rather than views. The rollup engine estimates it by merging
+    the hourly HyperLogLog sketches in the `visitor_sketch` table; the
+    other engines count exactly with COUNT(DISTINCT). Distinct counts
+    can't be added up, so `top_n` isn't supported with this metric.
+
     TODO: how to support bucketing by calendar month? -> time_bucket could also be allowed to be a string, e.g. MONTH.
     """
+    _check_num_buckets(query)
+    if engine is None:
+        engine = QueryEngine.Rollup if can_use_rollups(query) else QueryEngine.Sql
+    elif engine == QueryEngine.Rollup and not can_use_rollups(query):
+        raise ValueError("The query cannot be answered from the rollups.")
+
+    results = QueryResult(query.start_time, query.end_time, query.time_bucket)
+    # The top keys of a shifted range may differ, so these can't be reused.
+    if previous is not None and query.top_n is None:
+        start_time = results.copy_buckets(previous.result, previous.valid_until)
+        if start_time >= query.end_time:
+            return results
+        # Starts on a bucket boundary, so it's still eligible for rollups.
+        query = replace(query, start_time=start_time)
+    _execute(session, engine, [query], [results])
+    return results
+
+
+def run_queries(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    queries: List[Query],
+    engine: Optional[QueryEngine] = None,
+) -> List[QueryResult]:
+    """
+    Runs `queries`, which must share their time range and filter, in a
+    single pass over the data. They may differ in bucket size and group by,
+    e.g. the charts of a dashboard. Returns the results in the order of
+    `queries`. See `run_query()` for the meaning of the arguments.
+
+    The rollups are used if they can answer all of the queries.
+    """
+    if not queries:
+        return []
+    query = queries[0]
+    for other in queries:
+        if (other.start_time, other.end_time) != (query.start_time, query.end_time):
+            raise ValueError("Batched queries must share their time range.")
+        if (other.filter_by or FilterBy.Unset) != (query.filter_by or FilterBy.Unset):
+            raise ValueError("Batched queries must share their filter.")
+        _check_num_buckets(other)
+
+    use_rollups = all(can_use_rollups(other) for other in queries)
+    if engine is None:
+        engine = QueryEngine.Rollup if use_rollups else QueryEngine.Sql
+    elif engine == QueryEngine.Rollup and not use_rollups:
+        raise ValueError("The queries cannot be answered from the rollups.")
+
+    results = [
+        QueryResult(other.start_time, other.end_time, other.time_bucket)
+        for other in queries
+    ]
+    _execute(session, engine, queries, results)
+    return results
+
+
+def _check_num_buckets(query: Query):
+    """Raises a ValueError if `query` has more than `MAX_NUM_BUCKETS` buckets."""
     num_buckets = calculate_num_buckets(
         query.start_time, query.end_time, query.time_bucket
     )
@@ -147,26 +356,296 @@ def run_query(
             f"Too many buckets: requested {num_buckets} but max is {MAX_NUM_BUCKETS}."
         )
 
-    # Create and execute the query. We don't need to perform any GROUP BY
-    # or SORT within the query, as we will handle that using our buckets.
+
+def _execute(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    engine: QueryEngine,
+    queries: List[Query],
+    results: List[QueryResult],
+):
+    """
+    Adds the views matched by `queries` to the corresponding `results`,
+    using `engine`. The queries must share their time range and filter.
+    """
+    if engine not in (QueryEngine.Python, QueryEngine.Sql, QueryEngine.Rollup):
+        raise ValueError(f"Unsupported query engine: {engine}")
+    for query, query_results in zip(queries, results):
+        if query.metric == Metric.UniqueVisitors:
+            # Distinct counts can't be added up across buckets or keys, so
+            # these can't share a scan with other queries.
+            _run_unique_visitors_query(session, engine, query, query_results)
+    view_queries = [
+        (query, query_results)
+        for query, query_results in zip(queries, results)
+        if query.metric != Metric.UniqueVisitors
+    ]
+    if not view_queries:
+        return
+    for batch in _split_by_grid(view_queries):
+        queries, results = map(list, zip(*batch))
+        if engine == QueryEngine.Python:
+            _run_python_query(session, queries, results)
+        elif engine == QueryEngine.Sql:
+            _run_sql_query(session, queries, results)
+        else:
+            _run_rollup_query(session, queries, results)
+
+
+def _split_by_grid(
+    queries: List[Tuple[Query, QueryResult]]
+) -> List[List[Tuple[Query, QueryResult]]]:
+    """
+    Splits `queries` into batches that can share a scan. A scan counts the
+    buckets of the greatest common divisor of the bucket sizes, e.g. one
+    second for 3600 and 3601, so queries are only batched while that grid
+    has at most `MAX_NUM_BUCKETS` buckets.
+    """
+    batches = []
+    for query, query_results in queries:
+        for batch in batches:
+            time_bucket = math.gcd(
+                query_results.time_bucket, *(other.time_bucket for _, other in batch)
+            )
+            num_buckets = calculate_num_buckets(
+                query_results.start_time, query_results.end_time, time_bucket
+            )
+            if num_buckets <= MAX_NUM_BUCKETS:
+                batch.append((query, query_results))
+                break
+        else:
+            batches.append([(query, query_results)])
+    return batches
+
+
+def _run_python_query(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    queries: List[Query],
+    results: List[QueryResult],
+):
+    """
+    Executes `queries` by fetching every matching row and bucketing it in
+    Python. This is kept as the reference implementation for tests.
+
+    For queries with `top_n`, a first pass over the rows finds candidates
+    for the top keys with a `SpaceSaving` sketch, so that at most
+    `TOP_N_SKETCH_FACTOR` times as many keys are counted by bucket.
+    """
+    query = queries[0]
+    group_keys, columns = _make_group_keys(queries)
+    # We don't need to perform any GROUP BY or SORT within the query,
+    # as we will handle that using our buckets.
     sql = sqla.text(
-        f"SELECT {_make_select(query)} "
+        f"SELECT {', '.join(group_keys)}, timestamp "
         "FROM processed_view "
         f"WHERE {_make_where(query)}"
     )
+    params = {
+        "start_time": query.start_time,
+        "end_time": query.end_time,
+    }
+    sketches = {
+        i: SpaceSaving(query_.top_n * TOP_N_SKETCH_FACTOR)
+        for i, query_ in enumerate(queries)
+        if query_.top_n is not None
+    }
+    if sketches:
+        for r in session.execute(sql, params):
+            for i, sketch in sketches.items():
+                sketch.add(r[columns[i]])
+    candidates = [
+        set(sketches[i].candidates()) if i in sketches else None
+        for i in range(len(queries))
+    ]
+
+    for r in session.execute(sql, params):
+        timestamp = datetime.fromisoformat(r[-1])
+        for query_results, column, keys in zip(results, columns, candidates):
+            key = r[column]
+            if keys is not None and key not in keys:
+                key = OTHER_KEY
+            query_results.increment(key, timestamp)
+    for query_, query_results in zip(queries, results):
+        if query_.top_n is not None:
+            query_results.keep_top_keys(query_.top_n)
+
+
+def _run_sql_query(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    queries: List[Query],
+    results: List[QueryResult],
+):
+    """
+    Executes `queries` by computing the bucket index and group keys in SQL,
+    so that at most one row per bucket and combination of keys is returned.
+    The buckets are those of the greatest common divisor of the bucket
+    sizes, and are added up into the buckets of each query.
+    Buckets are counted from the start of `results`, which may be earlier
+    than that of `queries`.
+    """
+    query = queries[0]
+    group_keys, columns = _make_group_keys(queries)
+    time_bucket = math.gcd(*(other.time_bucket for other in queries))
+    key_aliases = [f"group_key_{i}" for i in range(len(group_keys))]
+    sql = sqla.text(
+        f"SELECT {_make_bucket_index()} AS bucket, "
+        + "".join(f"{key} AS {alias}, " for key, alias in zip(group_keys, key_aliases))
+        + "COUNT(*) "
+        "FROM processed_view "
+        f"WHERE {_make_where(query)} "
+        f"GROUP BY bucket, {', '.join(key_aliases)}"
+    )
     raw_result = session.execute(
         sql,
         {
             "start_time": query.start_time,
             "end_time": query.end_time,
+            "start_micros": to_micros(results[0].start_time),
+            "bucket_micros": time_bucket * 1000000,
         },
     )
+    rows = raw_result.all()
+    for query_, query_results, column in zip(queries, results, columns):
+        scale = query_results.time_bucket // time_bucket
+        query_results.add_counts(
+            _keep_top_keys(
+                [(r[column + 1], r[0] // scale, r[-1]) for r in rows], query_.top_n
+            )
+        )
 
-    # Process results and put into buckets.
-    results = QueryResult(query.start_time, query.end_time, query.time_bucket)
-    for r in raw_result.all():
-        key = r[0]
-        timestamp = datetime.fromisoformat(r[1])
-        results.increment(key, timestamp)
 
-    return results
+def _run_rollup_query(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    queries: List[Query],
+    results: List[QueryResult],
+):
+    """
+    Executes `queries` by summing the hourly counts in the `view_rollup`
+    table, reading the rollups of every group by at once. The caller must
+    check `can_use_rollups()` first.
+    """
+    query = queries[0]
+    queries_by_group_by = defaultdict(list)
+    for other, query_results in zip(queries, results):
+        queries_by_group_by[get_group_by_value(other.group_by)].append(
+            (other, query_results)
+        )
+    time_bucket = math.gcd(*(other.time_bucket for other in queries))
+    sql = sqla.text(
+        "SELECT group_by, group_key, "
+        f"{_make_bucket_index('bucket_start')} AS bucket, "
+        "SUM(count) "
+        "FROM view_rollup "
+        f"WHERE group_by IN :group_bys AND {_make_where(query, 'bucket_start')} "
+        "GROUP BY group_by, bucket, group_key"
+    ).bindparams(sqla.bindparam("group_bys", expanding=True))
+    raw_result = session.execute(
+        sql,
+        {
+            "group_bys": list(queries_by_group_by),
+            "start_time": query.start_time,
+            "end_time": query.end_time,
+            "start_micros": to_micros(results[0].start_time),
+            "bucket_micros": time_bucket * 1000000,
+        },
+    )
+    rows_by_group_by = defaultdict(list)
+    for group_by, key, bucket_index, count in raw_result.all():
+        rows_by_group_by[group_by].append((key, bucket_index, count))
+    for group_by, rows in rows_by_group_by.items():
+        for other, query_results in queries_by_group_by[group_by]:
+            scale = query_results.time_bucket // time_bucket
+            query_results.add_counts(
+                _keep_top_keys(
+                    [
+                        (key, bucket_index // scale, count)
+                        for key, bucket_index, count in rows
+                    ],
+                    other.top_n,
+                )
+            )
+
+
+def _keep_top_keys(
+    rows: List[Tuple[str, int, int]], top_n: Optional[int]
+) -> List[Tuple[str, int, int]]:
+    """
+    Returns the `(key, bucket_index, count)` rows with the keys outside the
+    `top_n` keys with the highest total counts replaced by `OTHER_KEY`.
+    """
+    if top_n is None:
+        return rows
+    totals = defaultdict(int)
+    for key, _, count in rows:
+        totals[key] += count
+    if len(totals) <= top_n:
+        return rows
+    top_keys = set(select_top_keys(totals, top_n))
+    return [
+        (key if key in top_keys else OTHER_KEY, bucket_index, count)
+        for key, bucket_index, count in rows
+    ]
+
+
+def _run_unique_visitors_query(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    engine: QueryEngine,
+    query: Query,
+    results: QueryResult,
+):
+    """
+    Executes `query`, which counts `Metric.UniqueVisitors`, using `engine`.
+    Buckets are counted from the start of `results`.
+    """
+    if query.top_n is not None:
+        raise ValueError("top_n is not supported for unique visitors.")
+    params = {
+        "start_time": query.start_time,
+        "end_time": query.end_time,
+        "start_micros": to_micros(results.start_time),
+        "bucket_micros": results.time_bucket * 1000000,
+    }
+    if engine == QueryEngine.Python:
+        sql = sqla.text(
+            f"SELECT {_make_group_key(query)}, timestamp, {VISITOR_COLUMN} "
+            "FROM processed_view "
+            f"WHERE {_make_where(query)}"
+        )
+        visitors = defaultdict(set)
+        for key, timestamp, visitor in session.execute(sql, params):
+            bucket_index = results.get_bucket_index(datetime.fromisoformat(timestamp))
+            visitors[(key, bucket_index)].add(visitor)
+        results.add_counts(
+            (key, bucket_index, len(bucket_visitors))
+            for (key, bucket_index), bucket_visitors in visitors.items()
+        )
+    elif engine == QueryEngine.Sql:
+        sql = sqla.text(
+            f"SELECT {_make_group_key(query)} AS group_key, "
+            f"{_make_bucket_index()} AS bucket, "
+            f"COUNT(DISTINCT {VISITOR_COLUMN}) "
+            "FROM processed_view "
+            f"WHERE {_make_where(query)} "
+            "GROUP BY bucket, group_key"
+        )
+        results.add_counts(session.execute(sql, params).all())
+    else:
+        sql = sqla.text(
+            "SELECT group_key, "
+            f"{_make_bucket_index('bucket_start')} AS bucket, "
+            "sketch "
+            "FROM visitor_sketch "
+            f"WHERE group_by = :group_by AND {_make_where(query, 'bucket_start')}"
+        )
+        sketches = {}
+        for key, bucket_index, data in session.execute(
+            sql, {**params, "group_by": get_group_by_value(query.group_by)}
+        ):
+            sketch = HyperLogLog.from_bytes(data)
+            if (key, bucket_index) in sketches:
+                sketches[(key, bucket_index)].merge(sketch)
+            else:
+                sketches[(key, bucket_index)] = sketch
+        results.add_counts(
+            (key, bucket_index, round(sketch.count()))
+            for (key, bucket_index), sketch in sketches.items()
+        )
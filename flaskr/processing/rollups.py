@@ -0,0 +1,259 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Set, Tuple
+
+import sqlalchemy as sqla
+import sqlalchemy.orm
+from sqlalchemy.dialects.sqlite import insert
+
+from flaskr.models.processed_view import ProcessedView
+from flaskr.models.view_rollup import ROLLUP_GRAIN_SECONDS, ViewRollup
+from flaskr.models.visitor_sketch import VisitorSketch
+from flaskr.processing.hyperloglog import HyperLogLog, hash_value
+from flaskr.processing.query_runner import (
+    VISITOR_COLUMN,
+    GroupBy,
+    get_group_by_value,
+    get_group_column,
+    to_micros,
+)
+
+# Key identifying a single row of the `view_rollup` table:
+# (bucket_start, group_by, group_key, is_bot).
+RollupKey = Tuple[datetime, str, str, bool]
+
+# The number of rollup buckets looked up per SELECT, keeping well below
+# SQLite's limit on the number of parameters.
+_BUCKETS_PER_SELECT = 500
+# The number of views read at a time when rebuilding the visitor sketches.
+_REBUILD_CHUNK_SIZE = 50000
+
+
+def get_rollup_bucket(timestamp: datetime) -> datetime:
+    """Returns the start of the rollup bucket that `timestamp` falls into."""
+    return timestamp - timedelta(
+        microseconds=to_micros(timestamp) % (ROLLUP_GRAIN_SECONDS * 1000000)
+    )
+
+
+def get_group_key(view: ProcessedView, group_by: GroupBy) -> str:
+    """Returns the key that `view` is counted under when grouping by `group_by`."""
+    if group_by == GroupBy.Unset:
+        return "Count"
+    value = getattr(view, get_group_column(group_by))
+    return value if value is not None else "UNKNOWN"
+
+
+def get_rollup_keys(view: ProcessedView) -> List[RollupKey]:
+    """Returns the key of each rollup that `view` is counted in."""
+    bucket_start = get_rollup_bucket(view.timestamp)
+    is_bot = bool(view.is_bot)
+    return [
+        (
+            bucket_start,
+            get_group_by_value(group_by),
+            get_group_key(view, group_by),
+            is_bot,
+        )
+        for group_by in GroupBy
+    ]
+
+
+class VisitorSketchAccumulator:
+    """
+    Accumulates the visitors of ProcessedViews in memory, so that their
+    sketches in the `visitor_sketch` table can be updated in a single batch.
+    """
+
+    def __init__(self):
+        self._visitors: Dict[RollupKey, Set[int]] = defaultdict(set)
+
+    def add(self, keys: Iterable[RollupKey], visitor: str):
+        """Adds `visitor` to the sketch of each of the rollup `keys`."""
+        visitor_hash = hash_value(visitor)
+        for key in keys:
+            self._visitors[key].add(visitor_hash)
+
+    def flush(self, session: "sqlalchemy.orm.scoping.scoped_session"):
+        """
+        Merges the accumulated visitors into the `visitor_sketch` table and
+        resets the accumulator. Does not commit.
+        """
+        if not self._visitors:
+            return
+        # A batch of views spans few hours, so it's cheapest to read all
+        # sketches of those hours and match the keys here.
+        bucket_starts = sorted({key[0] for key in self._visitors})
+        stored = {}
+        for i in range(0, len(bucket_starts), _BUCKETS_PER_SELECT):
+            for *key, sketch in session.execute(
+                sqla.select(
+                    VisitorSketch.bucket_start,
+                    VisitorSketch.group_by,
+                    VisitorSketch.group_key,
+                    VisitorSketch.is_bot,
+                    VisitorSketch.sketch,
+                ).where(
+                    VisitorSketch.bucket_start.in_(
+                        bucket_starts[i : i + _BUCKETS_PER_SELECT]
+                    )
+                )
+            ):
+                if tuple(key) in self._visitors:
+                    stored[tuple(key)] = sketch
+
+        rows = []
+        for key, visitor_hashes in self._visitors.items():
+            sketch = (
+                HyperLogLog.from_bytes(stored[key]) if key in stored else HyperLogLog()
+            )
+            for visitor_hash in visitor_hashes:
+                sketch.add_hash(visitor_hash)
+            bucket_start, group_by, group_key, is_bot = key
+            rows.append(
+                {
+                    "bucket_start": bucket_start,
+                    "group_by": group_by,
+                    "group_key": group_key,
+                    "is_bot": is_bot,
+                    "sketch": sketch.to_bytes(),
+                }
+            )
+        stmt = insert(VisitorSketch)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["bucket_start", "group_by", "group_key", "is_bot"],
+            set_={"sketch": stmt.excluded.sketch},
+        )
+        session.execute(stmt, rows)
+        self._visitors.clear()
+
+
+class RollupAccumulator:
+    """
+    Accumulates rollup counts and visitor sketches for ProcessedViews in
+    memory, so that they can be written to the `view_rollup` and
+    `visitor_sketch` tables in a single batch.
+    """
+
+    def __init__(self):
+        self._counts: Dict[RollupKey, int] = defaultdict(int)
+        self._visitors = VisitorSketchAccumulator()
+
+    def add(self, view: ProcessedView):
+        """Counts `view` under each of the `GroupBy` dimensions."""
+        keys = get_rollup_keys(view)
+        for key in keys:
+            self._counts[key] += 1
+        self._visitors.add(keys, getattr(view, VISITOR_COLUMN))
+
+    def flush(self, session: "sqlalchemy.orm.scoping.scoped_session"):
+        """
+        Adds the accumulated counts and visitors to the `view_rollup` and
+        `visitor_sketch` tables and resets the accumulator. Does not commit.
+        """
+        self._visitors.flush(session)
+        if not self._counts:
+            return
+        stmt = insert(ViewRollup)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["bucket_start", "group_by", "group_key", "is_bot"],
+            set_={"count": ViewRollup.count + stmt.excluded.count},
+        )
+        session.execute(
+            stmt,
+            [
+                {
+                    "bucket_start": bucket_start,
+                    "group_by": group_by,
+                    "group_key": group_key,
+                    "is_bot": is_bot,
+                    "count": count,
+                }
+                for (bucket_start, group_by, group_key, is_bot), count in (
+                    self._counts.items()
+                )
+            ],
+        )
+        self._counts.clear()
+
+
+def rebuild_rollups(session: "sqlalchemy.orm.scoping.scoped_session"):
+    """
+    Recomputes the `view_rollup` and `visitor_sketch` tables from scratch
+    using all rows of the `processed_view` table. Does not commit.
+    """
+    rebuild_visitor_sketches(session)
+    session.execute(sqla.delete(ViewRollup))
+    for group_by in GroupBy:
+        group_key = (
+            "'Count'"
+            if group_by == GroupBy.Unset
+            else f"IFNULL({get_group_column(group_by)}, 'UNKNOWN')"
+        )
+        session.execute(
+            sqla.text(
+                "INSERT INTO view_rollup "
+                "(bucket_start, group_by, group_key, is_bot, count) "
+                # Truncate timestamps to the rollup grain, keeping the format
+                # that SQLAlchemy uses to store datetimes.
+                "SELECT strftime('%Y-%m-%d %H:%M:%S.000000', "
+                "CAST(strftime('%s', timestamp) AS INTEGER) / :grain * :grain, "
+                "'unixepoch') AS bucket, "
+                ":group_by, "
+                f"{group_key} AS group_key, "
+                "IFNULL(is_bot, FALSE) AS bot, "
+                "COUNT(*) "
+                "FROM processed_view "
+                "GROUP BY bucket, group_key, bot"
+            ),
+            {
+                "group_by": get_group_by_value(group_by),
+                "grain": ROLLUP_GRAIN_SECONDS,
+            },
+        )
+
+
+def rebuild_visitor_sketches(session: "sqlalchemy.orm.scoping.scoped_session"):
+    """
+    Recomputes the `visitor_sketch` table from all processed views, reading
+    them in chunks. Does not commit.
+    """
+    session.execute(sqla.delete(VisitorSketch))
+    columns = {
+        "timestamp",
+        "is_bot",
+        VISITOR_COLUMN,
+        *(get_group_column(g) for g in GroupBy if g != GroupBy.Unset),
+    }
+    visitors = VisitorSketchAccumulator()
+    last_id = 0
+    while True:
+        # Keyset pagination, as the session is written to in between.
+        views = session.execute(
+            sqla.select(
+                ProcessedView.id,
+                *(getattr(ProcessedView, column) for column in columns),
+            )
+            .where(ProcessedView.id > last_id)
+            .order_by(ProcessedView.id)
+            .limit(_REBUILD_CHUNK_SIZE)
+        ).all()
+        if not views:
+            break
+        for view in views:
+            visitors.add(get_rollup_keys(view), getattr(view, VISITOR_COLUMN))
+        visitors.flush(session)
+        last_id = views[-1].id
@@ -0,0 +1,122 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for running `process-data` across several processes.
+
+Unprocessed raw views are partitioned into shards by id range. Each shard is
+read and has its user agents parsed by a worker process, which returns plain
+data to the parent. The parent resolves IP addresses (so that the ip-api
+rate limit and the IP caches are shared) and is the only process that writes
+to the database, as SQLite only allows one writer at a time.
+"""
+import dataclasses as dc
+from typing import Dict, Iterator, List, Tuple
+
+import sqlalchemy as sqla
+import sqlalchemy.orm
+
+from flaskr.models.raw_view import RawView
+from flaskr.processing.cache_stats import CacheStats
+from flaskr.processing.user_agent_cache import UserAgentCache
+from flaskr.processing.user_agent_parser import UserAgentInfo
+from flaskr.storage.database import enable_sqlite_pragmas
+from flaskr.storage.user_agent_storage import UserAgentStorage
+
+
+@dc.dataclass
+class ShardResult:
+    """The output of processing a single shard in a worker process."""
+
+    # The unprocessed raw views in the shard. Detached from any session.
+    raw_views: List[RawView]
+    # The parsed user agent of each raw view, keyed by user agent string.
+    user_agents: Dict[str, UserAgentInfo]
+    # The user agents that were parsed from scratch and should be stored.
+    new_user_agents: Dict[str, UserAgentInfo]
+    # How effective the worker's user agent cache was.
+    user_agent_stats: CacheStats
+
+
+def iter_unprocessed_id_ranges(
+    session: "sqlalchemy.orm.scoping.scoped_session", shard_size: int
+) -> Iterator[Tuple[int, int]]:
+    """
+    Partitions the unprocessed raw views into inclusive id ranges that each
+    contain (at most) `shard_size` unprocessed views. The ranges are found
+    lazily with a keyset query each, so only one shard's ids are held in
+    memory at a time.
+    """
+    last_id = 0
+    while True:
+        ids = session.scalars(
+            sqla.select(RawView.id)
+            .where(RawView.process_timestamp.is_(None))
+            .where(RawView.id > last_id)
+            .order_by(RawView.id)
+            .limit(shard_size)
+        ).all()
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        last_id = ids[-1]
+
+
+def read_shard_ip_addresses(
+    session: "sqlalchemy.orm.scoping.scoped_session", first_id: int, last_id: int
+) -> List[str]:
+    """
+    Returns the distinct IP addresses of the unprocessed raw views with ids
+    in [first_id, last_id].
+    """
+    return session.scalars(
+        sqla.select(RawView.ip_address)
+        .where(RawView.id.between(first_id, last_id))
+        .where(RawView.process_timestamp.is_(None))
+        .distinct()
+    ).all()
+
+
+def process_shard(
+    database_uri: str, sqlite_pragmas: Dict[str, str], first_id: int, last_id: int
+) -> ShardResult:
+    """
+    Reads the unprocessed raw views with ids in [first_id, last_id] and
+    parses their user agents. Runs in a worker process, so it uses its own
+    database connection (configured with `sqlite_pragmas`) and only reads.
+    """
+    engine = sqla.create_engine(database_uri)
+    enable_sqlite_pragmas(engine, sqlite_pragmas)
+    try:
+        with sqla.orm.Session(engine, expire_on_commit=False) as session:
+            raw_views = session.scalars(
+                sqla.select(RawView)
+                .where(RawView.id.between(first_id, last_id))
+                .where(RawView.process_timestamp.is_(None))
+                .order_by(RawView.id)
+            ).all()
+            session.expunge_all()
+            user_agent_cache = UserAgentCache(UserAgentStorage(session))
+            user_agent_cache.prefetch(raw_view.user_agent for raw_view in raw_views)
+            user_agents = {
+                raw_view.user_agent: user_agent_cache.get(raw_view.user_agent)
+                for raw_view in raw_views
+            }
+            return ShardResult(
+                raw_views,
+                user_agents,
+                user_agent_cache.take_unsaved(),
+                user_agent_cache.stats,
+            )
+    finally:
+        engine.dispose()
@@ -0,0 +1,92 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Dict, Iterable, Optional, Set
+
+import pylru
+
+from flaskr.processing.cache_stats import CacheStats
+from flaskr.processing.user_agent_parser import UserAgentInfo, parse_user_agent
+from flaskr.storage.user_agent_storage import UserAgentStorage
+
+
+class UserAgentCache:
+    """
+    Memoizes `parse_user_agent()`.
+
+    Results are kept in a bounded in-memory LRU cache, backed by the
+    persistent `storage`, if any. Callers should `prefetch()` the user
+    agents they are about to need, so that stored results are loaded in
+    bulk. New results are written to `storage` on `flush()`.
+    """
+
+    def __init__(
+        self,
+        storage: Optional[UserAgentStorage] = None,
+        max_size: int = 4096,
+    ):
+        self._storage = storage
+        self._cache = pylru.lrucache(max_size)
+        # Results that have been parsed but not yet written to storage.
+        self._unsaved: Dict[str, UserAgentInfo] = {}
+        # Results that were loaded from storage but not yet requested.
+        self._prefetched: Set[str] = set()
+        self.stats = CacheStats()
+
+    def prefetch(self, user_agent_strings: Iterable[str]):
+        """Loads stored results for any of `user_agent_strings` not in memory."""
+        if not self._storage:
+            return
+        to_load = [ua for ua in set(user_agent_strings) if ua not in self._cache]
+        for user_agent_string, info in self._storage.load(to_load).items():
+            self._cache[user_agent_string] = info
+            self._prefetched.add(user_agent_string)
+
+    def get(self, user_agent_string: str) -> UserAgentInfo:
+        """Returns the parsed `user_agent_string`."""
+        if user_agent_string in self._cache:
+            if user_agent_string in self._prefetched:
+                self._prefetched.remove(user_agent_string)
+                self.stats.database_hits += 1
+            else:
+                self.stats.memory_hits += 1
+            return self._cache[user_agent_string]
+        info = parse_user_agent(user_agent_string)
+        self.stats.misses += 1
+        # It may have been prefetched and then evicted.
+        self._prefetched.discard(user_agent_string)
+        self._cache[user_agent_string] = info
+        self._unsaved[user_agent_string] = info
+        return info
+
+    def take_unsaved(self) -> Dict[str, UserAgentInfo]:
+        """Returns the results that haven't been stored yet, and forgets them."""
+        unsaved = self._unsaved
+        self._unsaved = {}
+        return unsaved
+
+    def add_unsaved(self, results: Dict[str, UserAgentInfo], stats: CacheStats):
+        """
+        Adopts `results` parsed by another cache (e.g. in a worker process),
+        so that they are stored on the next `flush()`, and adds its `stats`.
+        """
+        for user_agent_string, info in results.items():
+            self._cache[user_agent_string] = info
+        self._unsaved.update(results)
+        self.stats.add(stats)
+
+    def flush(self):
+        """Writes new results to storage. Does not commit."""
+        if self._storage:
+            self._storage.save(self._unsaved)
+        self._unsaved.clear()
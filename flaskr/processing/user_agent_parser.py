@@ -0,0 +1,66 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import dataclasses as dc
+from importlib.metadata import version
+from typing import Optional
+
+import user_agents
+from user_agents.parsers import UserAgent
+
+# Identifies the parsing rules in use. Cached results are only reused if
+# they were produced by the same versions of the parsing libraries.
+PARSER_VERSION = (
+    f"user-agents={version('user-agents')},ua-parser={version('ua-parser')}"
+)
+
+
+@dc.dataclass(frozen=True)
+class UserAgentInfo:
+    """Stores information derived from a single user agent string."""
+
+    is_bot: bool
+    operating_system_family: Optional[str] = None
+    operating_system_version: Optional[str] = None
+    browser_family: Optional[str] = None
+    browser_version: Optional[str] = None
+    device_family: Optional[str] = None
+    device_brand: Optional[str] = None
+    device_type: Optional[str] = None
+
+
+def _device_type(user_agent: UserAgent) -> str:
+    if user_agent.is_mobile:
+        return "Mobile"
+    elif user_agent.is_tablet:
+        return "Tablet"
+    elif user_agent.is_pc:
+        return "PC"
+    else:
+        return "Unknown"
+
+
+def parse_user_agent(user_agent_string: str) -> UserAgentInfo:
+    """Parses `user_agent_string`. This is CPU-intensive; prefer `UserAgentCache`."""
+    user_agent = user_agents.parse(user_agent_string)
+    return UserAgentInfo(
+        # Whether the user agent is suspected to be from a bot.
+        is_bot=user_agent.is_bot,
+        operating_system_family=user_agent.os.family,
+        operating_system_version=user_agent.os.version_string,
+        browser_family=user_agent.browser.family,
+        browser_version=user_agent.browser.version_string,
+        device_family=user_agent.device.family,
+        device_brand=user_agent.device.brand,
+        device_type=_device_type(user_agent),
+    )
@@ -11,18 +11,21 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
 
-import pylru
-import ratelimiter
-import user_agents
 from flask import current_app
-from user_agents.parsers import UserAgent
 
 from flaskr.models.processed_view import ProcessedView
 from flaskr.models.raw_view import RawView
-from flaskr.processing.ip_lookup import IpAddressInfo, lookup_ip_address
+from flaskr.processing.cache_stats import CacheStats
+from flaskr.processing.ip_enricher import IpEnricher
+from flaskr.processing.ip_providers import make_ip_info_provider
+from flaskr.processing.user_agent_cache import UserAgentCache
+from flaskr.processing.user_agent_parser import UserAgentInfo
+from flaskr.storage.database import db
+from flaskr.storage.ip_info_storage import IpInfoStorage
+from flaskr.storage.user_agent_storage import UserAgentStorage
 
 
 class ViewProcessor:
@@ -31,21 +34,78 @@ class ViewProcessor:
     """
 
     def __init__(self):
-        self._ip_cache = pylru.lrucache(512)
-        # ip-api is limited to 45 requests per minute.
-        self._lookup_throttler = ratelimiter.RateLimiter(45, 60)
+        self._ip_enricher = IpEnricher(
+            current_app.logger,
+            make_ip_info_provider(
+                current_app.config["IP_API_URL"],
+                current_app.config["IP_DATABASE_PATH"],
+                current_app.config["IP_API_FALLBACK"],
+            ),
+            IpInfoStorage(
+                db.session,
+                timedelta(days=current_app.config["IP_CACHE_TTL_DAYS"]),
+                timedelta(days=current_app.config["IP_CACHE_NEGATIVE_TTL_DAYS"]),
+            ),
+        )
+        self._user_agent_cache = UserAgentCache(UserAgentStorage(db.session))
+
+    def prefetch_ip_addresses(self, ip_addresses: Iterable[str]):
+        """Starts looking up `ip_addresses` in the background."""
+        self._ip_enricher.prefetch(ip_addresses)
+
+    def add_parsed_user_agents(
+        self, user_agents: Dict[str, UserAgentInfo], stats: CacheStats
+    ):
+        """
+        Adopts user agents that were parsed elsewhere, e.g. in a worker process,
+        so that they are written to the database on the next `flush()`.
+        """
+        self._user_agent_cache.add_unsaved(user_agents, stats)
+
+    def prefetch(self, raw_views: Iterable[RawView]):
+        """
+        Starts looking up the IP addresses of `raw_views` in the background,
+        so that the lookups overlap with processing and writing other views.
+        Also loads previously parsed user agents.
+        """
+        raw_views = list(raw_views)
+        self._ip_enricher.prefetch(raw_view.ip_address for raw_view in raw_views)
+        self._user_agent_cache.prefetch(raw_view.user_agent for raw_view in raw_views)
+
+    def flush(self):
+        """
+        Writes newly looked-up IP information and parsed user agents to the
+        database. Does not commit.
+        """
+        self._ip_enricher.flush()
+        self._user_agent_cache.flush()
 
-    def process_view(self, raw_view: RawView) -> ProcessedView:
-        user_agent = user_agents.parse(raw_view.user_agent)
-        location = self._lookup_ip(raw_view.ip_address)
-        is_bot = self._is_bot(user_agent)
+    def close(self):
+        """Releases the resources used for IP lookups."""
+        self._ip_enricher.close()
+
+    def log_stats(self):
+        """Logs how effective the caches have been."""
+        current_app.logger.info(f"IP info cache: {self._ip_enricher.stats}.")
+        current_app.logger.info(f"User agent cache: {self._user_agent_cache.stats}.")
+
+    def process_view(
+        self, raw_view: RawView, user_agent: Optional[UserAgentInfo] = None
+    ) -> ProcessedView:
+        """
+        Derives a ProcessedView from `raw_view`. Parses its user agent unless
+        the parsed `user_agent` is passed in.
+        """
+        if user_agent is None:
+            user_agent = self._user_agent_cache.get(raw_view.user_agent)
+        location = self._ip_enricher.get(raw_view.ip_address)
         return ProcessedView(
             url=raw_view.url,
             ip_address=raw_view.ip_address,
             user_agent=raw_view.user_agent,
             timestamp=raw_view.timestamp,
             process_timestamp=datetime.now(),
-            is_bot=is_bot,
+            is_bot=user_agent.is_bot,
             hostname=location.hostname if location else None,
             domain=location.domain if location else None,
             country=location.country if location else None,
@@ -56,48 +116,11 @@ class ViewProcessor:
             lon=location.lon if location else None,
             isp=location.isp if location else None,
             org=location.org if location else None,
-            operating_system_family=user_agent.os.family,
-            operating_system_version=user_agent.os.version_string,
-            browser_family=user_agent.browser.family,
-            browser_version=user_agent.browser.version_string,
-            device_family=user_agent.device.family,
-            device_brand=user_agent.device.brand,
-            device_type=self._device_type(user_agent),
+            operating_system_family=user_agent.operating_system_family,
+            operating_system_version=user_agent.operating_system_version,
+            browser_family=user_agent.browser_family,
+            browser_version=user_agent.browser_version,
+            device_family=user_agent.device_family,
+            device_brand=user_agent.device_brand,
+            device_type=user_agent.device_type,
         )
-
-    def _lookup_ip(self, ip_address: str) -> Optional[IpAddressInfo]:
-        """
-        Returns location information for the specified IP address.
-
-        Internally makes a request to an external API. Uses an LRU cache to
-        reduce API calls and respects the location QPS limit.
-        """
-        lookup = self._ip_cache.get(ip_address, None)
-        if lookup:
-            return lookup
-        with self._lookup_throttler:
-            try:
-                ip_info = lookup_ip_address(ip_address)
-                self._ip_cache[ip_address] = ip_info
-                return ip_info
-            except ValueError as e:
-                current_app.logger.error(
-                    f"Error while processing IP address {ip_address}: {e}."
-                )
-                self._ip_cache[ip_address] = None
-
-    @staticmethod
-    def _is_bot(user_agent: UserAgent) -> bool:
-        """Returns whether the user agent is suspected to be from a bot."""
-        return user_agent.is_bot
-
-    @staticmethod
-    def _device_type(user_agent: UserAgent) -> str:
-        if user_agent.is_mobile:
-            return "Mobile"
-        elif user_agent.is_tablet:
-            return "Tablet"
-        elif user_agent.is_pc:
-            return "PC"
-        else:
-            return "Unknown"
@@ -0,0 +1,243 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The backup log: a CSV file to which every reported view is appended, so that
+the database can be rebuilt from it. Rotated segments are kept next to it.
+"""
+import atexit
+import csv
+import fcntl
+import glob
+import gzip
+import io
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional
+
+# Buffered bytes that trigger a flush before the flush interval is up.
+MAX_BUFFER_SIZE = 1024 * 1024
+# Matches the suffix of a rotated segment, e.g. `.20230102-030405.gz`.
+SEGMENT_SUFFIX_PATTERN = re.compile(r"\.(\d{8}-\d{6}(?:-\d+)?)(\.gz)?$")
+
+
+def get_log_segments(path: str) -> List[str]:
+    """
+    Returns the paths of the rotated segments of the log at `path`, oldest
+    first, followed by `path` itself if it exists.
+
+    A segment that is being compressed briefly exists both plain and gzipped;
+    the `.gz` is only renamed into place once complete, so it is preferred.
+    """
+    segments = {}
+    for segment in glob.glob(glob.escape(path) + ".*"):
+        match = SEGMENT_SUFFIX_PATTERN.search(segment)
+        if match and len(segment) == len(path) + len(match.group(0)):
+            stamp, is_gzipped = match.group(1), bool(match.group(2))
+            if is_gzipped or stamp not in segments:
+                segments[stamp] = segment
+    paths = [segments[stamp] for stamp in sorted(segments)]
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def read_log(path: str) -> Iterator[List[str]]:
+    """
+    Yields the rows of the log at `path`, including its rotated segments,
+    oldest first.
+    """
+    for segment in get_log_segments(path):
+        opener = gzip.open if segment.endswith(".gz") else open
+        with opener(segment, "rt", newline="") as log_file:
+            yield from csv.reader(log_file)
+
+
+class BackupLogWriter:
+    """
+    Appends rows to the backup log at `path`.
+
+    Rows are buffered in memory and written every `flush_interval_sec` by a
+    background thread, or sooner if the buffer grows large. The file is
+    rotated once it reaches `max_bytes`, or when the last write to it was in
+    an earlier `rotate_interval_sec` period (0 disables either check).
+    Rotated segments are renamed to `<path>.<YYYYmmdd-HHMMSS>` and, if
+    `compress` is set, gzipped in the background. If `max_segments` is
+    non-zero, only that many of the newest rotated segments are kept.
+
+    Several processes (e.g. gunicorn workers) may write to the same log:
+    every flush and rotation holds an exclusive `flock` on `<path>.lock`,
+    and a writer reopens the log if another process has rotated it.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 64 * 1024 * 1024,
+        rotate_interval_sec: int = 86400,
+        compress: bool = True,
+        flush_interval_sec: float = 1.0,
+        max_segments: int = 0,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.path = path
+        self._max_bytes = max_bytes
+        self._rotate_interval_sec = rotate_interval_sec
+        self._compress = compress
+        self._flush_interval_sec = flush_interval_sec
+        self._max_segments = max_segments
+        self._logger = logger or logging.getLogger(__name__)
+        self._buffer = io.StringIO()
+        self._csv_writer = csv.writer(self._buffer, delimiter=",")
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._lock_fd: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._compress_threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+
+    def write(self, rows: Iterable[list]):
+        """Buffers `rows` to be appended to the log."""
+        with self._lock:
+            self._csv_writer.writerows(rows)
+            # Start the thread lazily so that it isn't created before a
+            # server forks its workers, nor for CLI commands.
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="backup-log", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.close)
+            if self._buffer.tell() >= MAX_BUFFER_SIZE:
+                self._flush_locked()
+
+    def flush(self):
+        """Appends all buffered rows to the log file."""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        """Flushes the buffer and releases the log file."""
+        atexit.unregister(self.close)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            self._flush_locked()
+            for fd in (self._fd, self._lock_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._fd, self._lock_fd = None, None
+        for thread in self._compress_threads:
+            thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval_sec):
+            try:
+                self.flush()
+            except OSError:
+                self._logger.exception(f"Failed to write the log at {self.path}.")
+
+    def _flush_locked(self):
+        data = self._buffer.getvalue().encode()
+        if not data:
+            return
+        if self._lock_fd is None:
+            self._lock_fd = os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT)
+        rotated = None
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            self._open_current_file()
+            if self._should_rotate():
+                rotated = self._rotate()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view) :]
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        if rotated:
+            self._finish_rotation(rotated)
+
+    def _open_current_file(self):
+        """(Re)opens the file at `path` if it was rotated by any process."""
+        if self._fd is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._fd).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _should_rotate(self) -> bool:
+        stat = os.fstat(self._fd)
+        if stat.st_size == 0:
+            return False
+        if self._max_bytes and stat.st_size >= self._max_bytes:
+            return True
+        if self._rotate_interval_sec:
+            period = int(stat.st_mtime // self._rotate_interval_sec)
+            return period < int(time.time() // self._rotate_interval_sec)
+        return False
+
+    def _rotate(self) -> str:
+        """Renames the current file to a new segment and opens a new one."""
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        rotated = f"{self.path}.{stamp}"
+        i = 0
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            i += 1
+            rotated = f"{self.path}.{stamp}-{i}"
+        os.rename(self.path, rotated)
+        self._open_current_file()
+        self._logger.info(f"Rotated the log at {self.path} to {rotated}.")
+        return rotated
+
+    def _finish_rotation(self, rotated: str):
+        """Compresses the `rotated` segment and removes old segments."""
+        if self._compress:
+            thread = threading.Thread(
+                target=self._compress_segment, args=(rotated,), name="backup-log-gzip"
+            )
+            thread.start()
+            self._compress_threads = [
+                t for t in self._compress_threads if t.is_alive()
+            ] + [thread]
+        else:
+            self._remove_old_segments()
+
+    def _compress_segment(self, rotated: str):
+        try:
+            with open(rotated, "rb") as src, gzip.open(rotated + ".tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.rename(rotated + ".tmp", rotated + ".gz")
+            os.remove(rotated)
+        except OSError:
+            self._logger.exception(f"Failed to compress {rotated}.")
+        self._remove_old_segments()
+
+    def _remove_old_segments(self):
+        if not self._max_segments:
+            return
+        segments = [s for s in get_log_segments(self.path) if s != self.path]
+        for segment in segments[: -self._max_segments]:
+            try:
+                os.remove(segment)
+            except FileNotFoundError:
+                pass
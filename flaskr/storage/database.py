@@ -11,8 +11,23 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import Dict
+
+import sqlalchemy as sqla
 from flask_sqlalchemy import SQLAlchemy
 
 # This needs to be in a separate file to avoid circular imports
 # See https://stackoverflow.com/a/23400668
 db = SQLAlchemy()
+
+
+def enable_sqlite_pragmas(engine: sqla.Engine, pragmas: Dict[str, str]):
+    """Sets `pragmas` on every new connection that `engine` opens."""
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    sqla.event.listen(engine, "connect", on_connect)
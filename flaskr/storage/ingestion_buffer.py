@@ -0,0 +1,163 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import atexit
+import threading
+import time
+from typing import List, Optional
+
+from flask import Flask
+
+from flaskr.contracts.report_traffic import SinglePageView
+from flaskr.storage.raw_view_storage import write_raw_views
+
+
+class BufferFullError(Exception):
+    """Raised when the ingestion buffer has no room for more views."""
+
+
+class IngestionBuffer:
+    """
+    Holds reported views in memory and writes them to storage on a
+    background thread, so that `POST /api/v1/traffic` doesn't wait on the
+    log file or on a database commit.
+
+    Views are written with `write_raw_views` in a single transaction once
+    `flush_views` views are waiting, or `flush_interval_sec` after the
+    oldest one arrived. At most `max_views` views are held at a time;
+    beyond that `submit()` raises `BufferFullError`. The buffer is flushed
+    on `close()`, which is also registered to run at exit.
+
+    Each process (e.g. each gunicorn worker) has its own buffer. Views
+    that haven't been flushed yet are lost if the process is killed.
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        max_views: int = 10000,
+        flush_views: int = 1000,
+        flush_interval_sec: float = 1.0,
+    ):
+        self._app = app
+        self._max_views = max_views
+        self._flush_views = flush_views
+        self._flush_interval_sec = flush_interval_sec
+        self._pending: List[SinglePageView] = []
+        # When the oldest pending view was submitted.
+        self._pending_since: Optional[float] = None
+        self._condition = threading.Condition()
+        # Serializes writes between the background thread and `flush()`.
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._is_closed = False
+
+    def submit(self, views: List[SinglePageView]):
+        """Queues `views` to be written. Raises `BufferFullError` if full."""
+        with self._condition:
+            if self._is_closed:
+                raise BufferFullError("The ingestion buffer has been closed.")
+            if len(self._pending) + len(views) > self._max_views:
+                raise BufferFullError(
+                    f"The ingestion buffer holds {len(self._pending)} of at most "
+                    f"{self._max_views} views."
+                )
+            # Start the thread lazily so that it isn't created before a
+            # server forks its workers, nor for CLI commands.
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="ingestion-buffer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.close)
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.extend(views)
+            if len(self._pending) >= self._flush_views:
+                self._condition.notify()
+
+    @property
+    def num_pending(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def flush(self) -> bool:
+        """
+        Writes all pending views now, from the calling thread. Returns
+        whether the write succeeded; if not, the views stay pending.
+        """
+        with self._write_lock:
+            with self._condition:
+                views = self._take_pending()
+            return self._write(views)
+
+    def close(self):
+        """Stops the background thread and writes all pending views."""
+        with self._condition:
+            if self._is_closed:
+                return
+            self._is_closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        """Flushes by size or by time until the buffer is closed."""
+        while True:
+            with self._condition:
+                while not self._is_closed and not self._is_due():
+                    self._condition.wait(self._get_wait_time())
+                if self._is_closed:
+                    return
+            if not self.flush():
+                # Back off rather than retrying a failing write in a loop.
+                with self._condition:
+                    self._condition.wait(self._flush_interval_sec)
+
+    def _is_due(self) -> bool:
+        """Returns whether the pending views should be written now."""
+        if not self._pending:
+            return False
+        return (
+            len(self._pending) >= self._flush_views
+            or time.monotonic() - self._pending_since >= self._flush_interval_sec
+        )
+
+    def _get_wait_time(self) -> Optional[float]:
+        """Returns how long until the pending views are due by time."""
+        if not self._pending:
+            return None
+        return max(self._pending_since + self._flush_interval_sec - time.monotonic(), 0)
+
+    def _take_pending(self) -> List[SinglePageView]:
+        views = self._pending
+        self._pending = []
+        self._pending_since = None
+        return views
+
+    def _write(self, views: List[SinglePageView]) -> bool:
+        if not views:
+            return True
+        with self._app.app_context():
+            try:
+                write_raw_views(views)
+                return True
+            except Exception:
+                self._app.logger.exception(
+                    f"Failed to write {len(views)} buffered views."
+                )
+        with self._condition:
+            self._pending[:0] = views
+            self._pending_since = time.monotonic()
+        return False
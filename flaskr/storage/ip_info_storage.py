@@ -0,0 +1,94 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import dataclasses as dc
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+import sqlalchemy.orm
+from sqlalchemy.dialects.sqlite import insert
+
+from flaskr.models.ip_info import IpInfo
+from flaskr.processing.ip_lookup import IpAddressInfo
+
+# The maximum number of IP addresses to look up per SELECT statement.
+# Keeps us under SQLite's limit on the number of bound parameters.
+MAX_SELECT_SIZE = 500
+# Names of the fields stored for each IP address.
+IP_INFO_FIELDS = [f.name for f in dc.fields(IpAddressInfo)]
+
+
+class IpInfoStorage:
+    """
+    Reads and writes looked-up IP address information in the `ip_info` table.
+
+    Successful lookups are considered valid for `ttl`. Failed lookups are
+    stored too and considered valid for `negative_ttl`.
+    """
+
+    def __init__(
+        self,
+        session: "sqlalchemy.orm.scoping.scoped_session",
+        ttl: timedelta,
+        negative_ttl: timedelta,
+    ):
+        self._session = session
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+
+    def load(self, ip_addresses: Iterable[str]) -> Dict[str, Optional[IpAddressInfo]]:
+        """
+        Returns the stored information for those of `ip_addresses` that have
+        an entry that hasn't expired. The value is None for failed lookups.
+        """
+        ip_addresses = list(ip_addresses)
+        now = datetime.now()
+        results: Dict[str, Optional[IpAddressInfo]] = {}
+        for i in range(0, len(ip_addresses), MAX_SELECT_SIZE):
+            chunk = ip_addresses[i : i + MAX_SELECT_SIZE]
+            for row in self._session.query(IpInfo).filter(IpInfo.ip_address.in_(chunk)):
+                ttl = self._ttl if row.is_found else self._negative_ttl
+                if row.lookup_timestamp + ttl < now:
+                    continue
+                results[row.ip_address] = (
+                    IpAddressInfo(**{f: getattr(row, f) for f in IP_INFO_FIELDS})
+                    if row.is_found
+                    else None
+                )
+        return results
+
+    def save(self, results: Dict[str, Optional[IpAddressInfo]]):
+        """Stores the provided lookup results, replacing any existing ones."""
+        if not results:
+            return
+        now = datetime.now()
+        rows: List[dict] = []
+        for ip_address, ip_info in results.items():
+            row = {
+                "ip_address": ip_address,
+                "lookup_timestamp": now,
+                "is_found": ip_info is not None,
+            }
+            for f in IP_INFO_FIELDS:
+                value = getattr(ip_info, f) if ip_info else None
+                row[f] = str(value) if value is not None else None
+            rows.append(row)
+        stmt = insert(IpInfo)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["ip_address"],
+            set_={
+                column: stmt.excluded[column]
+                for column in ["lookup_timestamp", "is_found"] + IP_INFO_FIELDS
+            },
+        )
+        self._session.execute(stmt, rows)
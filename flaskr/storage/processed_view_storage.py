@@ -0,0 +1,61 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime
+from typing import List
+
+import sqlalchemy as sqla
+import sqlalchemy.orm
+
+from flaskr.models.processed_view import ProcessedView
+from flaskr.models.raw_view import RawView
+from flaskr.storage.ip_info_storage import MAX_SELECT_SIZE
+
+# Columns of the `processed_view` table that are set when inserting.
+PROCESSED_VIEW_COLUMNS = [
+    column.key for column in ProcessedView.__table__.columns if not column.primary_key
+]
+
+
+def write_processed_views(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    processed_views: List[ProcessedView],
+):
+    """
+    Inserts `processed_views` in a single executemany, bypassing the ORM's
+    unit of work. Does not commit.
+    """
+    if not processed_views:
+        return
+    session.execute(
+        sqla.insert(ProcessedView),
+        [
+            {column: getattr(view, column) for column in PROCESSED_VIEW_COLUMNS}
+            for view in processed_views
+        ],
+    )
+
+
+def mark_raw_views_processed(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    raw_view_ids: List[int],
+    process_timestamp: datetime,
+):
+    """Sets the `process_timestamp` of the given raw views. Does not commit."""
+    for i in range(0, len(raw_view_ids), MAX_SELECT_SIZE):
+        session.execute(
+            sqla.update(RawView)
+            .where(RawView.id.in_(raw_view_ids[i : i + MAX_SELECT_SIZE]))
+            .values(process_timestamp=process_timestamp)
+            .execution_options(synchronize_session=False)
+        )
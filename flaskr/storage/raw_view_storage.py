@@ -11,37 +11,97 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import csv
 from typing import List
 
+import sqlalchemy as sqla
+import sqlalchemy.orm
 from flask import current_app
 
 from flaskr import db
 from flaskr.contracts.report_traffic import SinglePageView
+from flaskr.models.processed_view import ProcessedView
 from flaskr.models.raw_view import RawView
 
 
 def write_raw_views(views: List[SinglePageView]):
     """Writes the provided view data to the database and to the backup log file."""
-    with open(current_app.config["LOG_PATH"], "a", newline="") as log_file:
-        writer = csv.writer(log_file, delimiter=",")
-        for view in views:
-            # Write to log.
-            writer.writerow(
-                [
-                    view.timestamp.isoformat(),
-                    view.url.strip(),
-                    view.ip_address.strip(),
-                    view.user_agent.strip(),
-                ]
-            )
-    for view in views:
-        db.session.add(
-            RawView(
-                url=view.url.strip(),
-                ip_address=view.ip_address.strip(),
-                user_agent=view.user_agent.strip(),
-                timestamp=view.timestamp,
-            )
-        )
+    insert_raw_views(views)
     db.session.commit()
+
+
+def insert_raw_views(views: List[SinglePageView]):
+    """
+    Inserts the provided view data into the database and writes it to the
+    backup log file. Does not commit.
+    """
+    rows = [
+        {
+            "timestamp": view.timestamp,
+            "url": view.url.strip(),
+            "ip_address": view.ip_address.strip(),
+            "user_agent": view.user_agent.strip(),
+        }
+        for view in views
+    ]
+    # The log is buffered and written out in the background.
+    current_app.extensions["backup_log"].write(
+        [row["timestamp"].isoformat(), row["url"], row["ip_address"], row["user_agent"]]
+        for row in rows
+    )
+    # Insert all rows with a single executemany rather than through the ORM.
+    if rows:
+        db.session.execute(sqla.insert(RawView), rows)
+
+
+def read_unprocessed_raw_views(after_id: int, limit: int) -> List[sqla.Row]:
+    """
+    Returns up to `limit` unprocessed raw views with ids greater than
+    `after_id`, ordered by id. The rows are plain tuples rather than ORM
+    objects, so they don't accumulate in the session.
+    """
+    return db.session.execute(
+        sqla.select(RawView.__table__)
+        .where(RawView.process_timestamp.is_(None))
+        .where(RawView.id > after_id)
+        .order_by(RawView.id)
+        .limit(limit)
+    ).all()
+
+
+def insert_new_raw_views(
+    session: "sqlalchemy.orm.scoping.scoped_session", rows: List[dict]
+) -> int:
+    """
+    Inserts those of `rows` that aren't already stored, comparing
+    (timestamp, ip_address, url, user_agent). Views that have already been
+    processed count as stored, even if their raw view has been garbage
+    collected. Duplicates within `rows` are only inserted once. Does not
+    commit. Returns the number of inserted rows.
+
+    Only stored views within the time range of `rows` are considered, so
+    this is fast if `rows` are roughly ordered by timestamp.
+    """
+    if not rows:
+        return 0
+    timestamps = [row["timestamp"] for row in rows]
+    seen = set()
+    for model in (RawView, ProcessedView):
+        seen.update(
+            session.execute(
+                sqla.select(
+                    model.timestamp,
+                    model.ip_address,
+                    model.url,
+                    model.user_agent,
+                ).where(model.timestamp.between(min(timestamps), max(timestamps)))
+            ).tuples()
+        )
+    new_rows = []
+    for row in rows:
+        key = (row["timestamp"], row["ip_address"], row["url"], row["user_agent"])
+        if key not in seen:
+            seen.add(key)
+            new_rows.append(row)
+    if new_rows:
+        session.execute(sqla.insert(RawView), new_rows)
+    return len(new_rows)
@@ -0,0 +1,74 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import dataclasses as dc
+from typing import Dict, Iterable
+
+import sqlalchemy.orm
+from sqlalchemy.dialects.sqlite import insert
+
+from flaskr.models.parsed_user_agent import ParsedUserAgent
+from flaskr.processing.user_agent_parser import PARSER_VERSION, UserAgentInfo
+from flaskr.storage.ip_info_storage import MAX_SELECT_SIZE
+
+# Names of the fields stored for each user agent.
+USER_AGENT_INFO_FIELDS = [f.name for f in dc.fields(UserAgentInfo)]
+
+
+class UserAgentStorage:
+    """Reads and writes parsed user agents in the `parsed_user_agent` table."""
+
+    def __init__(self, session: "sqlalchemy.orm.scoping.scoped_session"):
+        self._session = session
+
+    def load(self, user_agent_strings: Iterable[str]) -> Dict[str, UserAgentInfo]:
+        """
+        Returns the stored results for those of `user_agent_strings` that
+        were parsed by the current `PARSER_VERSION`.
+        """
+        user_agent_strings = list(user_agent_strings)
+        results: Dict[str, UserAgentInfo] = {}
+        for i in range(0, len(user_agent_strings), MAX_SELECT_SIZE):
+            chunk = user_agent_strings[i : i + MAX_SELECT_SIZE]
+            for row in self._session.query(ParsedUserAgent).filter(
+                ParsedUserAgent.user_agent.in_(chunk),
+                ParsedUserAgent.parser_version == PARSER_VERSION,
+            ):
+                results[row.user_agent] = UserAgentInfo(
+                    **{f: getattr(row, f) for f in USER_AGENT_INFO_FIELDS}
+                )
+        return results
+
+    def save(self, results: Dict[str, UserAgentInfo]):
+        """Stores the provided results, replacing any existing ones."""
+        if not results:
+            return
+        stmt = insert(ParsedUserAgent)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_agent"],
+            set_={
+                column: stmt.excluded[column]
+                for column in ["parser_version"] + USER_AGENT_INFO_FIELDS
+            },
+        )
+        self._session.execute(
+            stmt,
+            [
+                {
+                    "user_agent": user_agent_string,
+                    "parser_version": PARSER_VERSION,
+                    **dc.asdict(info),
+                }
+                for user_agent_string, info in results.items()
+            ],
+        )
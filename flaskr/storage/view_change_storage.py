@@ -0,0 +1,70 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime
+from typing import List, Optional
+
+import sqlalchemy as sqla
+import sqlalchemy.orm
+
+from flaskr.models.view_change import ViewChange
+
+
+def record_view_change(
+    session: "sqlalchemy.orm.scoping.scoped_session",
+    min_timestamp: Optional[datetime],
+    max_timestamp: Optional[datetime],
+):
+    """
+    Records that views between `min_timestamp` and `max_timestamp`
+    (inclusive) changed. Pass None for both if all views may have changed.
+    Does not commit.
+    """
+    session.execute(
+        sqla.insert(ViewChange).values(
+            min_timestamp=min_timestamp,
+            max_timestamp=max_timestamp,
+            change_timestamp=datetime.now(),
+        )
+    )
+
+
+def read_view_changes(
+    session: "sqlalchemy.orm.scoping.scoped_session", after_id: int
+) -> List[sqla.Row]:
+    """
+    Returns the changes with ids greater than `after_id`, ordered by id,
+    plus the latest change in any case. If the latest id is smaller than
+    `after_id`, the table has been recreated.
+    """
+    latest_id = sqla.select(sqla.func.max(ViewChange.id)).scalar_subquery()
+    return session.execute(
+        sqla.select(ViewChange.id, ViewChange.min_timestamp, ViewChange.max_timestamp)
+        .where((ViewChange.id > after_id) | (ViewChange.id == latest_id))
+        .order_by(ViewChange.id)
+    ).all()
+
+
+def delete_view_changes(
+    session: "sqlalchemy.orm.scoping.scoped_session", before: datetime
+) -> int:
+    """
+    Deletes changes made before `before`, except for the latest one.
+    Does not commit. Returns the number of deleted changes.
+    """
+    latest_id = sqla.select(sqla.func.max(ViewChange.id)).scalar_subquery()
+    return session.execute(
+        sqla.delete(ViewChange)
+        .where(ViewChange.change_timestamp < before)
+        .where(ViewChange.id != latest_id)
+    ).rowcount
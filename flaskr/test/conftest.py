@@ -12,7 +12,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
 
 import pytest
 from flask import Flask
@@ -38,6 +42,7 @@ def app() -> Flask:
             # Close the database connection so that we can delete the sqlite file.
             db.session.close()
             db.engine.dispose()
+            app.extensions["backup_log"].close()
 
 
 @pytest.fixture
@@ -55,3 +60,62 @@ def runner(app) -> FlaskCliRunner:
 def make_auth_headers() -> dict:
     """Makes headers for HTTP authentication with the server."""
     return {"Authorization": PYTEST_SECRET_KEY}
+
+
+class IpApiStub(ThreadingHTTPServer):
+    """
+    A local stand-in for the ip-api. Every IP address resolves to a made-up
+    country, except for addresses in `failing_ips`.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), IpApiStubHandler)
+        self.failing_ips = set()
+        # The IP addresses received by each request, in order.
+        self.requests: List[List[str]] = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class IpApiStubHandler(BaseHTTPRequestHandler):
+    server: IpApiStub
+
+    def do_POST(self):
+        ip_addresses = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(ip_addresses)
+        body = json.dumps(
+            [
+                {"status": "fail", "message": "reserved range", "query": ip}
+                if ip in self.server.failing_ips
+                else {
+                    "status": "success",
+                    "query": ip,
+                    "country": f"Country of {ip}",
+                    "city": "Springfield",
+                    "reverse": "host.example.com",
+                }
+                for ip in ip_addresses
+            ]
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def ip_api_stub(app: Flask) -> IpApiStub:
+    """Runs an `IpApiStub` and points the app at it."""
+    server = IpApiStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    app.config["IP_API_URL"] = server.url
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,117 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gc
+import gzip
+import os
+import tempfile
+import time
+import weakref
+
+from flaskr.storage.backup_log import BackupLogWriter, get_log_segments, read_log
+
+
+def read_segment(path: str) -> str:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", newline="") as f:
+        return f.read()
+
+
+def test_rows_are_buffered_until_flush():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "log.csv")
+        writer = BackupLogWriter(path, flush_interval_sec=60)
+        writer.write([["2023-01-01T00:00:00", "/", "1.2.3.4", "Pytest, v1"]])
+        assert not os.path.exists(path)
+        writer.flush()
+        assert read_segment(path) == '2023-01-01T00:00:00,/,1.2.3.4,"Pytest, v1"\r\n'
+        writer.close()
+
+
+def test_rotates_and_compresses_by_size():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "log.csv")
+        writer = BackupLogWriter(path, max_bytes=100, flush_interval_sec=60)
+        for i in range(3):
+            writer.write([["x" * 100, str(i)]])
+            writer.flush()
+        writer.close()
+
+        segments = get_log_segments(path)
+        assert len(segments) == 3
+        assert segments[-1] == path
+        assert all(segment.endswith(".gz") for segment in segments[:-1])
+        contents = "".join(read_segment(segment) for segment in segments)
+        assert [line.split(",")[1] for line in contents.split()] == ["0", "1", "2"]
+
+
+def test_segments_being_compressed_are_read_once():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "log.csv")
+        rotated = path + ".20230101-000000"
+        with open(rotated, "w") as f:
+            f.write("a\r\n")
+        with gzip.open(rotated + ".gz", "wt") as f:
+            f.write("a\r\n")
+        with open(path, "w") as f:
+            f.write("b\r\n")
+
+        assert get_log_segments(path) == [rotated + ".gz", path]
+        assert list(read_log(path)) == [["a"], ["b"]]
+
+
+def test_closed_writers_are_not_kept_alive():
+    with tempfile.TemporaryDirectory() as tempdir:
+        writer = BackupLogWriter(os.path.join(tempdir, "log.csv"))
+        writer.write([["a"]])
+        writer.close()
+        writer_ref = weakref.ref(writer)
+        del writer
+        gc.collect()
+        assert writer_ref() is None
+
+
+def test_rotates_by_time_and_keeps_max_segments():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "log.csv")
+        writer = BackupLogWriter(
+            path, compress=False, flush_interval_sec=60, max_segments=1
+        )
+        for i in range(3):
+            writer.write([[str(i)]])
+            writer.flush()
+            # Pretend that the log was last written two days ago.
+            two_days_ago = time.time() - 2 * 86400
+            os.utime(path, (two_days_ago, two_days_ago))
+        writer.close()
+
+        segments = get_log_segments(path)
+        assert len(segments) == 2
+        assert read_segment(segments[0]) == "1\r\n"
+
+
+def test_writers_reopen_the_log_after_another_rotates_it():
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, "log.csv")
+        first = BackupLogWriter(path, max_bytes=10, flush_interval_sec=60)
+        second = BackupLogWriter(path, max_bytes=10, flush_interval_sec=60)
+        first.write([["first-1" * 2]])
+        first.flush()
+        second.write([["second"]])
+        second.flush()
+        first.write([["first-2"]])
+        first.flush()
+        first.close()
+        second.close()
+
+        assert read_segment(path) == "second\r\nfirst-2\r\n"
@@ -0,0 +1,139 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import timedelta
+
+from flask import Flask
+from flask.testing import FlaskClient
+
+from flaskr.contracts.query_contract import MAX_QUERIES_PER_BATCH
+from flaskr.processing.query_runner import GroupBy, Metric, Query, run_query
+from flaskr.storage.database import db
+from flaskr.test.conftest import make_auth_headers
+from flaskr.test.test_run_query import START_TIME, add_views, normalize
+
+START = START_TIME + timedelta(minutes=30)
+END = START_TIME + timedelta(days=2, minutes=30)
+
+
+def make_request(queries: list) -> dict:
+    return {
+        "start_time": START.isoformat(),
+        "end_time": END.isoformat(),
+        "filter_by": None,
+        "queries": queries,
+    }
+
+
+def test_batch_query_returns_each_result(app: Flask, client: FlaskClient):
+    add_views(100)
+    items = [
+        {"time_bucket": 3600, "group_by": "Country"},
+        {"time_bucket": 86400, "group_by": "Url"},
+        {"time_bucket": 86400},
+        {"time_bucket": 86400, "group_by": "Country", "metric": "UniqueVisitors"},
+    ]
+    # Cache the first result beforehand.
+    client.get(
+        "/api/v1/data/query",
+        query_string={
+            "start_time": START.isoformat(),
+            "end_time": END.isoformat(),
+            **items[0],
+        },
+        headers=make_auth_headers(),
+    )
+    res = client.post(
+        "/api/v1/data/batch_query",
+        json=make_request(items),
+        headers=make_auth_headers(),
+    )
+    assert res.status_code == 200
+    results = res.json["results"]
+    assert len(results) == 4
+    for item, result in zip(items, results):
+        group_by = GroupBy[item["group_by"]] if "group_by" in item else None
+        metric = Metric[item.get("metric", "Views")]
+        query = Query(START, END, item["time_bucket"], group_by, None, metric=metric)
+        expected = run_query(db.session, query).make_json()
+        assert normalize(result) == normalize(expected)
+
+
+def test_batch_query_rejects_invalid_requests(client: FlaskClient):
+    for queries in [
+        [],
+        [{"time_bucket": 3600}] * (MAX_QUERIES_PER_BATCH + 1),
+        [{"time_bucket": 0}],
+        [{"time_bucket": 3600, "group_by": "Planet"}],
+        [{"time_bucket": 3600, "top_n": 0}],
+        [{"time_bucket": 3600, "metric": "Sessions"}],
+        [{"time_bucket": 3600, "top_n": 3, "metric": "UniqueVisitors"}],
+    ]:
+        res = client.post(
+            "/api/v1/data/batch_query",
+            json=make_request(queries),
+            headers=make_auth_headers(),
+        )
+        assert res.status_code == 400
+
+
+def test_queries_with_too_many_buckets_are_rejected(client: FlaskClient):
+    body = make_request([{"time_bucket": 3600}, {"time_bucket": 60}])
+    body["end_time"] = (START + timedelta(days=730)).isoformat()
+    res = client.post(
+        "/api/v1/data/batch_query", json=body, headers=make_auth_headers()
+    )
+    assert res.status_code == 400
+    assert "Too many buckets" in res.text
+
+    res = client.get(
+        "/api/v1/data/query",
+        query_string={
+            "start_time": body["start_time"],
+            "end_time": body["end_time"],
+            "time_bucket": 60,
+        },
+        headers=make_auth_headers(),
+    )
+    assert res.status_code == 400
+
+
+def test_times_with_offsets_are_converted_to_utc(app: Flask, client: FlaskClient):
+    add_views(100)
+    expected = run_query(
+        db.session, Query(START, END, 86400, GroupBy.Country, None)
+    ).make_json()
+
+    # The same time range as START and END, in UTC-1.
+    res = client.get(
+        "/api/v1/data/query",
+        query_string={
+            "start_time": (START - timedelta(hours=1)).isoformat() + "-01:00",
+            "end_time": (END - timedelta(hours=1)).isoformat() + "-01:00",
+            "time_bucket": 86400,
+            "group_by": "Country",
+        },
+        headers=make_auth_headers(),
+    )
+    assert res.status_code == 200
+    assert normalize(res.json) == normalize(expected)
+
+    # And in UTC+2.
+    body = make_request([{"time_bucket": 86400, "group_by": "Country"}])
+    body["start_time"] = (START + timedelta(hours=2)).isoformat() + "+02:00"
+    body["end_time"] = (END + timedelta(hours=2)).isoformat() + "+02:00"
+    res = client.post(
+        "/api/v1/data/batch_query", json=body, headers=make_auth_headers()
+    )
+    assert res.status_code == 200
+    assert normalize(res.json["results"][0]) == normalize(expected)
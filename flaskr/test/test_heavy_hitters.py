@@ -0,0 +1,43 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import random
+
+import pytest
+
+from flaskr.processing.heavy_hitters import SpaceSaving, select_top_keys
+
+
+def test_select_top_keys_breaks_ties_by_key():
+    totals = {"b": 2, "a": 2, "c": 5, "d": 1}
+    assert select_top_keys(totals, 3) == ["c", "a", "b"]
+    assert select_top_keys(totals, 10) == ["c", "a", "b", "d"]
+
+
+def test_space_saving_tracks_frequent_keys():
+    random.seed(0)
+    # Three frequent keys among many rare ones.
+    stream = ["x"] * 500 + ["y"] * 300 + ["z"] * 200
+    stream += [f"rare-{i}" for i in range(2000)]
+    random.shuffle(stream)
+    sketch = SpaceSaving(capacity=30)
+    for key in stream:
+        sketch.add(key)
+    assert len(sketch.candidates()) == 30
+    # Keys occurring more than len(stream) / capacity = 100 times are kept.
+    assert sketch.candidates()[:3] == ["x", "y", "z"]
+
+
+def test_space_saving_requires_capacity():
+    with pytest.raises(ValueError):
+        SpaceSaving(0)
@@ -0,0 +1,47 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+
+from flaskr.processing.hyperloglog import SPARSE_LIMIT, HyperLogLog
+
+
+def make_sketch(start: int, end: int) -> HyperLogLog:
+    sketch = HyperLogLog()
+    for i in range(start, end):
+        sketch.add(f"192.168.{i // 256}.{i % 256}")
+    return sketch
+
+
+@pytest.mark.parametrize("num_values", [0, 1, 10, SPARSE_LIMIT * 2, 20000])
+def test_count_is_close_to_the_number_of_distinct_values(num_values: int):
+    sketch = make_sketch(0, num_values)
+    # Adding values again doesn't change the estimate.
+    sketch.merge(make_sketch(0, num_values))
+    assert sketch.count() == pytest.approx(num_values, rel=0.05, abs=0.5)
+
+
+@pytest.mark.parametrize("split", [5, 100, 3000])
+def test_merge_matches_a_sketch_of_the_union(split: int):
+    merged = make_sketch(0, split)
+    merged.merge(make_sketch(split // 2, 5000))
+    assert merged.count() == make_sketch(0, 5000).count()
+    assert merged.to_bytes() == make_sketch(0, 5000).to_bytes()
+
+
+@pytest.mark.parametrize("num_values", [0, 3, 4000])
+def test_serialization_round_trips(num_values: int):
+    sketch = make_sketch(0, num_values)
+    data = sketch.to_bytes()
+    assert HyperLogLog.from_bytes(data).to_bytes() == data
+    assert HyperLogLog.from_bytes(data).count() == sketch.count()
@@ -0,0 +1,160 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List
+
+import pytest
+from click.testing import CliRunner
+
+import ingest_data
+from ingest_data import Uploader, encode_batch, read_batches
+
+VIEWS = [
+    {
+        "timestamp": f"2023-01-01T00:00:0{i}",
+        "url": f"https://www.stefanonsoftware.com/{i % 2}",
+        "ip_address": f"1.1.1.{i}",
+        "user_agent": "pytest",
+    }
+    for i in range(5)
+]
+
+
+class TrafficApiStub(ThreadingHTTPServer):
+    """
+    A local stand-in for the traffic API. Responds to each request with the
+    next of `statuses`, then with 200. Stalls for `stall_sec` on the first
+    request.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), TrafficApiStubHandler)
+        self.statuses: List[int] = []
+        self.stall_sec = 0.0
+        # The body and headers of each request, in order.
+        self.requests: List[tuple] = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/api/v1/traffic"
+
+    def handle_error(self, request, client_address):
+        # The client hangs up on stalled requests.
+        pass
+
+
+class TrafficApiStubHandler(BaseHTTPRequestHandler):
+    server: TrafficApiStub
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((body, dict(self.headers)))
+        if len(self.server.requests) == 1 and self.server.stall_sec:
+            time.sleep(self.server.stall_sec)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def traffic_api_stub(monkeypatch: pytest.MonkeyPatch) -> TrafficApiStub:
+    monkeypatch.setattr(ingest_data, "RETRY_BACKOFF_SEC", 0)
+    server = TrafficApiStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_read_batches(tmp_path: Path):
+    path = tmp_path / "traffic.csv"
+    path.write_text(
+        "".join(
+            f"{v['timestamp']},{v['url']},{v['ip_address']},{v['user_agent']}\n"
+            for v in VIEWS
+        )
+    )
+    batches = list(read_batches(path, 2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sum(batches, []) == VIEWS
+
+    path.write_text("2023-01-01T00:00:00,/,1.1.1.1\n")
+    with pytest.raises(ValueError):
+        list(read_batches(path, 2))
+
+
+def test_encode_batch():
+    body, headers = encode_batch(VIEWS, "columnar", use_gzip=True)
+    assert headers["Content-Encoding"] == "gzip"
+    columnar = json.loads(gzip.decompress(body))
+    assert len(columnar["urls"]) == 2
+    assert [columnar["urls"][i] for i in columnar["url"]] == [
+        view["url"] for view in VIEWS
+    ]
+
+    body, headers = encode_batch(VIEWS, "ndjson", use_gzip=False)
+    assert headers["Content-Type"] == ingest_data.NDJSON_CONTENT_TYPE
+    assert [json.loads(line) for line in body.splitlines()] == VIEWS
+
+    body, _ = encode_batch(VIEWS, "json", use_gzip=False)
+    assert json.loads(body) == {"traffic": VIEWS}
+
+
+def test_uploader_retries_failed_requests(traffic_api_stub: TrafficApiStub):
+    traffic_api_stub.statuses = [503, 429]
+    uploader = Uploader(traffic_api_stub.url, "password", max_retries=2)
+    assert uploader.send(VIEWS) == 5
+    assert uploader.num_retries == 2
+    assert len(traffic_api_stub.requests) == 3
+    assert traffic_api_stub.requests[-1][1]["Authorization"] == "password"
+
+    traffic_api_stub.statuses = [503, 503, 503]
+    with pytest.raises(ValueError):
+        uploader.send(VIEWS)
+
+
+def test_uploader_does_not_retry_client_errors(traffic_api_stub: TrafficApiStub):
+    traffic_api_stub.statuses = [400]
+    uploader = Uploader(traffic_api_stub.url, "password", max_retries=2)
+    with pytest.raises(ValueError):
+        uploader.send(VIEWS)
+    assert len(traffic_api_stub.requests) == 1
+
+
+def test_uploader_retries_timeouts(traffic_api_stub: TrafficApiStub):
+    traffic_api_stub.stall_sec = 1
+    uploader = Uploader(traffic_api_stub.url, "password", max_retries=1, timeout=0.2)
+    assert uploader.send(VIEWS) == 5
+    assert uploader.num_retries == 1
+
+
+def test_ingest_data_rejects_invalid_concurrency(tmp_path: Path):
+    path = tmp_path / "traffic.csv"
+    path.write_text("")
+    res = CliRunner().invoke(
+        ingest_data.ingest_data,
+        [str(path), "127.0.0.1", "1", "--password", "x", "--concurrency", "0"],
+    )
+    assert res.exit_code == 2
+    assert "--concurrency" in res.output
@@ -0,0 +1,104 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from datetime import datetime
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+
+from flaskr.models.raw_view import RawView
+from flaskr.storage.ingestion_buffer import IngestionBuffer
+from flaskr.test.conftest import make_auth_headers
+
+
+def make_traffic(num_views: int) -> dict:
+    return {
+        "traffic": [
+            {
+                "url": f"https://www.stefanonsoftware.com/{i}",
+                "ip_address": "123.456.7890",
+                "user_agent": "Pytest",
+                "timestamp": datetime.now().isoformat(),
+            }
+            for i in range(num_views)
+        ]
+    }
+
+
+def install_buffer(app: Flask, **kwargs) -> IngestionBuffer:
+    ingestion_buffer = IngestionBuffer(app, **kwargs)
+    app.extensions["ingestion_buffer"] = ingestion_buffer
+    return ingestion_buffer
+
+
+def wait_for_raw_views(num_views: int):
+    deadline = time.monotonic() + 5
+    while RawView.query.count() < num_views and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_buffered_request_is_written_on_flush(app: Flask, client: FlaskClient):
+    ingestion_buffer = install_buffer(app, flush_interval_sec=60)
+    res = client.post(
+        "/api/v1/traffic", json=make_traffic(3), headers=make_auth_headers()
+    )
+    assert res.status_code == 202
+    assert ingestion_buffer.num_pending == 3
+    assert ingestion_buffer.flush()
+    assert RawView.query.count() == 3
+    ingestion_buffer.close()
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{"flush_views": 5, "flush_interval_sec": 60}, {"flush_interval_sec": 0.05}],
+)
+def test_buffer_flushes_in_background(app: Flask, client: FlaskClient, kwargs: dict):
+    ingestion_buffer = install_buffer(app, **kwargs)
+    for _ in range(2):
+        client.post(
+            "/api/v1/traffic", json=make_traffic(3), headers=make_auth_headers()
+        )
+    wait_for_raw_views(6)
+    assert RawView.query.count() == 6
+    ingestion_buffer.close()
+
+
+def test_full_buffer_rejects_requests(app: Flask, client: FlaskClient):
+    ingestion_buffer = install_buffer(app, max_views=5, flush_interval_sec=60)
+    res = client.post(
+        "/api/v1/traffic", json=make_traffic(3), headers=make_auth_headers()
+    )
+    assert res.status_code == 202
+    res = client.post(
+        "/api/v1/traffic", json=make_traffic(3), headers=make_auth_headers()
+    )
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+    ingestion_buffer.close()
+    assert RawView.query.count() == 3
+
+
+def test_close_writes_pending_views(app: Flask):
+    ingestion_buffer = install_buffer(app, flush_interval_sec=60)
+    ingestion_buffer.submit(
+        [
+            RawView(url="/", ip_address="1.2.3.4", user_agent="Pytest", timestamp=t)
+            for t in [datetime.now(), datetime.now()]
+        ]
+    )
+    ingestion_buffer.close()
+    assert ingestion_buffer.num_pending == 0
+    assert RawView.query.count() == 2
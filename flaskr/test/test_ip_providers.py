@@ -0,0 +1,127 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pathlib import Path
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskCliRunner
+
+from flaskr.models.ip_info import IpInfo
+from flaskr.models.processed_view import ProcessedView
+from flaskr.processing.ip_providers import (
+    FallbackProvider,
+    IpApiProvider,
+    PartialLookupError,
+    RangeDatabaseProvider,
+)
+from flaskr.test.conftest import IpApiStub
+from flaskr.test.test_process_data import add_raw_views
+
+RANGE_DATABASE = """\
+# START_IP,END_IP,COUNTRY,REGION,CITY,ZIP,LAT,LON,ISP,ORG
+10.0.0.0,10.0.0.255,Germany,Bavaria,Munich,80331,48.1,11.6,Some ISP,
+10.0.2.0,10.0.2.127,France,,Paris,,,,,
+16909056,16909311,Australia,,,,,,,
+2001:db8::,2001:db8::ffff,Japan,,Tokyo,,,,,
+"""
+
+
+@pytest.fixture()
+def range_database(tmp_path: Path) -> str:
+    path = tmp_path / "ranges.csv"
+    path.write_text(RANGE_DATABASE)
+    return str(path)
+
+
+def test_range_database_lookup(range_database: str):
+    provider = RangeDatabaseProvider(range_database)
+    results = provider.lookup(
+        [
+            "10.0.0.0",
+            "10.0.0.255",
+            "10.0.1.1",
+            "10.0.2.5",
+            "1.2.3.4",
+            "2001:db8::1",
+            "2001:db9::1",
+            "not-an-ip",
+        ]
+    )
+    assert results["10.0.0.0"].country == "Germany"
+    assert results["10.0.0.0"].city == "Munich"
+    assert results["10.0.0.0"].org is None
+    assert results["10.0.0.255"].country == "Germany"
+    assert results["10.0.1.1"] is None
+    assert results["10.0.2.5"].country == "France"
+    assert results["10.0.2.5"].region is None
+    assert results["1.2.3.4"].country == "Australia"
+    assert results["2001:db8::1"].city == "Tokyo"
+    assert results["2001:db9::1"] is None
+    assert results["not-an-ip"] is None
+
+
+def test_fallback_provider(range_database: str, ip_api_stub: IpApiStub):
+    provider = FallbackProvider(
+        RangeDatabaseProvider(range_database), IpApiProvider(ip_api_stub.url)
+    )
+    results = provider.lookup(["10.0.0.1", "10.0.1.1"])
+    assert results["10.0.0.1"].country == "Germany"
+    assert results["10.0.1.1"].country == "Country of 10.0.1.1"
+    assert ip_api_stub.requests == [["10.0.1.1"]]
+    provider.close()
+
+
+def test_fallback_provider_keeps_local_results_on_failure(range_database: str):
+    # Nothing listens on port 9, so every ip-api request fails.
+    provider = FallbackProvider(
+        RangeDatabaseProvider(range_database), IpApiProvider("http://127.0.0.1:9")
+    )
+    with pytest.raises(PartialLookupError) as e:
+        provider.lookup(["1.2.3.4", "10.0.1.1"])
+    assert e.value.results["1.2.3.4"].country == "Australia"
+    assert "10.0.1.1" not in e.value.results
+    provider.close()
+
+
+def test_process_data_retries_failed_fallback_lookups(
+    app: Flask, runner: FlaskCliRunner, ip_api_stub: IpApiStub, range_database: str
+):
+    app.config["IP_DATABASE_PATH"] = range_database
+    app.config["IP_API_URL"] = "http://127.0.0.1:9"
+    add_raw_views(["1.2.3.4", "10.0.1.1"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+    processed = ProcessedView.query.order_by(ProcessedView.id).all()
+    assert processed[0].country == "Australia"
+    assert processed[1].country is None
+    # The failure isn't stored, so the address is looked up again.
+    assert IpInfo.query.filter_by(ip_address="10.0.1.1").count() == 0
+
+    app.config["IP_API_URL"] = ip_api_stub.url
+    add_raw_views(["10.0.1.1"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+    assert ip_api_stub.requests == [["10.0.1.1"]]
+
+
+def test_process_data_with_range_database(
+    app: Flask, runner: FlaskCliRunner, ip_api_stub: IpApiStub, range_database: str
+):
+    app.config["IP_DATABASE_PATH"] = range_database
+    app.config["IP_API_FALLBACK"] = False
+    add_raw_views(["10.0.0.1", "10.0.1.1"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+
+    processed = ProcessedView.query.order_by(ProcessedView.id).all()
+    assert processed[0].country == "Germany"
+    assert processed[1].country is None
+    assert ip_api_stub.requests == []
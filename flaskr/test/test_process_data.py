@@ -0,0 +1,195 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime
+
+from flask import Flask
+from flask.testing import FlaskCliRunner
+
+from flaskr.models.parsed_user_agent import ParsedUserAgent
+from flaskr.models.processed_view import ProcessedView
+from flaskr.models.raw_view import RawView
+from flaskr.processing.shard_processing import iter_unprocessed_id_ranges
+from flaskr.processing.user_agent_cache import UserAgentCache
+from flaskr.processing.user_agent_parser import parse_user_agent
+from flaskr.storage.database import db
+from flaskr.storage.user_agent_storage import UserAgentStorage
+from flaskr.test.conftest import IpApiStub
+
+
+def add_raw_views(ip_addresses: list):
+    for ip_address in ip_addresses:
+        db.session.add(
+            RawView(
+                url="https://www.stefanonsoftware.com",
+                ip_address=ip_address,
+                user_agent="pytest",
+                timestamp=datetime.now(),
+            )
+        )
+    db.session.commit()
+
+
+def test_process_data_success(runner: FlaskCliRunner, ip_api_stub: IpApiStub):
+    add_raw_views(["1.1.1.1", "2.2.2.2", "1.1.1.1"])
+    res = runner.invoke(args=["process-data"])
+    assert res.exit_code == 0
+    assert "Processed 3 records." in res.output
+
+    processed = ProcessedView.query.order_by(ProcessedView.id).all()
+    assert [p.country for p in processed] == [
+        "Country of 1.1.1.1",
+        "Country of 2.2.2.2",
+        "Country of 1.1.1.1",
+    ]
+    assert processed[0].domain == "example.com"
+    assert all(r.process_timestamp for r in RawView.query.all())
+
+
+def test_process_data_batches_unique_ips(
+    runner: FlaskCliRunner, ip_api_stub: IpApiStub
+):
+    # 250 unique IP addresses, each seen twice.
+    ip_addresses = [f"10.0.{i // 256}.{i % 256}" for i in range(250)]
+    add_raw_views(ip_addresses + ip_addresses)
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+
+    assert sorted(len(r) for r in ip_api_stub.requests) == [50, 100, 100]
+    assert sorted(sum(ip_api_stub.requests, [])) == sorted(ip_addresses)
+    assert ProcessedView.query.count() == 500
+
+
+def test_process_data_failed_lookup(runner: FlaskCliRunner, ip_api_stub: IpApiStub):
+    ip_api_stub.failing_ips.add("127.0.0.1")
+    add_raw_views(["127.0.0.1", "1.1.1.1"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+
+    processed = ProcessedView.query.order_by(ProcessedView.id).all()
+    assert processed[0].country is None
+    assert processed[1].country == "Country of 1.1.1.1"
+
+
+def test_process_data_reuses_stored_ip_info(
+    runner: FlaskCliRunner, ip_api_stub: IpApiStub
+):
+    ip_api_stub.failing_ips.add("127.0.0.1")
+    add_raw_views(["1.1.1.1", "127.0.0.1"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+    assert len(ip_api_stub.requests) == 1
+
+    # Both the successful and the failed lookup are reused by the next run.
+    add_raw_views(["1.1.1.1", "127.0.0.1", "2.2.2.2"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+    assert ip_api_stub.requests[1:] == [["2.2.2.2"]]
+    processed = ProcessedView.query.order_by(ProcessedView.id).all()
+    assert [p.country for p in processed[2:]] == [
+        "Country of 1.1.1.1",
+        None,
+        "Country of 2.2.2.2",
+    ]
+
+
+def test_process_data_expires_stored_ip_info(
+    app: Flask, runner: FlaskCliRunner, ip_api_stub: IpApiStub
+):
+    app.config["IP_CACHE_TTL_DAYS"] = 0
+    add_raw_views(["1.1.1.1"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+    add_raw_views(["1.1.1.1"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+    assert ip_api_stub.requests == [["1.1.1.1"], ["1.1.1.1"]]
+
+
+FIREFOX_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:80.0) Gecko/20100101 Firefox/80.0"
+)
+
+
+def test_user_agent_cache(app: Flask):
+    storage = UserAgentStorage(db.session)
+    cache = UserAgentCache(storage)
+    info = cache.get(FIREFOX_USER_AGENT)
+    assert info == parse_user_agent(FIREFOX_USER_AGENT)
+    assert info.browser_family == "Firefox"
+    assert cache.get(FIREFOX_USER_AGENT) is info
+    cache.flush()
+    db.session.commit()
+    assert (cache.stats.memory_hits, cache.stats.misses) == (1, 1)
+
+    # A new cache, e.g. in the next run, loads the stored result.
+    cache = UserAgentCache(storage)
+    cache.prefetch([FIREFOX_USER_AGENT, "pytest"])
+    assert cache.get(FIREFOX_USER_AGENT) == info
+    cache.get("pytest")
+    assert cache.stats.database_hits == 1
+    assert cache.stats.misses == 1
+
+
+def test_user_agent_cache_ignores_other_parser_versions(app: Flask):
+    cache = UserAgentCache(UserAgentStorage(db.session))
+    cache.get(FIREFOX_USER_AGENT)
+    cache.flush()
+    ParsedUserAgent.query.update({"parser_version": "outdated"})
+    db.session.commit()
+
+    cache = UserAgentCache(UserAgentStorage(db.session))
+    cache.prefetch([FIREFOX_USER_AGENT])
+    cache.get(FIREFOX_USER_AGENT)
+    assert cache.stats.misses == 1
+
+
+def test_process_data_with_workers(
+    runner: FlaskCliRunner, ip_api_stub: IpApiStub, monkeypatch
+):
+    monkeypatch.setattr("flaskr.cli.SHARD_SIZE", 3)
+    # More shards than are kept in flight at a time.
+    ip_addresses = [f"10.0.0.{i}" for i in range(20)]
+    add_raw_views(ip_addresses)
+    res = runner.invoke(args=["process-data", "--workers", "2"])
+    assert res.exit_code == 0, res.output
+    assert "Processed 20 records." in res.output
+
+    processed = ProcessedView.query.order_by(ProcessedView.ip_address).all()
+    assert [p.country for p in processed] == [
+        f"Country of {ip}" for ip in sorted(ip_addresses)
+    ]
+    assert all(p.browser_family == "Other" for p in processed)
+    assert all(r.process_timestamp for r in RawView.query.all())
+    assert ParsedUserAgent.query.count() == 1
+
+    # Nothing is left to process.
+    res = runner.invoke(args=["process-data", "--workers", "2"])
+    assert "Processed 0 records." in res.output
+
+
+def test_process_data_in_small_chunks(runner: FlaskCliRunner, ip_api_stub: IpApiStub):
+    add_raw_views(["1.1.1.1", "2.2.2.2"])
+    assert runner.invoke(args=["process-data"]).exit_code == 0
+    ip_addresses = [f"10.0.0.{i}" for i in range(5)]
+    add_raw_views(ip_addresses)
+
+    res = runner.invoke(args=["process-data", "--chunk_size", "2"])
+    assert res.exit_code == 0
+    assert "Processed 5 records." in res.output
+    processed = ProcessedView.query.order_by(ProcessedView.id).all()
+    assert [p.ip_address for p in processed[2:]] == ip_addresses
+    assert RawView.query.filter_by(process_timestamp=None).count() == 0
+
+
+def test_iter_unprocessed_id_ranges(app: Flask):
+    add_raw_views([f"10.0.0.{i}" for i in range(8)])
+    RawView.query.filter(RawView.id.in_([2, 3, 8])).update(
+        {"process_timestamp": datetime.now()}
+    )
+    db.session.commit()
+    assert list(iter_unprocessed_id_ranges(db.session, 2)) == [(1, 4), (5, 6), (7, 7)]
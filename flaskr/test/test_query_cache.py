@@ -0,0 +1,227 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import dataclasses as dc
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.testing import FlaskClient
+
+from flaskr.contracts.query_contract import QueryContract
+from flaskr.models.processed_view import ProcessedView
+from flaskr.processing.query_cache import QueryCache
+from flaskr.processing.query_result import QueryResult
+from flaskr.processing.query_runner import FilterBy, GroupBy, Query, run_query
+from flaskr.storage.database import db
+from flaskr.storage.view_change_storage import record_view_change
+from flaskr.test.conftest import make_auth_headers
+from flaskr.test.test_run_query import START_TIME, add_views, normalize
+
+# Not aligned to the rollups, which the tests don't maintain.
+QUERY_ARGS = {
+    "start_time": (START_TIME + timedelta(minutes=30)).isoformat(),
+    "end_time": (START_TIME + timedelta(days=1, minutes=30)).isoformat(),
+    "time_bucket": 3600,
+    "group_by": "Country",
+}
+
+
+def make_query(day: int) -> Query:
+    return Query(
+        START_TIME + timedelta(days=day),
+        START_TIME + timedelta(days=day + 1),
+        3600,
+        None,
+        None,
+    )
+
+
+def record_change(min_timestamp: datetime, max_timestamp: datetime):
+    record_view_change(db.session, min_timestamp, max_timestamp)
+    db.session.commit()
+
+
+def test_cache_normalizes_queries(app: Flask):
+    cache = QueryCache()
+    change_id = cache.sync(db.session)
+    cache.put(make_query(0), b"result", change_id)
+    query = make_query(0)
+    unset_query = Query(
+        query.start_time, query.end_time, 3600, GroupBy.Unset, FilterBy.Unset
+    )
+    assert cache.get(unset_query).body == b"result"
+    assert cache.get(query, "columnar") is None
+
+
+def test_cache_evicts_least_recently_used(app: Flask):
+    cache = QueryCache(max_entries=2, max_bytes=10)
+    change_id = cache.sync(db.session)
+    for day in range(3):
+        cache.put(make_query(day), b"abcd", change_id)
+        cache.get(make_query(0))
+    assert cache.get(make_query(0)) is not None
+    assert cache.get(make_query(1)) is None
+    assert cache.get(make_query(2)) is not None
+
+    # Too many bytes.
+    cache.put(make_query(3), b"abcdefg", change_id)
+    assert len(cache) == 1
+    assert cache.get(make_query(3)) is not None
+
+
+def test_cache_counts_the_size_of_kept_results(app: Flask):
+    query = make_query(0)
+    result = QueryResult(query.start_time, query.end_time, query.time_bucket)
+    result.add("Count", 0, 1)
+    # 24 buckets of 8 bytes.
+    assert result.nbytes == 192
+    cache = QueryCache(max_bytes=200)
+    change_id = cache.sync(db.session)
+    cache.put(query, b"abcd", change_id, result=result)
+    assert cache.get(query) is not None
+    cache.put(make_query(1), b"abcd", change_id, result=result)
+    assert cache.get(query) is None
+    assert len(cache) == 1
+    # Results that don't fit aren't cached at all.
+    cache.put(query, b"abcdefghi", change_id, result=result)
+    assert cache.get(query) is None
+
+
+def test_changes_invalidate_overlapping_results(app: Flask):
+    cache = QueryCache()
+    change_id = cache.sync(db.session)
+    for day in range(3):
+        cache.put(make_query(day), b"result", change_id)
+    record_change(
+        START_TIME + timedelta(days=1), START_TIME + timedelta(days=1, hours=2)
+    )
+    cache.sync(db.session)
+    assert cache.get(make_query(0)) is not None
+    assert cache.get(make_query(1)) is None
+    assert cache.get(make_query(2)) is not None
+
+    # A change covering all time.
+    record_change(None, None)
+    cache.sync(db.session)
+    assert len(cache) == 0
+
+
+def test_changes_keep_earlier_buckets_for_reuse(app: Flask):
+    cache = QueryCache()
+    change_id = cache.sync(db.session)
+    query = make_query(0)
+    result = QueryResult(query.start_time, query.end_time, query.time_bucket)
+    cache.put(query, b"result", change_id, result=result)
+    record_change(START_TIME + timedelta(hours=20, minutes=5), START_TIME)
+    cache.sync(db.session)
+    assert cache.get(query) is None
+
+    shifted = Query(
+        query.start_time + timedelta(hours=2),
+        query.end_time + timedelta(hours=2),
+        3600,
+        GroupBy.Unset,
+        None,
+    )
+    partial = cache.get_partial(shifted)
+    assert partial.result is result
+    assert partial.valid_until == START_TIME + timedelta(hours=20, minutes=5)
+    # Buckets that don't line up.
+    assert cache.get_partial(dc.replace(shifted, time_bucket=7200)) is None
+    assert (
+        cache.get_partial(
+            dc.replace(shifted, start_time=shifted.start_time + timedelta(minutes=1))
+        )
+        is None
+    )
+
+
+def test_result_computed_before_a_change_is_not_cached(app: Flask):
+    cache = QueryCache()
+    change_id = cache.sync(db.session)
+    record_change(START_TIME, START_TIME)
+    cache.sync(db.session)
+    cache.put(make_query(0), b"stale", change_id)
+    assert cache.get(make_query(0)) is None
+
+
+def test_query_endpoint_returns_304_until_data_changes(app: Flask, client: FlaskClient):
+    add_views(50)
+    res = client.get(
+        "/api/v1/data/query", query_string=QUERY_ARGS, headers=make_auth_headers()
+    )
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+    assert len(res.json["buckets"]) == 24
+
+    res = client.get(
+        "/api/v1/data/query",
+        query_string=QUERY_ARGS,
+        headers={**make_auth_headers(), "If-None-Match": etag},
+    )
+    assert res.status_code == 304
+    assert app.extensions["query_cache"].stats.memory_hits == 1
+
+    # Views outside of the queried range don't invalidate the result.
+    record_change(START_TIME + timedelta(days=2), START_TIME + timedelta(days=3))
+    res = client.get(
+        "/api/v1/data/query",
+        query_string=QUERY_ARGS,
+        headers={**make_auth_headers(), "If-None-Match": etag},
+    )
+    assert res.status_code == 304
+    assert app.extensions["query_cache"].stats.memory_hits == 2
+
+    add_views(60)
+    record_change(START_TIME, START_TIME + timedelta(days=3))
+    res = client.get(
+        "/api/v1/data/query",
+        query_string=QUERY_ARGS,
+        headers={**make_auth_headers(), "If-None-Match": etag},
+    )
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+
+
+def test_query_endpoint_reuses_earlier_buckets(app: Flask, client: FlaskClient):
+    add_views(50)
+    client.get(
+        "/api/v1/data/query", query_string=QUERY_ARGS, headers=make_auth_headers()
+    )
+    timestamp = START_TIME + timedelta(hours=21)
+    db.session.add(
+        ProcessedView(
+            url="https://www.stefanonsoftware.com/new",
+            ip_address="123.456.7890",
+            user_agent="pytest",
+            timestamp=timestamp,
+            process_timestamp=datetime.now(),
+            is_bot=False,
+            country="France",
+        )
+    )
+    record_change(timestamp, timestamp)
+    shifted_args = {
+        **QUERY_ARGS,
+        "start_time": (START_TIME + timedelta(hours=2, minutes=30)).isoformat(),
+        "end_time": (START_TIME + timedelta(days=1, hours=2, minutes=30)).isoformat(),
+    }
+    res = client.get(
+        "/api/v1/data/query", query_string=shifted_args, headers=make_auth_headers()
+    )
+    assert res.status_code == 200
+    assert "France" in res.json["all_keys"]
+
+    query = QueryContract.load(shifted_args).to_query()
+    expected = run_query(db.session, query).make_json()
+    assert normalize(res.json) == normalize(expected)
@@ -0,0 +1,66 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gzip
+import json
+from datetime import timedelta
+
+from flask import Flask
+from flask.testing import FlaskClient
+
+from flaskr.processing.query_result import QueryResult
+from flaskr.test.conftest import make_auth_headers
+from flaskr.test.test_query_cache import QUERY_ARGS
+from flaskr.test.test_run_query import START_TIME, add_views
+
+
+def test_columnar_json_matches_json():
+    result = QueryResult(START_TIME, START_TIME + timedelta(hours=3), 3600)
+    result.add("Germany", 0, 2)
+    result.add("France", 2, 1)
+    columnar = result.make_columnar_json()
+    assert columnar["start_time"] == START_TIME.isoformat()
+    assert columnar["time_bucket"] == 3600
+    assert columnar["num_buckets"] == 3
+    counts = dict(zip(columnar["all_keys"], columnar["counts"]))
+    assert counts == {"Germany": [2, 0, 0], "France": [0, 0, 1]}
+
+
+def test_query_endpoint_formats_and_compression(app: Flask, client: FlaskClient):
+    add_views(100)
+    res = client.get(
+        "/api/v1/data/query", query_string=QUERY_ARGS, headers=make_auth_headers()
+    )
+    assert res.status_code == 200
+    assert res.content_encoding is None
+    buckets = res.json["buckets"]
+
+    res = client.get(
+        "/api/v1/data/query",
+        query_string={**QUERY_ARGS, "format": "Columnar"},
+        headers={**make_auth_headers(), "Accept-Encoding": "gzip"},
+    )
+    assert res.status_code == 200
+    assert res.content_encoding == "gzip"
+    assert "Accept-Encoding" in res.vary
+    columnar = json.loads(gzip.decompress(res.data))
+    assert columnar["num_buckets"] == len(buckets)
+    for key, counts in zip(columnar["all_keys"], columnar["counts"]):
+        assert counts == [bucket["data"].get(key, 0) for bucket in buckets]
+
+    res = client.get(
+        "/api/v1/data/query",
+        query_string={**QUERY_ARGS, "format": "Tabular"},
+        headers=make_auth_headers(),
+    )
+    assert res.status_code == 400
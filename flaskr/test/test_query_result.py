@@ -0,0 +1,49 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import datetime, timedelta
+
+import pytest
+
+from flaskr.processing.query_result import QueryResult
+
+START_TIME = datetime(2023, 1, 1)
+
+
+def test_add_counts_matches_add():
+    rows = [("Germany", 0, 2), ("France", 2, 1), ("Germany", 0, 3), ("Spain", 1, 4)]
+    added = QueryResult(START_TIME, START_TIME + timedelta(hours=3), 3600)
+    for key, bucket_index, count in rows:
+        added.add(key, bucket_index, count)
+    batched = QueryResult(START_TIME, START_TIME + timedelta(hours=3), 3600)
+    batched.add_counts(rows)
+    assert batched.make_json() == added.make_json()
+    assert batched.make_json() == {
+        "all_keys": ["Germany", "France", "Spain"],
+        "buckets": [
+            {"timestamp": "2023-01-01T00:00:00", "data": {"Germany": 5}},
+            {"timestamp": "2023-01-01T01:00:00", "data": {"Spain": 4}},
+            {"timestamp": "2023-01-01T02:00:00", "data": {"France": 1}},
+        ],
+    }
+
+
+def test_increment_buckets_by_timestamp():
+    result = QueryResult(START_TIME, START_TIME + timedelta(hours=2), 3600)
+    result.increment("Count", START_TIME + timedelta(minutes=59, seconds=59))
+    result.increment("Count", START_TIME + timedelta(hours=1))
+    assert result.make_columnar_json()["counts"] == [[1, 1]]
+    with pytest.raises(ValueError):
+        result.increment("Count", START_TIME - timedelta(microseconds=1))
+    with pytest.raises(ValueError):
+        result.add_counts([("Count", 2, 1)])
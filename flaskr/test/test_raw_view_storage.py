@@ -51,6 +51,7 @@ def test_storage_writes_log_file(app: Flask):
         for i in range(10)
     ]
     write_raw_views(views)
+    app.extensions["backup_log"].flush()
     with open(app.config["LOG_PATH"], newline="") as log_file:
         reader = csv.reader(log_file)
         for i, row in enumerate(reader):
@@ -0,0 +1,71 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+from marshmallow import ValidationError
+
+from flaskr.contracts.report_traffic import ReportTrafficContract
+
+VIEW = {
+    "url": "https://www.stefanonsoftware.com/",
+    "ip_address": "123.456.7890",
+    "user_agent": "Pytest",
+    "timestamp": "2023-01-01T12:34:56.789012",
+}
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"traffic": [VIEW, VIEW]},
+        {"traffic": []},
+        {},
+        {"traffic": [{**VIEW, "timestamp": "2023-01-01T12:34:56"}]},
+        {"traffic": [{**VIEW, "timestamp": "2023-01-01 12:34:56.789"}]},
+        {"traffic": [{**VIEW, "timestamp": "2023-01-01T12:34:56+05:30"}]},
+        {"traffic": [{**VIEW, "timestamp": "2023-01-01T12:34:56Z"}]},
+        {"traffic": [{**VIEW, "timestamp": "2023-1-1T1:2"}]},
+        {"traffic": [{**VIEW, "timestamp": "2023-01-01T12:34:56.78"}]},
+        {"traffic": [{**VIEW, "url": ""}]},
+    ],
+)
+def test_fast_load_matches_load(data: dict):
+    assert ReportTrafficContract.fast_load(data) == ReportTrafficContract.load(data)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        [],
+        None,
+        {"traffic": None},
+        {"traffic": "views"},
+        {"traffic": [VIEW], "extra": 1},
+        {"traffic": [VIEW, None, 3]},
+        {"traffic": [VIEW, {**VIEW, "extra": 1}]},
+        {"traffic": [{"url": VIEW["url"]}, {**VIEW, "url": None}]},
+        {"traffic": [{**VIEW, "ip_address": 1234, "user_agent": ["Pytest"]}]},
+        {"traffic": [{**VIEW, "timestamp": ""}]},
+        {"traffic": [{**VIEW, "timestamp": "2023-13-01T00:00:00"}]},
+        {"traffic": [{**VIEW, "timestamp": "2023-01-01"}]},
+        {"traffic": [{**VIEW, "timestamp": "2023-01-01X12:00:00"}]},
+        {"traffic": [{**VIEW, "timestamp": 1672531200}]},
+    ],
+)
+def test_fast_load_errors_match_load(data):
+    with pytest.raises(ValidationError) as expected:
+        ReportTrafficContract.load(data)
+    with pytest.raises(ValidationError) as actual:
+        ReportTrafficContract.fast_load(data)
+    assert actual.value.messages == expected.value.messages
+    assert str(actual.value) == str(expected.value)
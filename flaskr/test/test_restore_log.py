@@ -0,0 +1,124 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gzip
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.testing import FlaskCliRunner
+
+from flaskr.models.processed_view import ProcessedView
+from flaskr.models.raw_view import RawView
+from flaskr.storage.database import db
+from flaskr.storage.raw_view_storage import write_raw_views
+
+START_TIME = datetime(2023, 1, 1)
+
+
+def make_views(num_views: int):
+    return [
+        RawView(
+            url=f"https://www.stefanonsoftware.com/{i}",
+            ip_address=f"123.456.7890-{i}",
+            user_agent=f"pytest, {i}",
+            timestamp=START_TIME + timedelta(hours=i, microseconds=i),
+        )
+        for i in range(num_views)
+    ]
+
+
+def delete_raw_views():
+    RawView.query.delete()
+    db.session.commit()
+
+
+def get_stored_keys() -> list:
+    return sorted(
+        (view.timestamp, view.url, view.ip_address, view.user_agent)
+        for view in RawView.query.all()
+    )
+
+
+def test_restore_log_restores_deleted_views(app: Flask, runner: FlaskCliRunner):
+    write_raw_views(make_views(10))
+    expected = get_stored_keys()
+    delete_raw_views()
+
+    res = runner.invoke(args=["restore-log", "--chunk_size=3"])
+    assert res.exit_code == 0
+    assert "Restored 10 of 10 records." in res.output
+    assert get_stored_keys() == expected
+    assert all(view.process_timestamp is None for view in RawView.query.all())
+
+
+def test_restore_log_skips_stored_views(app: Flask, runner: FlaskCliRunner):
+    write_raw_views(make_views(10))
+    RawView.query.filter(RawView.timestamp >= START_TIME + timedelta(hours=5)).delete()
+    db.session.commit()
+
+    res = runner.invoke(args=["restore-log", "--chunk_size=4"])
+    assert res.exit_code == 0
+    assert "Restored 5 of 10 records." in res.output
+    assert RawView.query.count() == 10
+
+
+def test_restore_log_skips_processed_views(app: Flask, runner: FlaskCliRunner):
+    write_raw_views(make_views(10))
+    # Garbage collection deleted the raw views that were already processed.
+    for view in RawView.query.filter(
+        RawView.timestamp < START_TIME + timedelta(hours=6)
+    ):
+        db.session.add(
+            ProcessedView(
+                url=view.url,
+                ip_address=view.ip_address,
+                user_agent=view.user_agent,
+                timestamp=view.timestamp,
+                process_timestamp=datetime.now(),
+            )
+        )
+    delete_raw_views()
+
+    res = runner.invoke(args=["restore-log"])
+    assert res.exit_code == 0
+    assert "Restored 4 of 10 records." in res.output
+    assert RawView.query.count() == 4
+
+
+def test_restore_log_filters_by_time(app: Flask, runner: FlaskCliRunner):
+    write_raw_views(make_views(10))
+    delete_raw_views()
+
+    res = runner.invoke(
+        args=[
+            "restore-log",
+            "--start=2023-01-01 02:00:00",
+            "--end=2023-01-01 05:00:00",
+        ]
+    )
+    assert res.exit_code == 0
+    views = RawView.query.order_by(RawView.timestamp).all()
+    assert [view.url[-1] for view in views] == ["2", "3", "4"]
+
+
+def test_restore_log_reads_rotated_segments(app: Flask, runner: FlaskCliRunner):
+    with gzip.open(app.config["LOG_PATH"] + ".20230101-000000.gz", "wt") as f:
+        f.write("2022-12-31T00:00:00,/old,1.2.3.4,pytest\r\n")
+        f.write("not a timestamp,/old,1.2.3.4,pytest\r\n")
+    write_raw_views(make_views(1))
+    delete_raw_views()
+
+    res = runner.invoke(args=["restore-log"])
+    assert res.exit_code == 0
+    assert "Restored 2 of 3 records." in res.output
+    assert RawView.query.order_by(RawView.timestamp).first().url == "/old"
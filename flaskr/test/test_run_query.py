@@ -0,0 +1,438 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from dataclasses import replace
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+import pytest
+from flask import Flask
+
+from flaskr.models.processed_view import ProcessedView
+from flaskr.models.view_rollup import ViewRollup
+from flaskr.processing import query_runner
+from flaskr.processing.query_result import OTHER_KEY, PartialResult, QueryResult
+from flaskr.processing.query_runner import (
+    FilterBy,
+    GroupBy,
+    Metric,
+    Query,
+    QueryEngine,
+    can_use_rollups,
+    run_queries,
+    run_query,
+)
+from flaskr.processing.rollups import RollupAccumulator, rebuild_rollups
+from flaskr.storage.database import db
+
+START_TIME = datetime(2023, 1, 1)
+COUNTRIES = ["Germany", "United States", None]
+
+
+def add_views(num_views: int):
+    """Adds `num_views` processed views, spread across three days."""
+    for i in range(num_views):
+        db.session.add(
+            ProcessedView(
+                url=f"https://www.stefanonsoftware.com/{i % 4}",
+                ip_address="123.456.7890",
+                user_agent="pytest",
+                timestamp=START_TIME + timedelta(minutes=37 * i, microseconds=i),
+                process_timestamp=datetime.now(),
+                is_bot=(i % 5 == 0),
+                country=COUNTRIES[i % len(COUNTRIES)],
+            )
+        )
+    db.session.commit()
+
+
+def add_visitors(num_views: int, num_visitors: int):
+    """Adds `num_views` processed views by `num_visitors` visitors."""
+    for i in range(num_views):
+        db.session.add(
+            ProcessedView(
+                url=f"https://www.stefanonsoftware.com/{i % 4}",
+                ip_address=f"10.0.{i % num_visitors // 256}.{i % num_visitors % 256}",
+                user_agent="pytest",
+                timestamp=START_TIME + timedelta(seconds=97 * i),
+                process_timestamp=datetime.now(),
+                is_bot=(i % 5 == 0),
+                country=COUNTRIES[i % len(COUNTRIES)],
+            )
+        )
+    db.session.commit()
+
+
+def get_counts(result: QueryResult) -> dict:
+    """Returns the counts of each key in `result`."""
+    return dict(zip(*itemgetter("all_keys", "counts")(result.make_columnar_json())))
+
+
+def normalize(result: dict) -> dict:
+    """Sorts `all_keys` so that results can be compared."""
+    return {"all_keys": sorted(result["all_keys"]), "buckets": result["buckets"]}
+
+
+@pytest.mark.parametrize(
+    "group_by", [None, GroupBy.Country, GroupBy.Url, GroupBy.Browser]
+)
+@pytest.mark.parametrize("filter_by", [None, FilterBy.Humans, FilterBy.Bots])
+@pytest.mark.parametrize("time_bucket", [3600, 7 * 3600, 86400])
+def test_sql_engine_matches_python_engine(
+    app: Flask, group_by: GroupBy, filter_by: FilterBy, time_bucket: int
+):
+    add_views(200)
+    query = Query(
+        START_TIME + timedelta(minutes=30),
+        START_TIME + timedelta(days=3),
+        time_bucket,
+        group_by,
+        filter_by,
+    )
+    python_result = run_query(db.session, query, QueryEngine.Python)
+    sql_result = run_query(db.session, query, QueryEngine.Sql)
+    assert normalize(sql_result.make_json()) == normalize(python_result.make_json())
+
+
+def test_sql_engine_counts(app: Flask):
+    add_views(200)
+    query = Query(START_TIME, START_TIME + timedelta(days=2), 86400, None, None)
+    result = run_query(db.session, query, QueryEngine.Sql).make_json()
+    assert result["all_keys"] == ["Count"]
+    # One view is added every 37 minutes.
+    assert result["buckets"][0]["data"] == {"Count": 39}
+    assert result["buckets"][1]["data"] == {"Count": 39}
+
+
+def test_view_at_end_time_is_excluded(app: Flask):
+    add_views(1)
+    query = Query(START_TIME - timedelta(days=1), START_TIME, 3600, None, None)
+    for engine in QueryEngine:
+        assert run_query(db.session, query, engine).make_json()["all_keys"] == []
+
+
+@pytest.mark.parametrize(
+    "group_by", [None, GroupBy.Country, GroupBy.Url, GroupBy.Browser]
+)
+@pytest.mark.parametrize("filter_by", [None, FilterBy.Humans, FilterBy.Bots])
+@pytest.mark.parametrize("time_bucket", [3600, 7 * 3600, 86400])
+def test_rollup_engine_matches_python_engine(
+    app: Flask, group_by: GroupBy, filter_by: FilterBy, time_bucket: int
+):
+    add_views(200)
+    rollups = RollupAccumulator()
+    for view in ProcessedView.query.all():
+        rollups.add(view)
+    rollups.flush(db.session)
+    db.session.commit()
+
+    query = Query(
+        START_TIME + timedelta(hours=1),
+        START_TIME + timedelta(days=3),
+        time_bucket,
+        group_by,
+        filter_by,
+    )
+    python_result = run_query(db.session, query, QueryEngine.Python)
+    rollup_result = run_query(db.session, query, QueryEngine.Rollup)
+    assert normalize(rollup_result.make_json()) == normalize(python_result.make_json())
+
+
+def test_rebuild_rollups_matches_accumulator(app: Flask):
+    add_views(200)
+    rollups = RollupAccumulator()
+    # Flush in two batches to exercise incrementing existing rollups.
+    for i, view in enumerate(ProcessedView.query.all()):
+        rollups.add(view)
+        if i == 100:
+            rollups.flush(db.session)
+    rollups.flush(db.session)
+    db.session.commit()
+    accumulated = {
+        (r.bucket_start, r.group_by, r.group_key, r.is_bot): r.count
+        for r in ViewRollup.query.all()
+    }
+
+    rebuild_rollups(db.session)
+    db.session.commit()
+    rebuilt = {
+        (r.bucket_start, r.group_by, r.group_key, r.is_bot): r.count
+        for r in ViewRollup.query.all()
+    }
+    assert rebuilt == accumulated
+
+
+@pytest.mark.parametrize("engine", [QueryEngine.Python, QueryEngine.Sql])
+def test_previous_result_is_reused(app: Flask, engine: QueryEngine):
+    add_views(200)
+    start_time = START_TIME + timedelta(minutes=30)
+    query = Query(start_time, start_time + timedelta(days=1), 3600, None, None)
+    previous = run_query(db.session, query, engine)
+
+    # Shift the window by three buckets.
+    query = Query(
+        start_time + timedelta(hours=3),
+        start_time + timedelta(days=1, hours=3),
+        3600,
+        None,
+        None,
+    )
+    expected = run_query(db.session, query, engine).make_json()
+    valid_until = start_time + timedelta(hours=12, minutes=30)
+    result = run_query(
+        db.session, query, engine, PartialResult(previous, valid_until, 0)
+    ).make_json()
+    assert result == expected
+
+    # Buckets that are up to date aren't queried again.
+    ProcessedView.query.delete()
+    result = run_query(
+        db.session, query, engine, PartialResult(previous, valid_until, 0)
+    ).make_json()
+    assert result["buckets"][:9] == expected["buckets"][:9]
+    assert all(not bucket["data"] for bucket in result["buckets"][9:])
+
+
+def test_previous_result_on_another_grid_is_ignored(app: Flask):
+    add_views(200)
+    query = Query(START_TIME, START_TIME + timedelta(days=1), 3600, None, None)
+    previous = run_query(db.session, query)
+    query = Query(
+        START_TIME + timedelta(minutes=30),
+        START_TIME + timedelta(days=1, minutes=30),
+        3600,
+        None,
+        None,
+    )
+    result = run_query(
+        db.session, query, previous=PartialResult(previous, query.end_time, 0)
+    )
+    assert result.make_json() == run_query(db.session, query).make_json()
+
+
+@pytest.mark.parametrize("engine", list(QueryEngine))
+def test_batched_queries_match_single_queries(app: Flask, engine: QueryEngine):
+    add_views(200)
+    rebuild_rollups(db.session)
+    db.session.commit()
+    start_time = START_TIME + timedelta(hours=1)
+    end_time = START_TIME + timedelta(days=3)
+    queries = [
+        Query(start_time, end_time, time_bucket, group_by, FilterBy.Humans)
+        for time_bucket, group_by in [
+            (3600, GroupBy.Country),
+            (86400, GroupBy.Country),
+            (7 * 3600, GroupBy.Browser),
+            (86400, None),
+        ]
+    ]
+    results = run_queries(db.session, queries, engine)
+    assert len(results) == len(queries)
+    for query, result in zip(queries, results):
+        expected = run_query(db.session, query, QueryEngine.Python)
+        assert normalize(result.make_json()) == normalize(expected.make_json())
+
+
+def test_batched_queries_on_a_fine_grid_are_scanned_separately(
+    app: Flask, monkeypatch: pytest.MonkeyPatch
+):
+    add_views(200)
+    batch_sizes = []
+    run_sql_query = query_runner._run_sql_query
+
+    def record_batch(session, queries, results):
+        batch_sizes.append(len(queries))
+        run_sql_query(session, queries, results)
+
+    monkeypatch.setattr(query_runner, "_run_sql_query", record_batch)
+    start_time = START_TIME + timedelta(minutes=30)
+    end_time = START_TIME + timedelta(days=3)
+    # The buckets only line up every second, which would be too many.
+    queries = [
+        Query(start_time, end_time, 3600, GroupBy.Country, None),
+        Query(start_time, end_time, 3601, GroupBy.Country, None),
+        Query(start_time, end_time, 7200, None, None),
+    ]
+    results = run_queries(db.session, queries, QueryEngine.Sql)
+    assert batch_sizes == [2, 1]
+    for query, result in zip(queries, results):
+        expected = run_query(db.session, query, QueryEngine.Python)
+        assert normalize(result.make_json()) == normalize(expected.make_json())
+
+
+def test_batched_queries_must_share_time_range_and_filter(app: Flask):
+    query = Query(START_TIME, START_TIME + timedelta(days=1), 3600, None, None)
+    with pytest.raises(ValueError):
+        run_queries(
+            db.session, [query, Query(START_TIME, START_TIME, 3600, None, None)]
+        )
+    with pytest.raises(ValueError):
+        run_queries(
+            db.session,
+            [query, Query(query.start_time, query.end_time, 3600, None, FilterBy.Bots)],
+        )
+
+
+@pytest.mark.parametrize("engine", list(QueryEngine))
+@pytest.mark.parametrize("top_n", [1, 3, 10])
+def test_top_n_keeps_the_keys_with_the_highest_counts(
+    app: Flask, engine: QueryEngine, top_n: int
+):
+    add_views(200)
+    add_views(100)
+    rebuild_rollups(db.session)
+    db.session.commit()
+    query = Query(
+        START_TIME + timedelta(hours=1),
+        START_TIME + timedelta(days=3),
+        3600,
+        GroupBy.Url,
+        None,
+    )
+    full = run_query(db.session, query, QueryEngine.Python).make_columnar_json()
+    full_counts = dict(zip(full["all_keys"], full["counts"]))
+    result = run_query(db.session, replace(query, top_n=top_n), engine)
+    counts = dict(zip(*itemgetter("all_keys", "counts")(result.make_columnar_json())))
+
+    top_keys = sorted(full_counts, key=lambda key: (-sum(full_counts[key]), key))
+    expected_keys = set(top_keys[:top_n])
+    if len(full_counts) > top_n:
+        expected_keys.add(OTHER_KEY)
+    assert set(counts) == expected_keys
+    for key in set(counts) - {OTHER_KEY}:
+        assert counts[key] == full_counts[key]
+    # Nothing is lost.
+    assert [sum(c) for c in zip(*counts.values())] == [
+        sum(c) for c in zip(*full_counts.values())
+    ]
+
+
+@pytest.mark.parametrize("group_by", [None, GroupBy.Country, GroupBy.Url])
+@pytest.mark.parametrize("filter_by", [None, FilterBy.Humans])
+@pytest.mark.parametrize("time_bucket", [3600, 86400])
+def test_unique_visitors_engines_agree(
+    app: Flask, group_by: GroupBy, filter_by: FilterBy, time_bucket: int
+):
+    add_visitors(3000, 700)
+    rollups = RollupAccumulator()
+    # Flush in two batches to exercise merging into stored sketches.
+    for i, view in enumerate(ProcessedView.query.all()):
+        rollups.add(view)
+        if i == 1000:
+            rollups.flush(db.session)
+    rollups.flush(db.session)
+    db.session.commit()
+    query = Query(
+        START_TIME,
+        START_TIME + timedelta(days=4),
+        time_bucket,
+        group_by,
+        filter_by,
+        metric=Metric.UniqueVisitors,
+    )
+    counts = get_counts(run_query(db.session, query, QueryEngine.Python))
+    assert get_counts(run_query(db.session, query, QueryEngine.Sql)) == counts
+    rollup_counts = get_counts(run_query(db.session, query, QueryEngine.Rollup))
+    assert set(rollup_counts) == set(counts)
+    for key, key_counts in counts.items():
+        assert rollup_counts[key] == pytest.approx(key_counts, rel=0.05, abs=1)
+    # Distinct visitors aren't the number of views.
+    assert max(max(c) for c in counts.values()) <= 700
+
+
+def test_rebuilt_visitor_sketches_match_accumulator(app: Flask):
+    add_visitors(2000, 300)
+    rollups = RollupAccumulator()
+    for view in ProcessedView.query.all():
+        rollups.add(view)
+    rollups.flush(db.session)
+    db.session.commit()
+    query = Query(
+        START_TIME,
+        START_TIME + timedelta(days=2),
+        86400,
+        GroupBy.Country,
+        None,
+        metric=Metric.UniqueVisitors,
+    )
+    accumulated = run_query(db.session, query, QueryEngine.Rollup).make_json()
+
+    rebuild_rollups(db.session)
+    db.session.commit()
+    assert run_query(db.session, query, QueryEngine.Rollup).make_json() == accumulated
+
+
+def test_batched_queries_mix_metrics(app: Flask):
+    add_visitors(1000, 100)
+    start_time = START_TIME + timedelta(minutes=30)
+    end_time = START_TIME + timedelta(days=2)
+    queries = [
+        Query(start_time, end_time, 3600, GroupBy.Country, None),
+        Query(
+            start_time,
+            end_time,
+            86400,
+            GroupBy.Url,
+            None,
+            metric=Metric.UniqueVisitors,
+        ),
+        Query(start_time, end_time, 86400, None, None),
+    ]
+    results = run_queries(db.session, queries)
+    for query, result in zip(queries, results):
+        expected = run_query(db.session, query, QueryEngine.Python)
+        assert normalize(result.make_json()) == normalize(expected.make_json())
+
+
+def test_unique_visitors_rejects_top_n(app: Flask):
+    query = Query(
+        START_TIME,
+        START_TIME + timedelta(days=1),
+        3600,
+        GroupBy.Url,
+        None,
+        top_n=3,
+        metric=Metric.UniqueVisitors,
+    )
+    with pytest.raises(ValueError):
+        run_query(db.session, query)
+
+
+def test_can_use_rollups():
+    assert can_use_rollups(
+        Query(START_TIME, START_TIME + timedelta(days=1), 7200, None, None)
+    )
+    # Bucket size is not a multiple of an hour.
+    assert not can_use_rollups(
+        Query(START_TIME, START_TIME + timedelta(days=1), 1800, None, None)
+    )
+    # Time range does not start on the hour.
+    assert not can_use_rollups(
+        Query(
+            START_TIME + timedelta(minutes=1),
+            START_TIME + timedelta(days=1),
+            3600,
+            None,
+            None,
+        )
+    )
+    # Time range does not end on the hour.
+    assert not can_use_rollups(
+        Query(
+            START_TIME,
+            START_TIME + timedelta(days=1, microseconds=1),
+            3600,
+            None,
+            None,
+        )
+    )
@@ -0,0 +1,59 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import tempfile
+
+import pytest
+import sqlalchemy as sqla
+from flask import Flask
+
+from flaskr import create_app
+from flaskr.config import SiteConfig
+from flaskr.storage.database import db
+
+
+def get_pragma(name: str):
+    return db.session.execute(sqla.text(f"PRAGMA {name}")).scalar()
+
+
+def test_default_pragmas_are_applied(app: Flask):
+    assert get_pragma("journal_mode") == "wal"
+    # NORMAL
+    assert get_pragma("synchronous") == 1
+    assert get_pragma("busy_timeout") == 5000
+    assert get_pragma("cache_size") == -64 * 1024
+
+
+def test_pragmas_are_configurable():
+    with tempfile.TemporaryDirectory() as tempdir:
+        app = create_app(
+            test_config=SiteConfig(
+                "dev",
+                tempdir,
+                sqlite_journal_mode="delete",
+                sqlite_synchronous="full",
+                sqlite_busy_timeout_ms=100,
+            )
+        )
+        with app.app_context():
+            assert get_pragma("journal_mode") == "delete"
+            # FULL
+            assert get_pragma("synchronous") == 2
+            assert get_pragma("busy_timeout") == 100
+            db.session.close()
+            db.engine.dispose()
+
+
+def test_invalid_journal_mode_is_rejected():
+    with pytest.raises(ValueError):
+        create_app(test_config=SiteConfig("dev", "/tmp", sqlite_journal_mode="fast"))
@@ -11,15 +11,37 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import gzip
+import json
 from datetime import datetime
 
+import pytest
+import sqlalchemy as sqla
+from flask import Flask
 from flask.testing import FlaskClient
 
-from flaskr.api.traffic_api import MAX_ALLOWED_VIEWS_PER_REQUEST
+from flaskr.api import traffic_api
+from flaskr.api.traffic_api import (
+    COLUMNAR_CONTENT_TYPE,
+    MAX_DECOMPRESSED_BYTES_PER_VIEW,
+    MAX_NDJSON_LINE_BYTES,
+    MIN_DECOMPRESSED_BYTES,
+    NDJSON_CONTENT_TYPE,
+)
+from flaskr.contracts.report_traffic import ReportTrafficContract
 from flaskr.models.raw_view import RawView
 from flaskr.test.conftest import make_auth_headers
 
 
+@pytest.fixture(autouse=True, params=["fast", "marshmallow"])
+def contract_loader(request, monkeypatch: pytest.MonkeyPatch):
+    """Runs each test with both the fast and the marshmallow validation."""
+    if request.param == "marshmallow":
+        monkeypatch.setattr(
+            ReportTrafficContract, "fast_load", ReportTrafficContract.load
+        )
+
+
 def test_report_traffic_success(client: FlaskClient):
     curr_time = datetime.now()
     res = client.post(
@@ -78,12 +100,33 @@ def test_report_traffic_fails_when_empty(client: FlaskClient):
     assert res.status == "400 BAD REQUEST"
 
 
-def test_report_traffic_fails_when_too_large(client: FlaskClient):
+def test_report_traffic_fails_when_missing(client: FlaskClient):
+    res = client.post("/api/v1/traffic", json={}, headers=make_auth_headers())
+    assert res.text == "The request did not contain any traffic records."
+    assert res.status == "400 BAD REQUEST"
+
+
+def test_report_traffic_fails_when_invalid(client: FlaskClient):
+    res = client.post(
+        "/api/v1/traffic",
+        json={"traffic": [{"url": "https://www.stefanonsoftware.com/"}]},
+        headers=make_auth_headers(),
+    )
+    assert res.text == (
+        "Invalid parameters: {'traffic': {0: {"
+        "'ip_address': ['Missing data for required field.'], "
+        "'user_agent': ['Missing data for required field.'], "
+        "'timestamp': ['Missing data for required field.']}}}"
+    )
+    assert res.status == "400 BAD REQUEST"
+
+
+def test_report_traffic_fails_when_too_large(app: Flask, client: FlaskClient):
     curr_time = datetime.now()
     res = client.post(
         "/api/v1/traffic",
         json={
-            "traffic": (MAX_ALLOWED_VIEWS_PER_REQUEST + 1)
+            "traffic": (app.config["MAX_VIEWS_PER_REQUEST"] + 1)
             * [
                 {
                     "url": "https://www.stefanonsoftware.com/test-1",
@@ -115,3 +158,219 @@ def test_report_traffic_fails_when_unauthorized(client: FlaskClient):
         headers={},
     )
     assert res.status == "401 UNAUTHORIZED"
+
+
+def make_traffic_body(num_views: int) -> dict:
+    return {
+        "traffic": [
+            {
+                "url": "https://www.stefanonsoftware.com/a",
+                "ip_address": f"123.456.7890-{i}",
+                "user_agent": "Pytest",
+                "timestamp": datetime(2023, 1, 1, i).isoformat(),
+            }
+            for i in range(num_views)
+        ]
+    }
+
+
+def make_columnar_body(num_views: int) -> dict:
+    return {
+        "urls": [
+            "https://www.stefanonsoftware.com/a",
+            "https://www.stefanonsoftware.com/b",
+        ],
+        "user_agents": ["Pytest"],
+        "url": [i % 2 for i in range(num_views)],
+        "user_agent": [0] * num_views,
+        "ip_address": [f"123.456.7890-{i}" for i in range(num_views)],
+        "timestamp": [datetime(2023, 1, 1, i).isoformat() for i in range(num_views)],
+    }
+
+
+def test_report_traffic_columnar(client: FlaskClient):
+    res = client.post(
+        "/api/v1/traffic",
+        data=json.dumps(make_columnar_body(3)),
+        headers={**make_auth_headers(), "Content-Type": COLUMNAR_CONTENT_TYPE},
+    )
+    assert res.status == "200 OK"
+    raw_views = RawView.query.order_by(RawView.timestamp).all()
+    assert [view.url[-1] for view in raw_views] == ["a", "b", "a"]
+    assert [view.ip_address[-1] for view in raw_views] == ["0", "1", "2"]
+    assert all(view.user_agent == "Pytest" for view in raw_views)
+    assert raw_views[2].timestamp == datetime(2023, 1, 1, 2)
+
+
+@pytest.mark.parametrize(
+    "column, values",
+    [("url", [0, 2, 0]), ("user_agent", [0, -1, 0]), ("ip_address", ["1.2.3.4"])],
+)
+def test_report_traffic_columnar_fails_when_invalid(
+    client: FlaskClient, column: str, values: list
+):
+    body = make_columnar_body(3)
+    body[column] = values
+    res = client.post(
+        "/api/v1/traffic",
+        data=json.dumps(body),
+        headers={**make_auth_headers(), "Content-Type": COLUMNAR_CONTENT_TYPE},
+    )
+    assert res.status == "400 BAD REQUEST"
+    assert column in res.text
+    assert RawView.query.count() == 0
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_report_traffic_gzip(client: FlaskClient, columnar: bool):
+    if columnar:
+        body, content_type = make_columnar_body(3), COLUMNAR_CONTENT_TYPE
+    else:
+        body, content_type = make_traffic_body(3), "application/json"
+    res = client.post(
+        "/api/v1/traffic",
+        data=gzip.compress(json.dumps(body).encode()),
+        headers={
+            **make_auth_headers(),
+            "Content-Type": content_type,
+            "Content-Encoding": "gzip",
+        },
+    )
+    assert res.status == "200 OK"
+    assert RawView.query.count() == 3
+
+
+def test_report_traffic_gzip_fails_when_too_large(client: FlaskClient):
+    # Compresses to a few KiB.
+    body = json.dumps({"traffic": [], "padding": " " * (MIN_DECOMPRESSED_BYTES + 1)})
+    res = client.post(
+        "/api/v1/traffic",
+        data=gzip.compress(body.encode()),
+        headers={
+            **make_auth_headers(),
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        },
+    )
+    assert res.status == "413 REQUEST ENTITY TOO LARGE"
+
+
+def test_report_traffic_gzip_limit_grows_with_max_views(
+    app: Flask, client: FlaskClient
+):
+    app.config["MAX_VIEWS_PER_REQUEST"] = 2000
+    # Trailing whitespace is valid JSON, and compresses to a few KiB.
+    body = json.dumps(make_traffic_body(3)) + " " * MIN_DECOMPRESSED_BYTES
+    headers = {
+        **make_auth_headers(),
+        "Content-Type": "application/json",
+        "Content-Encoding": "gzip",
+    }
+    res = client.post(
+        "/api/v1/traffic", data=gzip.compress(body.encode()), headers=headers
+    )
+    assert res.status == "200 OK"
+    assert RawView.query.count() == 3
+
+    body += " " * (2000 * MAX_DECOMPRESSED_BYTES_PER_VIEW)
+    res = client.post(
+        "/api/v1/traffic", data=gzip.compress(body.encode()), headers=headers
+    )
+    assert res.status == "413 REQUEST ENTITY TOO LARGE"
+
+
+def test_report_traffic_fails_with_unknown_encoding(client: FlaskClient):
+    res = client.post(
+        "/api/v1/traffic",
+        data=json.dumps(make_traffic_body(1)),
+        headers={
+            **make_auth_headers(),
+            "Content-Type": "application/json",
+            "Content-Encoding": "br",
+        },
+    )
+    assert res.status == "415 UNSUPPORTED MEDIA TYPE"
+
+
+def make_ndjson_body(num_views: int) -> bytes:
+    return "\n".join(
+        json.dumps(view) for view in make_traffic_body(num_views)["traffic"]
+    ).encode()
+
+
+def post_ndjson(client: FlaskClient, body: bytes, use_gzip: bool = False):
+    headers = {**make_auth_headers(), "Content-Type": NDJSON_CONTENT_TYPE}
+    if use_gzip:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    return client.post("/api/v1/traffic", data=body, headers=headers)
+
+
+@pytest.mark.parametrize("use_gzip", [False, True])
+def test_report_traffic_ndjson(
+    app: Flask, client: FlaskClient, monkeypatch: pytest.MonkeyPatch, use_gzip: bool
+):
+    # Exercise writing several chunks.
+    monkeypatch.setattr(traffic_api, "NDJSON_WRITE_CHUNK_SIZE", 7)
+    app.config["MAX_VIEWS_PER_REQUEST"] = 20
+    res = post_ndjson(client, make_ndjson_body(20) + b"\n\n", use_gzip)
+    assert res.status == "200 OK"
+    raw_views = RawView.query.order_by(RawView.timestamp).all()
+    assert len(raw_views) == 20
+    assert raw_views[19].timestamp == datetime(2023, 1, 1, 19)
+
+
+def test_report_traffic_ndjson_stores_nothing_when_a_chunk_fails(
+    app: Flask, client: FlaskClient, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(traffic_api, "NDJSON_WRITE_CHUNK_SIZE", 7)
+    app.config["MAX_VIEWS_PER_REQUEST"] = 20
+    insert_raw_views = traffic_api.insert_raw_views
+    num_chunks = 0
+
+    def insert_or_fail(views):
+        nonlocal num_chunks
+        num_chunks += 1
+        if num_chunks == 3:
+            raise sqla.exc.OperationalError("INSERT", None, Exception("disk I/O error"))
+        insert_raw_views(views)
+
+    monkeypatch.setattr(traffic_api, "insert_raw_views", insert_or_fail)
+    res = post_ndjson(client, make_ndjson_body(20))
+    assert res.status == "500 INTERNAL SERVER ERROR"
+    assert RawView.query.count() == 0
+
+    # A retry stores every view exactly once.
+    monkeypatch.setattr(traffic_api, "insert_raw_views", insert_raw_views)
+    res = post_ndjson(client, make_ndjson_body(20))
+    assert res.status == "200 OK"
+    assert RawView.query.count() == 20
+
+
+def test_report_traffic_ndjson_fails_when_invalid(client: FlaskClient):
+    body = make_ndjson_body(3) + b'\n{"url": "https://www.stefanonsoftware.com/"}'
+    res = post_ndjson(client, body)
+    assert res.status == "400 BAD REQUEST"
+    assert res.text.startswith("Invalid parameters: {'traffic': {3: {'ip_address'")
+    assert RawView.query.count() == 0
+
+    res = post_ndjson(client, make_ndjson_body(3) + b"\n{")
+    assert res.status == "400 BAD REQUEST"
+    assert res.text.startswith("Invalid JSON for view 3")
+
+
+def test_report_traffic_ndjson_fails_when_too_large(app: Flask, client: FlaskClient):
+    app.config["MAX_VIEWS_PER_REQUEST"] = 5
+    res = post_ndjson(client, make_ndjson_body(6))
+    assert res.status == "400 BAD REQUEST"
+    assert "Too many traffic records" in res.text
+    assert RawView.query.count() == 0
+
+    res = post_ndjson(client, b"[" + b" " * MAX_NDJSON_LINE_BYTES + b"]")
+    assert res.status == "413 REQUEST ENTITY TOO LARGE"
+
+
+def test_report_traffic_ndjson_fails_when_empty(client: FlaskClient):
+    res = post_ndjson(client, b"\n")
+    assert res.text == "The request did not contain any traffic records."
+    assert res.status == "400 BAD REQUEST"
@@ -0,0 +1,84 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from datetime import timedelta
+
+import sqlalchemy as sqla
+from flask import Flask
+from flask.testing import FlaskCliRunner
+
+from flaskr.models.view_rollup import ViewRollup
+from flaskr.models.visitor_sketch import VisitorSketch
+from flaskr.processing.query_runner import Metric, Query, QueryEngine, run_query
+from flaskr.processing.rollups import rebuild_rollups
+from flaskr.storage.database import db
+from flaskr.test.test_run_query import START_TIME, add_views, add_visitors
+
+
+def get_index_names() -> set:
+    inspector = sqla.inspect(db.engine)
+    return {
+        index["name"]
+        for table in inspector.get_table_names()
+        for index in inspector.get_indexes(table)
+    }
+
+
+def test_upgrade_db_creates_missing_indexes(runner: FlaskCliRunner):
+    expected = {
+        index.name for table in db.metadata.sorted_tables for index in table.indexes
+    }
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(bind=db.engine)
+    assert not (get_index_names() & expected)
+
+    res = runner.invoke(args=["upgrade-db"])
+    assert res.exit_code == 0
+    assert expected <= get_index_names()
+
+
+def test_upgrade_db_is_idempotent(runner: FlaskCliRunner):
+    assert runner.invoke(args=["upgrade-db"]).exit_code == 0
+    assert runner.invoke(args=["upgrade-db"]).exit_code == 0
+
+
+def test_upgrade_db_fills_new_rollups_table(app: Flask, runner: FlaskCliRunner):
+    add_views(100)
+    ViewRollup.__table__.drop(bind=db.engine)
+
+    assert runner.invoke(args=["upgrade-db"]).exit_code == 0
+    query = Query(START_TIME, START_TIME + timedelta(days=3), 86400, None, None)
+    assert (
+        run_query(db.session, query, QueryEngine.Rollup).make_json()
+        == run_query(db.session, query, QueryEngine.Sql).make_json()
+    )
+
+
+def test_upgrade_db_fills_new_visitor_sketch_table(app: Flask, runner: FlaskCliRunner):
+    add_visitors(300, 50)
+    rebuild_rollups(db.session)
+    db.session.commit()
+    VisitorSketch.__table__.drop(bind=db.engine)
+
+    assert runner.invoke(args=["upgrade-db"]).exit_code == 0
+    query = Query(
+        START_TIME,
+        START_TIME + timedelta(days=1),
+        86400,
+        None,
+        None,
+        metric=Metric.UniqueVisitors,
+    )
+    result = run_query(db.session, query, QueryEngine.Rollup).make_json()
+    assert result["buckets"][0]["data"] == {"Count": 50}
@@ -12,15 +12,161 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import csv
-from datetime import datetime
+import gzip
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 import click
 import requests
 
-# The number of views to report in each call to the server.
+# The default number of views to report in each call to the server.
 # This must be within the requirements of the API.
 BATCH_SIZE = 200
+# Seconds to wait before the first retry of a failed request. Doubles with
+# each further retry.
+RETRY_BACKOFF_SEC = 0.5
+# Seconds to wait for the server to respond before retrying a request.
+REQUEST_TIMEOUT_SEC = 30
+# Content type of request bodies in the columnar format accepted by the API.
+COLUMNAR_CONTENT_TYPE = "application/vnd.site-analytics.columnar+json"
+# Content type of request bodies with one view per line.
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def make_columnar_traffic(batch: List[dict]) -> dict:
+    """
+    Encodes `batch` in the columnar format of the API, in which each
+    distinct URL and user agent is only sent once.
+    """
+    urls: Dict[str, int] = {}
+    user_agents: Dict[str, int] = {}
+    return {
+        "url": [urls.setdefault(view["url"], len(urls)) for view in batch],
+        "user_agent": [
+            user_agents.setdefault(view["user_agent"], len(user_agents))
+            for view in batch
+        ],
+        "ip_address": [view["ip_address"] for view in batch],
+        "timestamp": [view["timestamp"] for view in batch],
+        "urls": list(urls),
+        "user_agents": list(user_agents),
+    }
+
+
+def encode_batch(
+    batch: List[dict], body_format: str, use_gzip: bool
+) -> Tuple[bytes, Dict[str, str]]:
+    """Returns the request body for `batch` and its content headers."""
+    if body_format == "columnar":
+        body = json.dumps(make_columnar_traffic(batch)).encode()
+        headers = {"Content-Type": COLUMNAR_CONTENT_TYPE}
+    elif body_format == "ndjson":
+        body = "\n".join(json.dumps(view) for view in batch).encode()
+        headers = {"Content-Type": NDJSON_CONTENT_TYPE}
+    else:
+        body = json.dumps({"traffic": batch}).encode()
+        headers = {"Content-Type": "application/json"}
+    if use_gzip:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+class Uploader:
+    """
+    Sends batches of views to the server, retrying requests that fail with
+    a 5xx or 429 status, a connection error or a timeout. Each thread keeps
+    its own `requests.Session`, so connections are reused across requests.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        password: str,
+        max_retries: int,
+        body_format: str = "json",
+        use_gzip: bool = False,
+        timeout: float = REQUEST_TIMEOUT_SEC,
+    ):
+        self._url = url
+        self._password = password
+        self._max_retries = max_retries
+        self._body_format = body_format
+        self._use_gzip = use_gzip
+        self._timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Latency of each successful request, in seconds.
+        self.latencies: List[float] = []
+        self.num_retries = 0
+
+    def send(self, batch: List[dict]) -> int:
+        """
+        Sends `batch`, raising `ValueError` if it can't be sent. Returns the
+        number of sent views.
+        """
+        body, headers = encode_batch(batch, self._body_format, self._use_gzip)
+        headers["Authorization"] = self._password
+        for attempt in range(self._max_retries + 1):
+            start_time = time.perf_counter()
+            retry_after: Optional[str] = None
+            try:
+                res = self._get_session().post(
+                    self._url, data=body, headers=headers, timeout=self._timeout
+                )
+                # The server responds 202 if it buffers the views.
+                if res.status_code in (200, 202):
+                    with self._lock:
+                        self.latencies.append(time.perf_counter() - start_time)
+                    return len(batch)
+                if res.status_code != 429 and res.status_code < 500:
+                    raise ValueError(
+                        f"Request failed with status {res.status_code}: {res.text}"
+                    )
+                error = f"status {res.status_code}: {res.text}"
+                retry_after = res.headers.get("Retry-After")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            if attempt == self._max_retries:
+                raise ValueError(
+                    f"Request failed after {attempt + 1} attempts with {error}"
+                )
+            with self._lock:
+                self.num_retries += 1
+            backoff = RETRY_BACKOFF_SEC * 2**attempt
+            if retry_after and retry_after.isdigit():
+                backoff = max(backoff, int(retry_after))
+            # Add jitter so that concurrent retries don't arrive together.
+            time.sleep(backoff * random.uniform(1, 1.5))
+
+    def _get_session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+
+def read_batches(traffic_csv: Path, batch_size: int) -> Iterator[List[dict]]:
+    """Yields the records in `traffic_csv` in batches of `batch_size`."""
+    with open(traffic_csv, newline="") as csvfile:
+        reader = csv.DictReader(
+            csvfile, fieldnames=["timestamp", "url", "ip_address", "user_agent"]
+        )
+        batch = []
+        for line, row in enumerate(reader, start=1):
+            if len(row) != 4 or None in row.values():
+                raise ValueError(f"Invalid row at line {line}: {row}")
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
 
 @click.command()
@@ -33,11 +179,46 @@ BATCH_SIZE = 200
 @click.argument("host", type=str)
 @click.argument("port", type=int)
 @click.password_option(required=True)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of requests sent at the same time.",
+)
+@click.option(
+    "--max_retries",
+    type=click.IntRange(min=0),
+    default=5,
+    help="Number of times a request failing with a 5xx or 429 status, a "
+    "connection error or a timeout is retried.",
+)
+@click.option(
+    "--format",
+    "body_format",
+    type=click.Choice(["json", "columnar", "ndjson"]),
+    default="json",
+    help="Format of the request bodies. `columnar` sends each distinct URL "
+    "and user agent once per request. `ndjson` sends one view per line and "
+    "is streamed by the server, which suits large batches.",
+)
+@click.option(
+    "--batch_size",
+    type=click.IntRange(min=1),
+    default=BATCH_SIZE,
+    help="Number of views per request. Must be within the server's "
+    "configured maximum.",
+)
+@click.option("--gzip", "use_gzip", is_flag=True, help="Gzip the request bodies.")
 def ingest_data(
     traffic_csv: Path,
     host: str,
     port: int,
     password: str,
+    concurrency: int,
+    max_retries: int,
+    body_format: str,
+    use_gzip: bool,
+    batch_size: int,
 ):
     """
     Reads records from the provided CSV file and sends `ReportTraffic` requests
@@ -53,36 +234,40 @@ def ingest_data(
     PASSWORD: secret key used to authenticate API requests, e.g. `dev-12345`.
     """
     click.echo(f"Will send requests to http://{host}:{port}.")
-    start_time = datetime.now()
-    with open(traffic_csv, newline="") as csvfile:
-        reader = csv.DictReader(
-            csvfile, fieldnames=["timestamp", "url", "ip_address", "user_agent"]
-        )
-        # Batch views into requests for improved performance.
-        curr_batch = {"traffic": []}
-        line = 1
-        num_ingested = 0
-        for row in reader:
-            if len(row) != 4:
-                raise ValueError(f"Invalid row at line {line}: {row}")
-            curr_batch["traffic"].append(row)
-            num_ingested += 1
-            if len(curr_batch["traffic"]) == BATCH_SIZE:
-                res = requests.post(
-                    f"http://{host}:{port}/api/v1/traffic",
-                    json=curr_batch,
-                    headers={"Authorization": password},
-                )
-                if res.status_code != 200:
-                    raise ValueError(
-                        f"Request failed with status {res.status_code}: {res.text}"
-                    )
-                curr_batch["traffic"].clear()
-    end_time = datetime.now()
+    uploader = Uploader(
+        f"http://{host}:{port}/api/v1/traffic",
+        password,
+        max_retries,
+        body_format,
+        use_gzip,
+    )
+    start_time = time.perf_counter()
+    num_ingested = 0
+    with ThreadPoolExecutor(concurrency) as executor:
+        in_flight: Set[Future] = set()
+        for batch in read_batches(traffic_csv, batch_size):
+            # Don't read further ahead than the requests that can be sent.
+            if len(in_flight) >= 2 * concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    num_ingested += future.result()
+            in_flight.add(executor.submit(uploader.send, batch))
+        for future in in_flight:
+            num_ingested += future.result()
+    elapsed = time.perf_counter() - start_time
+
     click.echo(
-        f"Sent {num_ingested} records for ingestion. Took "
-        f"{(end_time - start_time).seconds} seconds."
+        f"Sent {num_ingested} records for ingestion in {len(uploader.latencies)} "
+        f"requests. Took {elapsed:.1f} seconds ({num_ingested / elapsed:.0f} "
+        f"records/sec), with {uploader.num_retries} retries."
     )
+    if uploader.latencies:
+        latencies = sorted(uploader.latencies)
+        click.echo(
+            f"Request latency: median {statistics.median(latencies) * 1000:.0f} ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f} ms, "
+            f"max {latencies[-1] * 1000:.0f} ms."
+        )
 
 
 if __name__ == "__main__":
@@ -11,8 +11,8 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from datetime import datetime
-from typing import List, Set
+from datetime import datetime, timedelta
+from typing import Dict, List, Set, Tuple
 
 import matplotlib.pyplot as plt
 import requests
@@ -26,6 +26,17 @@ def get_groups(res: dict) -> Set[str]:
     return groups
 
 
+def read_columnar(res: dict) -> Tuple[List[datetime], Dict[str, List[int]]]:
+    """
+    Returns the bucket start times and the series of counts of each key in
+    a query response in the columnar format.
+    """
+    start_time = datetime.fromisoformat(res["start_time"])
+    step = timedelta(seconds=res["time_bucket"])
+    x_axis = [start_time + i * step for i in range(res["num_buckets"])]
+    return x_axis, dict(zip(res["all_keys"], res["counts"]))
+
+
 if __name__ == "__main__":
     response = requests.get(
         r"http://127.0.0.1:5000/api/v1/data/query",
@@ -36,18 +47,14 @@ if __name__ == "__main__":
             "filter_by": "Humans",
             "group_by": "Country",
             "time_bucket": 86400,
+            "format": "Columnar",
         },
     )
     if response.status_code != 200:
         raise ValueError(f"Error: {response.status_code} {response.text}")
     # print(response.text)
 
-    series = {group: [] for group in response.json()["all_keys"]}
-    x_axis: List[datetime] = []
-    for bucket in response.json()["buckets"]:
-        x_axis.append(datetime.fromisoformat(bucket["timestamp"]))
-        for group_name in series:
-            series[group_name].append(bucket["data"].get(group_name, 0))
+    x_axis, series = read_columnar(response.json())
     # print(x_axis)
     # print(series)
 